@@ -1,7 +1,21 @@
 import re
 from collections import namedtuple
+from functools import lru_cache
 
 
+# Spellings that fuzzy search treats as the same sound (or as nothing).
+NORMALIZE_SPELLING = {'q': 'k', 'y': 'i', 'w': 'u', 'e': '', "'": ''}
+# Lowercases everything but R (which is distinct from r except at the start
+# of a word) and applies NORMALIZE_SPELLING in one pass.
+NORMALIZE_TABLE = str.maketrans({
+    char: NORMALIZE_SPELLING.get(char.lower(), char.lower())
+    for char in 'ABCDEFGHIJKLMNOPQSTUVWXYZ' + ''.join(NORMALIZE_SPELLING)
+})
+G_NOT_AFTER_N = re.compile('(?<!n)g')
+VOWEL_RUN = re.compile(r'([aiu])\1+')
+
+
+@lru_cache(maxsize=65536)
 def normalize(word, g_and_r=True):
     '''
     Perform fuzzy search normalization (collapse commonly confused sounds
@@ -21,18 +35,14 @@ def normalize(word, g_and_r=True):
     'kingunk'
     >>> normalize('giinaq', g_and_r=False)
     'ginak'
+    >>> normalize('Ruuyaq')
+    'ruiak'
     '''
-    if g_and_r:
-        word = re.sub('(?<!n)g', 'r', word)
-    word = re.sub('[A-QS-Z]|^R', lambda m: m.group().lower(), word)
-    word = (word.replace('q', 'k')
-                .replace('y', 'i')
-                .replace('w', 'u')
-                .replace('e', '')
-                .replace(u"'", ''))
-    for vowel in 'aiu':
-        word = re.sub(vowel + '+', vowel, word)
-    return word
+    if g_and_r and 'g' in word:
+        word = G_NOT_AFTER_N.sub('r', word)
+    if word.startswith('R'):
+        word = 'r' + word[1:]
+    return VOWEL_RUN.sub(r'\1', word.translate(NORMALIZE_TABLE))
 
 
 CONSONANT = '([ptckqwlysgrmnR]|ng|ll|hm|hn|hng)'
@@ -273,6 +283,62 @@ def get_root(word, pos='', defn=''):
     return word
 
 
+DerivedFields = namedtuple('DerivedFields', ['search_word', 'search_text', 'pos_auto',
+                                             'pos_final', 'root_auto', 'root_final'])
+
+
+def derive_fields(word, defn, pos='', root=''):
+    '''
+    The fields of a dictionary entry computed from its word, definition and
+    (possibly blank) part of speech and root, as stored by Entry.fill.
+
+    >>> derive_fields('taqukaq', 'Bear')
+    DerivedFields(search_word='takukak', search_text='bear', pos_auto='n', pos_final='n', \
+root_auto='taqukar', root_final='taqukar')
+    '''
+    pos_auto = get_pos(word, defn)
+    pos_final = pos or pos_auto
+    root_auto = get_root(word, pos_final, defn)
+    return DerivedFields(
+        search_word=normalize(word),
+        search_text=defn.lower(),
+        pos_auto=pos_auto,
+        pos_final=pos_final,
+        root_auto=root_auto,
+        root_final=root or root_auto,
+    )
+
+
+# Patterns for apply_negative and apply_transformations, compiled once at
+# import rather than rebuilt from CONSONANT on every call.
+AI_UI_T_END = re.compile(r'[au]iT$')
+VOWEL_T_END = re.compile(r'[aeiou]T$')
+VCE_FRIC_END = re.compile('[aeiou]' + CONSONANT + 'e[gr]$')
+VCER_END = re.compile('[aeiou]' + CONSONANT + 'er$')
+CV_START = re.compile(r'^.' + CONSONANT + "[aeiou]")
+OPEN_START = re.compile(r'^.' + CONSONANT + "[aeiou']")
+CLOSED_START = re.compile(r'^.(' + CONSONANT + '|$)(' + CONSONANT + '|$)')
+CC_END = re.compile(CONSONANT + CONSONANT + '$')
+CC_START = re.compile(r'^.' + CONSONANT + CONSONANT)
+SINGLE_LL_END = re.compile("([aeiou']|^)ll$")
+SINGLE_LL_START = re.compile("^ll[aeiou']")
+G_CONS = re.compile(r'~g' + CONSONANT)
+L_NG_VOWEL_START = re.compile(r'^~(l|ng)[aeiou]')
+STRONG_FRIC_END = re.compile(r'[aiu][rg]\*$')
+STOP_E_END = re.compile('[stpkqc]e$')
+LONG_VOWEL_END = re.compile(r'([aeiou])\1$')
+VOWEL_PAIR_END = re.compile(r"[aeiou]\\?[aeiou]$")
+DROPPED_LONG_VC_END = re.compile(r'([aiu])\\\1' + CONSONANT + '$')
+DROPPED_VV_END = re.compile(r'([aiu])\\([aiu])$')
+DROPPED_LONG_END = re.compile(r'([aiu])\\\1$')
+DROPPED_BEFORE_VOWEL = re.compile(r'(?<=[a-zR])\\(?=[aiu])')
+DROPPED_FRIC_OPEN = re.compile(r'\\[gr][aiu](' + CONSONANT + '|$)')
+DROPPED_FRIC_SAME = re.compile(r'([aiu])\\[gr]\1')
+DROPPED_FRIC_I = re.compile(r'i\\[gr]')
+DROPPED_FRIC_U = re.compile(r'u\\[gr]')
+DROPPED_FRIC_A = re.compile(r'a\\[gr]')
+
+
 def apply_vowel_alternation(center, before):
     if center is None:
         return None
@@ -312,11 +378,11 @@ def apply_negative(before, center):
                 # asi\iT !+[+t]uq => asir +[+t]uq => asirtuq
                 if before.endswith(r'\iT'):
                     before = before[:-3] + 'r'
-                elif re.search(r'[au]iT$', before):
+                elif AI_UI_T_END.search(before):
                     before = before[:-2] + 'r'
                 elif before.endswith('kiT'):
                     before = before[:-3] + "tu"
-                elif re.search(r'[aeiou]T$', before):
+                elif VOWEL_T_END.search(before):
                     before = before[:-1]
                     negative = True
                 else:
@@ -425,7 +491,7 @@ def apply_transformations(before, center, after):
 
             if center.endswith('rr') or center.endswith('gg'):
                 center = center[:-2]
-            elif re.search('[aeiou]' + CONSONANT + 'e[gr]$', center) and \
+            elif VCE_FRIC_END.search(center) and \
                     len(after) >= 2 and after[1] in 'aiu':
                 # nuter -a => nutra
                 center = center[:-2] + center[-1]
@@ -443,10 +509,10 @@ def apply_transformations(before, center, after):
                 center = center[:-1]
             elif center.endswith('e') and len(after) >= 2 and after[1] in 'aeiou':
                 center = center[:-1] + "'"
-            elif center.endswith('e') and re.search(r'^.' + CONSONANT + "[aeiou]", after):
+            elif center.endswith('e') and CV_START.search(after):
                 center = center[:-1]
-                if re.search(CONSONANT + CONSONANT + '$', center) or \
-                        re.search(r'^.' + CONSONANT + CONSONANT, after):
+                if CC_END.search(center) or \
+                        CC_START.search(after):
                     if not center.endswith(after[1:2]) and \
                             (after[1:2] in list('ptckqsgrh') or after[1:3] == 'll') and \
                             (center[-1:] in list('ptckqsgrh') or center.endswith('ll')):
@@ -482,17 +548,17 @@ def apply_transformations(before, center, after):
                     # leave one g in place
                 elif center.endswith(('gg', 'rr', 'g*', 'r*')):
                     center = center[:-2]
-                elif re.search('[aeiou]' + CONSONANT + 'er$', center) and \
+                elif VCER_END.search(center) and \
                         len(after) >= 3 and after[2] in 'aeiou':
                     # nater ~ka => natqa
                     center = center[:-2]
                 elif center[-1] not in 'aioul':
                     center = center[:-1]
 
-                double_center = (re.search(CONSONANT + CONSONANT + '$', center) and
-                                 not re.search("([aeiou']|^)ll$", center))
-                double_after = (re.search(r'^.' + CONSONANT + CONSONANT, after) and
-                                not re.search("^ll[aeiou']", after))
+                double_center = (CC_END.search(center) and
+                                 not SINGLE_LL_END.search(center))
+                double_after = (CC_START.search(after) and
+                                not SINGLE_LL_START.search(after))
                 voiceless_center = (center[-1:] in list('ptckqsgrh') or center.endswith('ll'))
                 voiceless_after = (after[1:2] in list('ptckqsgrh') or after[1:3] == 'll')
                 if (double_center or double_after) and (voiceless_center or voiceless_after):
@@ -500,14 +566,14 @@ def apply_transformations(before, center, after):
                     # iluqlle ~ka => iluqll'ka
                     center += "'"
             elif after.startswith('~g'):
-                if re.search('[aeiou]' + CONSONANT + 'e[gr]$', center) and \
+                if VCE_FRIC_END.search(center) and \
                         len(after) >= 3 and after[2] in 'aeiou':
                     # nater ~ga => natra
                     center = center[:-2]
                     if center.endswith('w'):
                         # kiweg ~ganun => kiw ~ganun => kiuganun
                         center = center[:-1] + 'u'
-                elif center.endswith('e') and re.search(r'~g' + CONSONANT, after):
+                elif center.endswith('e') and G_CONS.search(after):
                     center = center[:-1] + "'"
                 elif center.endswith(('gg', 'rr', 'g*', 'r*')):
                     center = center[:-2]
@@ -526,7 +592,7 @@ def apply_transformations(before, center, after):
                     # aiwite ~ngama => aiwicama
                     center = center[:-2]
 
-                    if center and center[-1] not in "aeiou'" and not re.search(r'^~(l|ng)[aeiou]', after):
+                    if center and center[-1] not in "aeiou'" and not L_NG_VOWEL_START.search(after):
                         # mikte ~lnguq => mik'llnguq
                         # BUT: pekte ~luni => peklluni
                         center += "'"
@@ -537,8 +603,8 @@ def apply_transformations(before, center, after):
                     # age ~luni => agluni
                     center = center[:-1]
 
-                    double_center = (re.search(CONSONANT + CONSONANT + '$', center) and
-                                     not re.search("([aeiou']|^)ll$", center))
+                    double_center = (CC_END.search(center) and
+                                     not SINGLE_LL_END.search(center))
                     voiceless_center = (center[-1:] in list('ptckqsgrh') or center.endswith('ll'))
                     if double_center and voiceless_center:
                         # piugte ~ka => piugt'ka
@@ -575,7 +641,7 @@ def apply_transformations(before, center, after):
                 }.get(center[-1:], center[-1:])
             elif center.endswith('*') and after.startswith('+e'):
                 #
-                if re.search(r'[aiu][rg]\*$', center):
+                if STRONG_FRIC_END.search(center):
                     center = center[:-1]
                 center = center[:-1]
             elif center.endswith('*'):
@@ -590,25 +656,25 @@ def apply_transformations(before, center, after):
                     center += "'"
             elif center.endswith("'") and len(after) >= 2 and after[1] not in 'aeiou':
                 center = center[:-1]
-            elif re.search('[aeiou]' + CONSONANT + 'e[gr]$', center) and \
+            elif VCE_FRIC_END.search(center) and \
                     len(after) >= 2 and after[1] in 'aeiou':
                 # nater +en => natren
                 center = center[:-2] + center[-1]
                 if len(center) >= 2 and center[-2] == 'w':
                     # kiweg +a => kiwg +a => kiuga
                     center = center[:-2] + 'u' + center[-1]
-            elif re.search('[stpkqc]e$', center) and \
+            elif STOP_E_END.search(center) and \
                     len(after) >= 2 and after[1] in 'gr':
                 # tape +gkunani => tap'gkunani
                 center = center[:-1] + "'"
-            elif re.search(r'([aeiou])\1$', center) and \
+            elif LONG_VOWEL_END.search(center) and \
                     len(after) >= 2 and after[1] == '\\':
                 # tamaa +\um => tamaatum
                 # This is a horrible hack. The good alternative would be to allow having
                 # multiple roots, which demonstratives have (tamaatu-, tamaaku-, tamaa-).
                 center = center + "t"
 
-        if re.search(r"[aeiou]\\?[aeiou]$", center) and \
+        if VOWEL_PAIR_END.search(center) and \
                 len(after) >= 2 and after[1] in 'aeiou':
             # ki\ir -a => kiiya
             # ki\ir -it => kii'it
@@ -667,51 +733,93 @@ def apply_transformations(before, center, after):
                 # piugtA -a => piugtii
                 # niuwasuutE -a => niuwasuutii
                 center = 'i' + center[1:]
-            elif center.startswith('e') and re.search(r'[aiu][gr]\*$', before):
+            elif center.startswith('e') and STRONG_FRIC_END.search(before):
                 # taquka\ra +et => taquka\ra at => taqukaraat
                 center = before[-3] + center[1:]
         else:
             center = ' ' + center
 
-    if after and re.search(r'^.' + CONSONANT + "[aeiou']", after):
+    if after and OPEN_START.search(after):
         # su\ug ~ka => sugka
-        center = re.sub(r'([aiu])\\\1' + CONSONANT + '$', r'\1\2', center)
+        center = DROPPED_LONG_VC_END.sub(r'\1\2', center)
         # asi\i +tuq => asiituq
-        center = re.sub(r'([aiu])\\([aiu])$', r'\1\2', center)
-    elif after and re.search(r'^.(' + CONSONANT + '|$)(' + CONSONANT + '|$)', after):
+        center = DROPPED_VV_END.sub(r'\1\2', center)
+    elif after and CLOSED_START.search(after):
         # su\ug + => suk
-        center = re.sub(fr'([aiu])\\\1{CONSONANT}$', r'\1\2', center)
+        center = DROPPED_LONG_VC_END.sub(r'\1\2', center)
         # su\ug ~gci => sugci
         # pi\i +lnguq = pilnguq
-        center = re.sub(r'([aiu])\\\1$', r'\1', center)
+        center = DROPPED_LONG_END.sub(r'\1', center)
     elif after:
         # su\ug +a => suuga
-        center = re.sub(r'(?<=[a-zR])\\(?=[aiu])', '', center)
+        center = DROPPED_BEFORE_VOWEL.sub('', center)
 
     if '\\' in center:
         if before and center.startswith('\\') and before.endswith(center[1:2]):
             center = center[2:]
-        if re.search(fr'\\[gr][aiu]({CONSONANT}|$)', center + (after or '')[1:]):
-            center = re.sub(r'([aiu])\\[gr]\1', r"\1'\1", center)
-            center = re.sub(r'i\\[gr]', 'iy', center)
-            center = re.sub(r'u\\[gr]', 'uw', center)
-            center = re.sub(r'a\\[gr]', "a'", center)
+        if DROPPED_FRIC_OPEN.search(center + (after or '')[1:]):
+            center = DROPPED_FRIC_SAME.sub(r"\1'\1", center)
+            center = DROPPED_FRIC_I.sub('iy', center)
+            center = DROPPED_FRIC_U.sub('uw', center)
+            center = DROPPED_FRIC_A.sub("a'", center)
         center = center.replace('\\', '')
 
     return center
 
 
-def morpho_join(chunks):
-    if '-' in chunks:
-        return '-'
+class MorphoEngine(object):
+    '''
+    Joins chunks of a word (root, postbases, endings) with the
+    morphophonological rules in `apply_transformations`, remembering the
+    result of each `(before, center, after)` triple and of each whole join.
+    Both are pure functions of their strings, and the same triples come up
+    over and over within a paradigm and across roots, so a batch job that
+    builds many paradigms can pass one engine around and share its cache.
+
+    >>> engine = MorphoEngine(maxsize=100)
+    >>> engine.join(['nallu', '~aqa'])
+    'nalluwaqa'
+    >>> engine.join(['nallu', '~aqa'])
+    'nalluwaqa'
+    >>> engine.stats()['join']
+    {'hits': 1, 'misses': 1, 'size': 1, 'maxsize': 100}
+    '''
+    def __init__(self, maxsize=65536):
+        self.maxsize = maxsize
+        self.transform = lru_cache(maxsize=maxsize)(apply_transformations)
+        self._join = lru_cache(maxsize=maxsize)(self._join_uncached)
+
+    def join(self, chunks):
+        return self._join(tuple(chunks))
+
+    def _join_uncached(self, chunks):
+        if '-' in chunks:
+            return '-'
+
+        chunks = (None,) + chunks + (None,)
+        transformed = []
+        for i in range(1, len(chunks) - 1):
+            transformed.append(self.transform(chunks[i - 1],
+                                              chunks[i],
+                                              chunks[i + 1]))
+        return ''.join(transformed)
 
-    chunks = [None] + chunks + [None]
-    transformed = []
-    for i in range(1, len(chunks) - 1):
-        transformed.append(apply_transformations(chunks[i - 1],
-                                                 chunks[i],
-                                                 chunks[i + 1]))
-    return ''.join(transformed)
+    def stats(self):
+        return {name: {'hits': info.hits, 'misses': info.misses,
+                       'size': info.currsize, 'maxsize': info.maxsize}
+                for name, info in [('join', self._join.cache_info()),
+                                   ('transform', self.transform.cache_info())]}
+
+    def clear(self):
+        self._join.cache_clear()
+        self.transform.cache_clear()
+
+
+ENGINE = MorphoEngine()
+
+
+def morpho_join(chunks, engine=None):
+    return (engine or ENGINE).join(chunks)
 
 
 Widget = namedtuple('Table', ['id', 'title', 'default', 'rows', 'cols',
@@ -888,8 +996,9 @@ TableRow = namedtuple('TableRow', ['header', 'cells'])
 TableCell = namedtuple('TableCell', ['id', 'map'])
 
 
-def build_tables(root):
-    endings_map = get_endings_map(root.root, root.pos)
+def build_tables(root, endings_map=None):
+    if endings_map is None:
+        endings_map = get_endings_map(root.root, root.pos)
 
     for w in HIERARCHY[root.pos]:
         column_headers = [header for id_, header in w.cols]
@@ -915,13 +1024,107 @@ def build_tables(root):
         yield table
 
 
+def default_tables(tables):
+    '''
+    Copies of `tables` keeping only the forms that are visible before any
+    cell is clicked, when every table shows its default cell. Follows the
+    order in which endings.js activates the defaults.
+    '''
+    tables = list(tables)
+    active = set()
+    for table in tables:
+        for row in table.rows:
+            for cell in row.cells:
+                active.difference_update(cell.id.split(':'))
+        active.update(table.default.split(':'))
+
+    def visible(id):
+        return not id or active.issuperset(id.split(':'))
+
+    return [
+        table._replace(rows=[
+            row._replace(cells=[
+                cell._replace(map={id: form for id, form in cell.map.items() if visible(id)})
+                for cell in row.cells
+            ])
+            for row in table.rows
+        ])
+        for table in tables
+    ]
+
+
+def table_maps(pos, endings_map, table_id=None):
+    '''
+    The forms in each cell of the ending tables for `pos`, as
+    {table id: {cell id: {form id: form}}}, optionally only for one table.
+
+    >>> maps = table_maps('vt', get_endings_map('nallu', 'vt'), 'tense')
+    >>> list(maps)
+    ['tense']
+    >>> maps['tense']['PRES:POS']['O3P:OSG:S1P:SSG']
+    'nalluwaqa'
+    '''
+    return {
+        widget.id: {cell.id: cell.map
+                    for row in build_rows(widget, endings_map)
+                    for cell in row.cells}
+        for widget in HIERARCHY[pos]
+        if table_id is None or widget.id == table_id
+    }
+
+
 def build_rows(widget, endings_map):
+    index = index_endings(widget, endings_map)
     for id, header in widget.rows:
         row = TableRow(header,
-                       list(build_cells(id, widget, endings_map)))
+                       list(build_cells(id, widget, index)))
         yield row
 
 
+@lru_cache(maxsize=4096)
+def split_id(full_id):
+    '''
+    >>> split_id('PRES:1P:SG')[1]
+    ('1P', 'PRES', 'SG')
+    '''
+    parts = frozenset(full_id.split(':'))
+    return parts, tuple(sorted(parts))
+
+
+EndingsIndex = namedtuple('EndingsIndex', ['items', 'by_tag', 'row_flattened', 'col_flattened'])
+
+
+def index_endings(widget, endings_map):
+    '''
+    Split each full id in `endings_map` into its tags once and record which
+    forms carry each tag (and which are flattened across the rows or columns
+    of `widget`), so each table cell only looks at the forms that can
+    appear in it.
+
+    >>> w = Widget(id='', title='', default='a:A', rows=[('a', '')], cols=[('A', '')],
+    ...            row_flatten=['X'], col_flatten=['X'])
+    >>> index = index_endings(w, {'a:A:Y': 'aay', 'X': 'x'})
+    >>> index.items
+    [(('A', 'Y', 'a'), 'aay'), (('X',), 'x')]
+    >>> index.by_tag['a'], index.row_flattened
+    ({0}, {1})
+    '''
+    items = []
+    by_tag = {id: set() for id, header_ in widget.rows + widget.cols}
+    row_flattened = set()
+    col_flattened = set()
+    for i, (full_id, inflection) in enumerate(endings_map.items()):
+        parts, sorted_parts = split_id(full_id)
+        items.append((sorted_parts, inflection))
+        for part in parts.intersection(by_tag):
+            by_tag[part].add(i)
+        if not parts.isdisjoint(widget.row_flatten):
+            row_flattened.add(i)
+        if not parts.isdisjoint(widget.col_flatten):
+            col_flattened.add(i)
+    return EndingsIndex(items, by_tag, row_flattened, col_flattened)
+
+
 def external_subset(full_id, internal):
     '''
     >>> external_subset('PAST:1P:DU', ['1P', 'DU'])
@@ -956,27 +1159,40 @@ def is_active(row_id, col_id, full_id, widget):
     return check_active.issubset(full_parts)
 
 
-def build_cells(row_id, widget, endings_map):
+def build_cells(row_id, widget, index):
+    '''
+    Equivalent to collecting, for each column, the forms of the endings map
+    for which `is_active` holds, keyed by `external_subset`, but using the
+    tag buckets of `index_endings` instead of testing every form.
+    '''
     if widget.cols:
+        row_matches = index.by_tag[row_id] | index.row_flattened
         for col_id, header_ in widget.cols:
+            # Same conditions as is_active.
+            matches = None
+            if row_id not in widget.spancols:
+                matches = index.by_tag[col_id] | index.col_flattened
+            if col_id not in widget.spanrows:
+                matches = row_matches if matches is None else matches & row_matches
+            if matches is None:
+                matches = range(len(index.items))
             sub_map = {
-                external_subset(full_id, [row_id, col_id]): inflection
-                for full_id, inflection in endings_map.items()
-                if is_active(row_id, col_id, full_id, widget)
+                ':'.join(part for part in index.items[i][0]
+                         if part != row_id and part != col_id): index.items[i][1]
+                for i in sorted(matches)
             }
             cell = TableCell(':'.join([row_id, col_id]), sub_map)
             yield cell
     else:
         sub_map = {
-            external_subset(full_id, [row_id]): inflection
-            for full_id, inflection in endings_map.items()
-            if row_id in full_id.split(':')
+            ':'.join(part for part in index.items[i][0] if part != row_id): index.items[i][1]
+            for i in sorted(index.by_tag[row_id])
         }
         cell = TableCell(row_id, sub_map)
         yield cell
 
 
-def get_endings_map(root, pos):
+def get_endings_map(root, pos, engine=None):
     '''
     >>> get_endings_map('yaamar', 'n')['ABS:DU:POSS1P:POSSSG']
     'yaamagka'
@@ -985,9 +1201,8 @@ def get_endings_map(root, pos):
     >>> get_endings_map('nallu', 'vt')['O3P:OSG:POS:PRES:S1P:SSG']
     'nalluwaqa'
     '''
-    endings_map = {}
-    build_endings(endings_map, ID_LISTS[pos], root, ENDINGS[pos])
-    return endings_map
+    return {full_id: morpho_join([root, ending], engine=engine)
+            for full_id, ending in CELL_PLANS[pos]}
 
 
 def spanned(id_list, id_curr):
@@ -1017,33 +1232,31 @@ def spanned(id_list, id_curr):
     return any(c.issubset(id_curr) for c in conds)
 
 
-def build_endings(endings_map, id_lists, root, endings, id_curr=None):
+def compile_cell_plan(id_lists, endings):
     '''
-    >>> TEST_ENDINGS = [['+a', '+b'], ['+A', '+B']]
-    >>> TEST_ID_LISTS = [['LOWER', 'UPPER'], ['A', 'B']]
-    >>> result = {}
-    >>> build_endings(result, TEST_ID_LISTS, 'x', TEST_ENDINGS)
-    >>> result['B:LOWER']
-    'xb'
+    Flatten the nested ending lists for a part of speech into a tuple of
+    (full_id, ending) pairs with the span rules already resolved, so building
+    a paradigm is one `morpho_join` per pair. Later cells with the same
+    full_id replace earlier ones but keep their position.
+
+    >>> compile_cell_plan([['LOWER', 'UPPER'], ['A', 'B']], [['+a', '+b'], ['+A', '+B']])
+    (('A:LOWER', '+a'), ('B:LOWER', '+b'), ('A:UPPER', '+A'), ('B:UPPER', '+B'))
+    >>> compile_cell_plan([['LOWER', 'UPPER'], ['A-UPPER', 'B-UPPER']], [['+a', '+b'], '+U'])
+    (('A:LOWER', '+a'), ('B:LOWER', '+b'), ('UPPER', '+U'))
     '''
-    if id_curr is None:
-        id_curr = []
-
-    if id_lists:
-        curr_list = id_lists[0]
-        if spanned(curr_list, id_curr):
-            build_endings(endings_map, id_lists[1:], root,
-                          endings, id_curr=id_curr)
+    plan = {}
+
+    def walk(id_lists, endings, id_curr):
+        if not id_lists:
+            plan[':'.join(sorted(id_curr))] = endings
+        elif spanned(id_lists[0], id_curr):
+            walk(id_lists[1:], endings, id_curr)
         else:
-            for id, sub_endings in zip(curr_list, endings):
-                if '-' in id:
-                    id = id.split('-')[0]
-                build_endings(endings_map, id_lists[1:], root,
-                              sub_endings, id_curr=id_curr + [id])
-    else:
-        full_id = ':'.join(sorted(id_curr))
-        cell = morpho_join([root, endings])
-        endings_map[full_id] = cell
+            for id, sub_endings in zip(id_lists[0], endings):
+                walk(id_lists[1:], sub_endings, id_curr + [id.split('-')[0]])
+
+    walk(id_lists, endings, [])
+    return tuple(plan.items())
 
 
 def negatives(table):
@@ -1642,14 +1855,17 @@ ENDINGS = {
 }
 
 
-def inflection_data(root):
+CELL_PLANS = {pos: compile_cell_plan(ID_LISTS[pos], ENDINGS[pos]) for pos in ENDINGS}
+
+
+def inflection_data(root, endings_map=None):
     if root.pos in ENDINGS:
-        return inflect(root)
+        return inflect(root, endings_map)
     else:
         return None
 
 
-def inflect(root):
+def inflect(root, endings_map=None):
     '''
     return [build_table(s, column_headers,
             [TableRow(rh, ['-' if c == '-' else morpho_join([entry, c])
@@ -1657,4 +1873,4 @@ def inflect(root):
              for rh, row in zip(row_headers, cells[i])])
             for i, s in enumerate(HIERARCHY[root.pos])]
     '''
-    return list(build_tables(root))
+    return list(build_tables(root, endings_map))
@@ -0,0 +1,268 @@
+'''
+Request analytics kept in the database as daily rollups (RequestRollup),
+so that the weekly summary, lists of top searches and week-over-week trends
+can be read off a few small tables instead of recomputed from raw logs.
+
+AnalyticsMiddleware counts each request by kind (see `classify`, which
+weekly_summary also uses for logs) along with its response time, buffers
+the counts in memory and adds them to the rollups from a background thread
+every ANALYTICS_FLUSH_INTERVAL seconds. Visitors are counted by network
+(see `network`), not by address. Set ANALYTICS = False to turn it off.
+'''
+import atexit
+import datetime
+import ipaddress
+import logging
+import threading
+import time
+import urllib.parse
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils import timezone
+
+
+logger = logging.getLogger(__name__)
+
+SEARCH_PREFIX = '/ems/search/?q='
+WORD_PREFIX = '/ems/w/'
+# RequestRollup.key is truncated to this length.
+MAX_KEY_LENGTH = 200
+
+# Rollup kinds that make up the sections of the weekly summary.
+SUMMARY_KINDS = {
+    'search': 'searches',
+    'word': 'words',
+    'page': 'other_2xx',
+    '4xx': 'paths_4xx',
+    '5xx': 'paths_5xx',
+    'ip': 'ips',
+}
+# Every request is also counted under this kind, with an empty key.
+TOTAL = 'all'
+
+
+def classify(path, status):
+    '''
+    What kind of request `path` (including any query string) with HTTP
+    status `status` was, and the key it is counted under: ('search', query),
+    ('word', word), ('page', path) for other successful pages, ('4xx', path)
+    or ('5xx', path). Returns None for anything else (static files,
+    redirects).
+
+    >>> classify('/ems/search/?q=nallu+a', '200')
+    ('search', 'nallu a')
+    >>> classify('/ems/w/ta%C5%99aq/', '200')
+    ('word', 'tařaq')
+    >>> classify('/static/dictionary/endings.js', '200') is None
+    True
+    '''
+    if status.startswith('4'):
+        return ('4xx', path)
+    elif status.startswith('5'):
+        return ('5xx', path)
+    elif path.startswith(SEARCH_PREFIX):
+        return ('search', urllib.parse.unquote_plus(path[len(SEARCH_PREFIX):]))
+    elif path.startswith(WORD_PREFIX):
+        word = urllib.parse.unquote(path[len(WORD_PREFIX):])
+        if word.endswith('/'):
+            word = word[:-1]
+        return ('word', word)
+    elif status.startswith('2') and not path.startswith('/static/'):
+        return ('page', path)
+    return None
+
+
+def client_ip(request):
+    forwarded = request.META.get('HTTP_X_FORWARDED_FOR')
+    if forwarded:
+        return forwarded.split(',')[0].strip()
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def network(ip):
+    '''
+    The network `ip` belongs to, which is what is stored instead of the
+    address itself: the /24 of an IPv4 address or the /48 of an IPv6 one.
+    That still places visitors for the weekly summary's locations.
+
+    >>> network('203.0.113.57')
+    '203.0.113.0'
+    >>> network('2001:db8:85a3:8d3:1319:8a2e:370:7348')
+    '2001:db8:85a3::'
+    >>> network('unknown')
+    ''
+    '''
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return ''
+    prefix = 24 if address.version == 4 else 48
+    return str(ipaddress.ip_network((address, prefix), strict=False).network_address)
+
+
+class RollupBuffer(object):
+    '''
+    Request counts and total response times by (date, kind, key), collected
+    in memory and added to the RequestRollup table by `flush`, which once
+    `start`ed runs every `interval` seconds in a background thread (and when
+    the process exits), so requests never wait for it.
+    '''
+    def __init__(self, interval=60):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def add(self, date, kind, key, ms):
+        with self.lock:
+            counts = self.counts.setdefault((date, kind, key[:MAX_KEY_LENGTH]), [0, 0])
+            counts[0] += 1
+            counts[1] += ms
+
+    def record(self, path, status, ip, ms, date=None):
+        date = date or timezone.localdate()
+        self.add(date, TOTAL, '', ms)
+        kind_key = classify(path, str(status))
+        if kind_key is not None:
+            self.add(date, kind_key[0], kind_key[1], ms)
+            if kind_key[0] in ('search', 'word'):
+                self.add(date, 'ip', network(ip), ms)
+
+    def flush(self):
+        with self.lock:
+            counts, self.counts = self.counts, {}
+        if counts:
+            write_rollups(counts)
+
+    def start(self):
+        '''Start flushing in the background, unless already started or `interval` is None.'''
+        with self.lock:
+            if self.thread is not None or self.interval is None:
+                return
+            self.thread = threading.Thread(target=self.run, name='analytics-flush', daemon=True)
+        self.thread.start()
+        atexit.register(self.flush_quietly)
+
+    def run(self):
+        from django.db import connections
+        while not self.stopping.wait(self.interval):
+            self.flush_quietly()
+            connections.close_all()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def flush_quietly(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('Could not save request analytics')
+
+
+def write_rollups(counts, batch_size=100):
+    '''
+    Add {(date, kind, key): [count, total_ms]} to the rollup table, with one
+    INSERT ... ON CONFLICT (upsert) statement per `batch_size` rows.
+    '''
+    from django.db import connection, transaction
+    from .models import RequestRollup
+
+    quote = connection.ops.quote_name
+    table = quote(RequestRollup._meta.db_table)
+    columns = ', '.join(quote(column) for column in ('date', 'kind', 'key', 'count', 'total_ms'))
+    if connection.vendor == 'mysql':
+        on_conflict = ('ON DUPLICATE KEY UPDATE {count} = {count} + VALUES({count}), '
+                       '{ms} = {ms} + VALUES({ms})')
+    else:
+        on_conflict = ('ON CONFLICT ({date}, {kind}, {key}) DO UPDATE SET '
+                       '{count} = {table}.{count} + excluded.{count}, '
+                       '{ms} = {table}.{ms} + excluded.{ms}')
+    on_conflict = on_conflict.format(table=table, date=quote('date'), kind=quote('kind'),
+                                     key=quote('key'), count=quote('count'),
+                                     ms=quote('total_ms'))
+
+    rows = [(date, kind, key, count, ms) for (date, kind, key), (count, ms) in counts.items()]
+    with transaction.atomic(), connection.cursor() as cursor:
+        for i in range(0, len(rows), batch_size):
+            batch = rows[i:i + batch_size]
+            sql = 'INSERT INTO {} ({}) VALUES {} {}'.format(
+                table, columns, ', '.join(['(%s, %s, %s, %s, %s)'] * len(batch)), on_conflict)
+            cursor.execute(sql, [connection.ops.adapt_datefield_value(value)
+                                 if isinstance(value, datetime.date) else value
+                                 for row in batch for value in row])
+
+
+BUFFER = RollupBuffer()
+
+
+class AnalyticsMiddleware(object):
+    def __init__(self, get_response):
+        if not getattr(settings, 'ANALYTICS', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        BUFFER.interval = getattr(settings, 'ANALYTICS_FLUSH_INTERVAL', BUFFER.interval)
+        BUFFER.start()
+
+    def __call__(self, request):
+        start = time.monotonic()
+        response = self.get_response(request)
+        ms = int((time.monotonic() - start) * 1000)
+        try:
+            BUFFER.record(request.get_full_path(), response.status_code, client_ip(request), ms)
+        except Exception:
+            # Never let bookkeeping break a page.
+            logger.exception('Could not save request analytics')
+        return response
+
+
+def summary_from_rollups(start, end):
+    '''
+    A summary of the requests from date `start` up to (not including) date
+    `end`, in the form returned by weekly_summary.summarize_logs, plus
+    'service_ms': the total response time of each section, and
+    'ip_networks', since 'ips' counts networks rather than addresses.
+    '''
+    from collections import Counter
+    from .models import RequestRollup
+
+    summary = {section: Counter() for section in SUMMARY_KINDS.values()}
+    summary['total_requests'] = 0
+    summary['service_ms'] = Counter()
+    summary['ip_networks'] = True
+    rows = (RequestRollup.objects.filter(date__gte=start, date__lt=end)
+                                 .order_by('kind', '-count', 'key')
+                                 .values_list('kind', 'key', 'count', 'total_ms'))
+    for kind, key, count, total_ms in rows:
+        if kind == TOTAL:
+            summary['total_requests'] += count
+            summary['service_ms'][TOTAL] += total_ms
+        elif kind in SUMMARY_KINDS:
+            summary[SUMMARY_KINDS[kind]][key] += count
+            if kind != 'ip':
+                summary['service_ms'][SUMMARY_KINDS[kind]] += total_ms
+    return summary
+
+
+def week_summaries(end=None):
+    '''Summaries of the 7 days before `end` (default today) and the 7 days before those.'''
+    end = end or timezone.localdate()
+    week = datetime.timedelta(days=7)
+    return summary_from_rollups(end - week, end), summary_from_rollups(end - 2 * week, end - week)
+
+
+def top_queries(kind='search', days=7, limit=20, end=None):
+    '''The `limit` most common keys of `kind` over the last `days` days, as (key, count).'''
+    from django.db.models import Sum
+    from .models import RequestRollup
+
+    end = end or timezone.localdate() + datetime.timedelta(days=1)
+    rows = (RequestRollup.objects.filter(kind=kind, date__gte=end - datetime.timedelta(days=days),
+                                         date__lt=end)
+                                 .values('key')
+                                 .annotate(total=Sum('count'))
+                                 .order_by('-total', 'key'))
+    return [(row['key'], row['total']) for row in rows[:limit]]
@@ -0,0 +1,206 @@
+'''
+Streaming backups of the dictionary tables, used by the dumplexicon and
+loadlexicon management commands (and the backup and restore scripts):
+
+    ./manage.py dumplexicon backup.jsonl.gz
+    ./manage.py loadlexicon [--replace] backup.jsonl.gz
+
+A backup is a gzipped JSON Lines file. For each model in MODELS it has a
+header object naming the model and its columns, one JSON array of column
+values per row in primary key order, and a footer object with the number
+of rows and a SHA-1 of the row lines:
+
+    {"format": "lexicon", "version": 1}
+    {"model": "dictionary.source", "fields": ["id", "abbrev", ...]}
+    [1, "A/SD", ...]
+    {"end": "dictionary.source", "count": 1, "sha1": "..."}
+    ...
+
+Rows are read and written in batches, so memory use doesn't grow with the
+size of the dictionary. Stored paradigms are not backed up; they are
+regenerated when needed.
+'''
+import gzip
+import hashlib
+import json
+
+
+FORMAT = 'lexicon'
+VERSION = 1
+BATCH_SIZE = 1000
+
+# Models in the order they are restored: everything a model refers to
+# comes before it (apart from Entry.main_entry, see load_rows).
+MODELS = ['Source', 'Variety', 'Example', 'Entry',
+          'EntryVarietyInfo', 'ExampleVarietyInfo', 'EntryExampleInfo', 'SeeAlso']
+
+
+def get_models():
+    from django.apps import apps
+    return [apps.get_model('dictionary', name) for name in MODELS]
+
+
+def columns(model):
+    return [field.attname for field in model._meta.concrete_fields]
+
+
+def encode(value):
+    # Dates and times, written in full (DjangoJSONEncoder rounds to milliseconds).
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    raise TypeError('cannot back up {!r}'.format(value))
+
+
+def dump_line(obj):
+    return json.dumps(obj, default=encode, ensure_ascii=False) + '\n'
+
+
+def dump_lexicon(path, batch_size=BATCH_SIZE):
+    '''
+    Write every row of the dictionary tables to a backup at `path`.
+    Returns a dict mapping model labels to row counts.
+    '''
+    from django.db import transaction
+
+    counts = {}
+    # One transaction, so the tables are dumped as of the same moment.
+    with transaction.atomic(), gzip.open(path, 'wt', encoding='utf-8') as outfile:
+        outfile.write(dump_line({'format': FORMAT, 'version': VERSION}))
+        for model in get_models():
+            fields = columns(model)
+            outfile.write(dump_line({'model': model._meta.label_lower, 'fields': fields}))
+            checksum = hashlib.sha1()
+            count = 0
+            rows = model.objects.order_by('pk').values_list(*fields)
+            for row in rows.iterator(chunk_size=batch_size):
+                line = dump_line(row)
+                checksum.update(line.encode('utf-8'))
+                outfile.write(line)
+                count += 1
+            outfile.write(dump_line({'end': model._meta.label_lower, 'count': count,
+                                     'sha1': checksum.hexdigest()}))
+            counts[model._meta.label_lower] = count
+    return counts
+
+
+def load_lexicon(path, replace=False, batch_size=BATCH_SIZE):
+    '''
+    Restore the dictionary tables from a backup at `path` with batched
+    inserts, in one transaction. The tables must be empty unless `replace` is true,
+    in which case their current contents are deleted first. Raises
+    ValueError (and leaves the database unchanged) if the file is not a
+    backup or its row counts or checksums don't match. Returns a dict
+    mapping model labels to row counts.
+    '''
+    from django.db import connection, transaction
+    from . import caching, search
+
+    models = get_models()
+    with transaction.atomic():
+        if replace:
+            # Plain DELETEs rather than QuerySet.delete(), which loads every
+            # row to handle cascades and signals.
+            with connection.cursor() as cursor:
+                for model in reversed(models):
+                    cursor.execute('DELETE FROM {}'.format(
+                        connection.ops.quote_name(model._meta.db_table)))
+        for model in models:
+            if model.objects.exists():
+                raise ValueError('{} is not empty (use --replace to overwrite it)'
+                                 .format(model._meta.label_lower))
+
+        with gzip.open(path, 'rt', encoding='utf-8') as infile:
+            header = json.loads(next(infile, 'null'))
+            if not isinstance(header, dict) or header.get('format') != FORMAT:
+                raise ValueError('{} is not a lexicon backup'.format(path))
+            if header['version'] != VERSION:
+                raise ValueError('unsupported backup version {}'.format(header['version']))
+
+            counts = {}
+            for model in models:
+                counts[model._meta.label_lower] = load_rows(model, infile, batch_size)
+
+        reset_sequences(models)
+
+    search.invalidate_index()
+    caching.lexicon_changed()
+    return counts
+
+
+def load_rows(model, infile, batch_size):
+    '''
+    Insert the rows of one model's section of a backup and check them against
+    its footer. Rows go straight to executemany() in batches, with values
+    converted by the model fields, which is much faster than building model
+    instances for bulk_create. Entries can point to main entries with higher
+    ids, which don't exist yet when the entry is inserted; those links are set
+    once the whole section is in.
+    '''
+    from django.db import connection
+
+    label = model._meta.label_lower
+    header = json.loads(next(infile, 'null'))
+    if not isinstance(header, dict) or header.get('model') != label:
+        raise ValueError('expected rows for {}, found {!r}'.format(label, header))
+    fields = [model._meta.get_field(name) for name in header['fields']]
+    id_index = header['fields'].index('id')
+    self_links = [i for i, field in enumerate(fields)
+                  if field.is_relation and field.related_model is model]
+
+    quote = connection.ops.quote_name
+    insert = 'INSERT INTO {} ({}) VALUES ({})'.format(
+        quote(model._meta.db_table),
+        ', '.join(quote(field.column) for field in fields),
+        ', '.join(['%s'] * len(fields)))
+
+    def prepare(field, value):
+        return field.get_db_prep_save(field.to_python(value), connection)
+
+    checksum = hashlib.sha1()
+    count = 0
+    batch = []
+    deferred = []
+    with connection.cursor() as cursor:
+        for line in infile:
+            if not line.startswith('['):
+                footer = json.loads(line)
+                break
+            checksum.update(line.encode('utf-8'))
+            row = [prepare(field, value) for field, value in zip(fields, json.loads(line))]
+            for i in self_links:
+                if row[i] is not None and row[i] >= row[id_index]:
+                    deferred.append((i, row[i], row[id_index]))
+                    row[i] = None
+            batch.append(row)
+            count += 1
+            if len(batch) == batch_size:
+                cursor.executemany(insert, batch)
+                batch = []
+        else:
+            raise ValueError('backup ends in the middle of {}'.format(label))
+        if batch:
+            cursor.executemany(insert, batch)
+
+        for i in self_links:
+            cursor.executemany('UPDATE {} SET {} = %s WHERE {} = %s'.format(
+                                   quote(model._meta.db_table), quote(fields[i].column),
+                                   quote(model._meta.pk.column)),
+                               [(value, id) for j, value, id in deferred if j == i])
+
+    if footer.get('end') != label:
+        raise ValueError('expected the end of {}, found {!r}'.format(label, footer))
+    if footer['count'] != count or model.objects.count() != count:
+        raise ValueError('{}: expected {} rows, found {}'.format(label, footer['count'], count))
+    if footer['sha1'] != checksum.hexdigest():
+        raise ValueError('{}: checksum does not match'.format(label))
+    return count
+
+
+def reset_sequences(models):
+    '''Move id sequences (on databases that have them) past the restored ids.'''
+    from django.core.management.color import no_style
+    from django.db import connection
+
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sequence_reset_sql(no_style(), models):
+            cursor.execute(sql)
@@ -0,0 +1,146 @@
+# Run with: python -m dictionary.benchmarks
+
+'''
+Micro-benchmarks for alutiiq.py, each timing the current
+implementation against the straightforward version it replaced.
+'''
+import io
+import json
+import os
+import re
+import timeit
+from collections import namedtuple
+
+from .alutiiq import (HIERARCHY, TableCell, TableRow, build_rows, external_subset,
+                      get_endings_map, is_active, normalize)
+from .combined_ortho import OrthoTransformer
+
+
+Root = namedtuple('Root', ['root', 'pos'])
+
+ROOTS = {
+    'n': 'yaamar',
+    'vi': 'silug',
+    'vt': 'nallu',
+    'loc': 'qul',
+    'dem': 'taug',
+}
+
+
+def naive_build_rows(widget, endings_map):
+    '''Table rows built by scanning the whole endings map for every cell.'''
+    for row_id, header in widget.rows:
+        cells = []
+        if widget.cols:
+            for col_id, header_ in widget.cols:
+                sub_map = {
+                    external_subset(full_id, [row_id, col_id]): inflection
+                    for full_id, inflection in endings_map.items()
+                    if is_active(row_id, col_id, full_id, widget)
+                }
+                cells.append(TableCell(':'.join([row_id, col_id]), sub_map))
+        else:
+            sub_map = {
+                external_subset(full_id, [row_id]): inflection
+                for full_id, inflection in endings_map.items()
+                if row_id in full_id.split(':')
+            }
+            cells.append(TableCell(row_id, sub_map))
+        yield TableRow(header, cells)
+
+
+def table_rows(pos, endings_map, rows_builder=build_rows):
+    return [list(rows_builder(widget, endings_map)) for widget in HIERARCHY[pos]]
+
+
+def naive_normalize(word, g_and_r=True):
+    '''normalize() as a chain of regex substitutions and replacements.'''
+    if g_and_r:
+        word = re.sub('(?<!n)g', 'r', word)
+    word = re.sub('[A-QS-Z]|^R', lambda m: m.group().lower(), word)
+    word = (word.replace('q', 'k')
+                .replace('y', 'i')
+                .replace('w', 'u')
+                .replace('e', '')
+                .replace(u"'", ''))
+    for vowel in 'aiu':
+        word = re.sub(vowel + '+', vowel, word)
+    return word
+
+
+# Stand-in for dict_sources/ortho.txt (which isn't in the repo): a few
+# dozen spelling changes of the kind it makes.
+ORTHO_TABLE = dict(
+    [(c + "'", c.upper()) for c in 'gklmnrstwy'] +
+    [(c + c, c + ':') for c in 'aiu'] +
+    [('ng', 'ŋ'), ('gh', 'ĝ'), ('ll', 'ł'), ('hm', 'm̂'), ('hn', 'n̂'), ('hng', 'ŋ̂'),
+     ('kw', 'q'), ('qw', 'ǫ'), ('wh', 'ŵ'), ('ř', 'R'), ('ee', 'e')]
+)
+
+
+def naive_multiple_replace(dict, text):
+    '''combined_ortho's old replacement, which compiled a regex for every line.'''
+    options = "|".join(map(re.escape, dict.keys()))
+    regex = re.compile(f'({options})', flags=re.UNICODE)
+    return regex.sub(lambda mo: dict[mo.string[mo.start():mo.end()]], text)
+
+
+def naive_transform(table, text):
+    return ''.join(naive_multiple_replace(table, line) + '\n' for line in text.splitlines())
+
+
+def stream_transform(transformer, text):
+    outfile = io.StringIO()
+    transformer.transform_stream(io.StringIO(text), outfile)
+    return outfile.getvalue()
+
+
+def fixture_words():
+    path = os.path.join(os.path.dirname(__file__), 'fixtures', 'words_free.json')
+    with open(path, 'r') as infile:
+        return [entry['fields']['entry'] for entry in json.load(infile)]
+
+
+def time_call(func, number):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+
+def bench_tables(number=20):
+    for pos, root in ROOTS.items():
+        endings_map = get_endings_map(root, pos)
+        assert table_rows(pos, endings_map) == table_rows(pos, endings_map, naive_build_rows)
+        before = time_call(lambda: table_rows(pos, endings_map, naive_build_rows), number)
+        after = time_call(lambda: table_rows(pos, endings_map), number)
+        print('tables {: <4} {:5d} forms: {:8.2f} ms -> {:6.2f} ms ({:.0f}x)'.format(
+            pos, len(endings_map), before * 1000, after * 1000, before / after))
+
+
+def bench_normalize(number=20):
+    words = fixture_words()
+    assert [normalize(w) for w in words] == [naive_normalize(w) for w in words]
+    before = time_call(lambda: [naive_normalize(w) for w in words], number)
+    uncached = time_call(lambda: [normalize.__wrapped__(w) for w in words], number)
+    cached = time_call(lambda: [normalize(w) for w in words], number)
+    print('normalize {} words: {:.2f} ms -> {:.2f} ms uncached, {:.2f} ms cached'.format(
+        len(words), before * 1000, uncached * 1000, cached * 1000))
+
+
+def bench_ortho(number=3):
+    lines = ['\\lx\t{}\n\\de\tsomething\n'.format(w) for w in fixture_words()]
+    text = ''.join(lines * 200)
+    # Overlapping keys are now tried longest first, so compare on a table
+    # whose old (insertion) order was already longest first.
+    table = dict(sorted(ORTHO_TABLE.items(), key=lambda item: -len(item[0])))
+    transformer = OrthoTransformer(table)
+    assert stream_transform(transformer, text) == naive_transform(table, text)
+    before = time_call(lambda: naive_transform(table, text), number)
+    after = time_call(lambda: stream_transform(transformer, text), number)
+    megabytes = len(text.encode('utf-8')) / 1e6
+    print('ortho {:.1f} MB: {:.1f} MB/s -> {:.1f} MB/s ({:.0f}x)'.format(
+        megabytes, megabytes / before, megabytes / after, before / after))
+
+
+if __name__ == '__main__':
+    bench_tables()
+    bench_normalize()
+    bench_ortho()
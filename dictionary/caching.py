@@ -0,0 +1,312 @@
+'''
+Whole-page caching for entry and search pages.
+
+Every change to the dictionary tables moves a global "lexicon version" kept
+in the 'lexicon' cache on (`lexicon_changed`, connected to the model signals
+in models.py and called by the bulk import and update paths). Pages are
+cached under the version and their full URL, so each page is rendered once
+and then served from the cache until the dictionary actually changes. When
+the cache is shared by all the server processes (CACHE_SHARED), the version
+is also the pages' ETag and, being the time of the change in microseconds,
+their Last-Modified date, so browsers can revalidate with a conditional
+request and get a 304 back.
+
+Pieces of pages that show up on many different pages, like the listing of a
+word in search results, are cached the same way by `cached_fragments`, and
+the ranked results of popular searches are kept in process memory by a
+`QueryCache`.
+
+The cache backend is chosen with CACHE_URL in settings; set PAGE_CACHE = False
+to turn page and fragment caching off.
+'''
+import collections
+import functools
+import hashlib
+import itertools
+import logging
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.db import connection, transaction
+from django.http import HttpResponse
+from django.template.defaultfilters import urlencode
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+from django.utils.safestring import mark_safe
+
+
+logger = logging.getLogger(__name__)
+
+VERSION_CACHE = 'lexicon'
+VERSION_KEY = 'lexicon-version'
+PAGE_PREFIX = 'page'
+
+# Pages link to the feedback form with the reader's user agent filled in.
+# Cached pages are rendered with this placeholder as the user agent, and it
+# is swapped for each reader's own when the page is served.
+USER_AGENT_PLACEHOLDER = 'wiinaq-user-agent-' + uuid.uuid4().hex
+
+
+def now_micros():
+    return int(time.time() * 1000000)
+
+
+def lexicon_version():
+    '''The current lexicon version.'''
+    versions = caches[VERSION_CACHE]
+    version = versions.get(VERSION_KEY)
+    if version is None:
+        # First use, or the cache was cleared: start from the current time,
+        # which is later than any version pages could be cached under.
+        version = now_micros()
+        versions.add(VERSION_KEY, version, timeout=None)
+        version = versions.get(VERSION_KEY, version)
+    return version
+
+
+def bump_version():
+    '''Move the lexicon version on. Returns the old and new versions.'''
+    from . import search
+
+    old = lexicon_version()
+    new = max(now_micros(), old + 1)
+    caches[VERSION_CACHE].set(VERSION_KEY, new, timeout=None)
+    search.version_changed(old, new)
+    return old, new
+
+
+def lexicon_changed(**kwargs):
+    '''
+    Signal handler for changes to the dictionary tables, also called after
+    bulk changes. Inside a transaction, the version is moved on again once
+    it commits, since pages rendered in the meantime (by other processes)
+    still show the old data.
+    '''
+    if kwargs.get('action', 'post_').startswith('pre_'):
+        return
+    bump_version()
+    if connection.in_atomic_block:
+        transaction.on_commit(bump_version)
+
+
+def cache_key(prefix, version, key):
+    return '{}:{}:{}'.format(prefix, version, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+
+def page_key(request, version):
+    return cache_key(PAGE_PREFIX, version, request.build_absolute_uri())
+
+
+def render_page(view, request, *args, **kwargs):
+    '''Run `view` with the user agent placeholder in place of the real one.'''
+    user_agent = request.META.get('HTTP_USER_AGENT')
+    request.META['HTTP_USER_AGENT'] = USER_AGENT_PLACEHOLDER
+    try:
+        return view(request, *args, **kwargs)
+    finally:
+        if user_agent is None:
+            del request.META['HTTP_USER_AGENT']
+        else:
+            request.META['HTTP_USER_AGENT'] = user_agent
+
+
+def fill_user_agent(content, request):
+    user_agent = urlencode(request.META.get('HTTP_USER_AGENT', ''))
+    return content.replace(USER_AGENT_PLACEHOLDER.encode('ascii'), user_agent.encode('utf-8'))
+
+
+def get_page(view, request, version, *args, **kwargs):
+    '''The response of `view`, from the cache if it has been rendered at this version.'''
+    key = page_key(request, version)
+    page = cache.get(key)
+    if page is None:
+        response = render_page(view, request, *args, **kwargs)
+        if response.streaming:
+            return response
+        if response.status_code == 200:
+            cache.set(key, (response.content, response['Content-Type']),
+                      getattr(settings, 'PAGE_CACHE_TIMEOUT', 300))
+        response.content = fill_user_agent(response.content, request)
+        return response
+
+    content, content_type = page
+    return HttpResponse(fill_user_agent(content, request), content_type=content_type)
+
+
+def cached_page(view):
+    '''
+    Decorator for views whose pages depend only on their URL and the
+    contents of the dictionary (and the user agent, see
+    USER_AGENT_PLACEHOLDER). Conditional requests are only answered when
+    the version is shared by all processes; otherwise a process that never
+    hears of an edit would keep telling browsers their copy is current.
+    '''
+    @functools.wraps(view)
+    def cached_view(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD') or not getattr(settings, 'PAGE_CACHE', True):
+            return view(request, *args, **kwargs)
+
+        version = lexicon_version()
+        conditional = getattr(settings, 'CACHE_SHARED', False)
+        etag = '"{}"'.format(version)
+        last_modified = version // 1000000
+        response = None
+        if conditional:
+            response = get_conditional_response(request, etag=etag,
+                                                last_modified=last_modified)
+        if response is None:
+            response = get_page(view, request, version, *args, **kwargs)
+        if response.status_code in (200, 304):
+            if conditional:
+                response['ETag'] = etag
+                response['Last-Modified'] = http_date(last_modified)
+            # Browsers may keep pages but should check they're current.
+            patch_cache_control(response, no_cache=True)
+            patch_vary_headers(response, ['User-Agent'])
+        return response
+
+    return cached_view
+
+
+def cached_fragments(prefix, keys, render):
+    '''
+    The HTML fragment for each of `keys` (a list of tuples of strings and
+    numbers), from the cache where it has been rendered at the current
+    lexicon version. `render` is called once with the list of keys that
+    missed and returns their fragments in the same order.
+    '''
+    if not getattr(settings, 'PAGE_CACHE', True):
+        return [mark_safe(fragment) for fragment in render(keys)]
+
+    version = lexicon_version()
+    names = [cache_key(prefix, version, repr(key)) for key in keys]
+    fragments = cache.get_many(names)
+    missing = [i for i, name in enumerate(names) if name not in fragments]
+    if missing:
+        rendered = {names[i]: fragment
+                    for i, fragment in zip(missing, render([keys[i] for i in missing]))}
+        cache.set_many(rendered, getattr(settings, 'PAGE_CACHE_TIMEOUT', 300))
+        fragments.update(rendered)
+    return [mark_safe(fragments[name]) for name in names]
+
+
+class QueryCache(object):
+    '''
+    Results of popular searches, by query, in process memory.
+
+    Entries are kept in order of last use, along with how many times each
+    has been used. When the cache is full, the least used of the `window`
+    least recently used entries is evicted, so a run of one-off queries
+    can't push out the popular ones; use counts are halved every
+    `maxsize * 8` lookups so that queries that stop being popular age out.
+    Everything is dropped when the lexicon version changes, and each result
+    after `timeout` seconds, since a per-process version doesn't change for
+    edits made through other processes. With `shared` (a Django cache),
+    results are also written to it and looked up there before being
+    computed, so processes share them.
+
+        >>> results = QueryCache(maxsize=2, window=2, version=lambda: 1)
+        >>> results.get_or_compute('a', str.upper), results.get_or_compute('a', str.upper)
+        ('A', 'A')
+        >>> results.get_or_compute('b', str.upper), results.get_or_compute('c', str.upper)
+        ('B', 'C')
+        >>> list(results.entries)  # 'b' was used once, 'a' twice
+        ['a', 'c']
+        >>> results.stats()
+        {'hits': 1, 'shared_hits': 0, 'misses': 3, 'evictions': 1, 'size': 2, 'hit_rate': 0.25}
+    '''
+    PREFIX = 'query'
+
+    def __init__(self, maxsize=1000, window=16, shared=None, timeout=300,
+                 version=lexicon_version, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.window = window
+        self.shared = shared
+        self.timeout = timeout
+        self.version = version
+        self.clock = clock
+        self.lock = threading.Lock()
+        # query -> [result, uses, expiry time]
+        self.entries = collections.OrderedDict()
+        self.entries_version = None
+        self.lookups = 0
+        self.hits = self.shared_hits = self.misses = self.evictions = 0
+
+    def get_or_compute(self, query, compute):
+        '''The result for `query`, calling compute(query) if it isn't cached.'''
+        version = self.version()
+        now = self.clock()
+        with self.lock:
+            self.check_version(version)
+            self.age()
+            entry = self.entries.get(query)
+            if entry is not None and entry[2] <= now:
+                del self.entries[query]
+                entry = None
+            if entry is not None:
+                entry[1] += 1
+                self.entries.move_to_end(query)
+                self.hits += 1
+                return entry[0]
+
+        result = None
+        if self.shared is not None:
+            key = cache_key(self.PREFIX, version, query)
+            result = self.shared.get(key)
+        if result is None:
+            result = compute(query)
+            if self.shared is not None:
+                self.shared.set(key, result, self.timeout)
+            shared_hit = False
+        else:
+            shared_hit = True
+
+        with self.lock:
+            if shared_hit:
+                self.shared_hits += 1
+            else:
+                self.misses += 1
+            # Results computed from an older version aren't kept.
+            if version == self.entries_version and query not in self.entries:
+                while len(self.entries) >= self.maxsize:
+                    self.evict()
+                self.entries[query] = [result, 1, now + self.timeout]
+        return result
+
+    def check_version(self, version):
+        if version != self.entries_version:
+            if self.entries:
+                logger.info('Lexicon changed, clearing the query cache: %s', self.stats())
+            self.entries.clear()
+            self.entries_version = version
+
+    def age(self):
+        self.lookups += 1
+        if self.lookups >= self.maxsize * 8:
+            self.lookups = 0
+            for entry in self.entries.values():
+                entry[1] //= 2
+
+    def evict(self):
+        oldest = itertools.islice(self.entries.items(), self.window)
+        query, entry = min(oldest, key=lambda item: item[1][1])
+        del self.entries[query]
+        self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.shared_hits + self.misses
+        return {
+            'hits': self.hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self.entries),
+            'hit_rate': (self.hits + self.shared_hits) / lookups if lookups else 0.0,
+        }
@@ -1,26 +1,79 @@
 # -*- coding: utf-8 -*-
 """
-Run as: python combined_ortho.py < dict.mdf > dict_ortho.mdf
+Run as: python -m dictionary.combined_ortho < dict.mdf > dict_ortho.mdf
 """
+import functools
 import re
+import sys
 
 TABLE = None
 TABLE_FILENAME = 'dict_sources/ortho.txt'
+TRANSFORMER = None
+
+# Roughly how many characters of input to convert at a time.
+CHUNK_SIZE = 1 << 20
+
+
+class OrthoTransformer(object):
+    '''
+    Replaces every occurrence of a key of `table` in a text with its value,
+    in one pass with a single regex compiled up front. Keys are tried
+    longest first, so where keys overlap the longest match wins.
+
+    >>> fix = OrthoTransformer({'g': 'r', 'ng': 'ŋ', "'": ''})
+    >>> fix("angayug'ka")
+    'aŋayurka'
+    '''
+    def __init__(self, table):
+        self.table = dict(table)
+        keys = sorted(self.table, key=lambda key: (-len(key), key))
+        self.regex = re.compile('|'.join(map(re.escape, keys))) if keys else None
+
+    def __call__(self, text):
+        if self.regex is None:
+            return text
+        return self.regex.sub(self.replace, text)
+
+    def replace(self, match):
+        return self.table[match.group()]
+
+    def transform_stream(self, infile, outfile, chunk_size=CHUNK_SIZE):
+        '''
+        Convert `infile` to `outfile`, about `chunk_size` characters of whole
+        lines at a time (no key spans a line break).
+        '''
+        while True:
+            lines = infile.readlines(chunk_size)
+            if not lines:
+                break
+            outfile.write(self(''.join(lines)))
 
 
 def substitute(s):
-    table = load_table()
-    return multiple_replace(table, s)
+    return get_transformer()(s)
 
 
 def multiple_replace(dict, text):
-    # https://stackoverflow.com/a/15175239/4481448
-    # Create a regular expression  from the dictionary keys
-    options = "|".join(map(re.escape, dict.keys()))
-    regex = re.compile(f'({options})', flags=re.UNICODE)
+    '''
+    Replace the keys of `dict` in `text` with their values. The transformer
+    for each table is compiled once and reused.
+
+    >>> multiple_replace({'ng': 'ŋ'}, 'angayuk')
+    'aŋayuk'
+    '''
+    return cached_transformer(frozenset(dict.items()))(text)
+
 
-    # For each match, look-up corresponding value in dictionary
-    return regex.sub(lambda mo: dict[mo.string[mo.start():mo.end()]], text)
+@functools.lru_cache(maxsize=16)
+def cached_transformer(items):
+    return OrthoTransformer(items)
+
+
+def get_transformer():
+    global TRANSFORMER
+    if TRANSFORMER is None:
+        TRANSFORMER = OrthoTransformer(load_table())
+    return TRANSFORMER
 
 
 def load_table():
@@ -45,14 +98,11 @@ def load_table():
     return TABLE
 
 
-def transform_ortho():
-    while True:
-        try:
-            line = input()
-        except (EOFError, IOError, KeyboardInterrupt):
-            break
-
-        print(substitute(line))
+def transform_ortho(infile=None, outfile=None):
+    try:
+        get_transformer().transform_stream(infile or sys.stdin, outfile or sys.stdout)
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == '__main__':
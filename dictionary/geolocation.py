@@ -0,0 +1,221 @@
+'''
+IP geolocation for the weekly summary.
+
+    >>> get_location_map(['10.0.0.1', '10.0.0.2', '10.0.0.3'],
+    ...                  backend=StubBackend({'10.0.0.2': 'Kodiak, Alaska, United States'}),
+    ...                  cache=GeoCache(None))
+    {'unknown': ['10.0.0.1', '10.0.0.3'], 'Kodiak, Alaska, United States': ['10.0.0.2']}
+
+Lookups are remembered in a JSON file (GEOLOCATION_CACHE, by default in
+~/.cache/wiinaq) for GEOLOCATION_CACHE_TTL seconds, so each week only the
+new addresses are looked up. Those are sent to ip-api.com's batch endpoint,
+100 at a time, from a few threads that share one rate limiter.
+'''
+import json
+import os
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+
+CACHE_FILE = os.environ.get('GEOLOCATION_CACHE',
+                            os.path.join(os.path.expanduser('~'), '.cache', 'wiinaq',
+                                         'geolocation.json'))
+CACHE_TTL = float(os.environ.get('GEOLOCATION_CACHE_TTL', 30 * 24 * 60 * 60))
+
+UNKNOWN = u'unknown'
+
+
+def format_location(data):
+    '''
+    >>> format_location({'district': '', 'city': 'Kodiak', 'regionName': 'Alaska',
+    ...                  'country': 'United States', 'proxy': True})
+    'Kodiak, Alaska, United States [proxy]'
+    '''
+    parts = [
+        part
+        for key in ('district', 'city', 'regionName', 'country')
+        for part in (data.get(key),)
+        if part
+    ]
+    location = u', '.join(parts)
+    if data.get('proxy'):
+        location += u' [proxy]'
+    return location
+
+
+class GeoCache(object):
+    '''
+    Locations looked up before, kept in a JSON file mapping each IP to
+    [location, time looked up]. Entries older than `ttl` seconds are ignored.
+    With `path` None, nothing is read or written.
+    '''
+    def __init__(self, path=CACHE_FILE, ttl=CACHE_TTL, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r') as infile:
+                    self.entries = json.load(infile)
+            except ValueError as e:
+                print('Ignoring unreadable geolocation cache {}: {}'.format(path, e),
+                      file=sys.stderr)
+
+    def get(self, ip):
+        entry = self.entries.get(ip)
+        if entry is not None and self.clock() - entry[1] < self.ttl:
+            return entry[0]
+        return None
+
+    def set(self, ip, location):
+        self.entries[ip] = [location, self.clock()]
+
+    def save(self):
+        if not self.path:
+            return
+        now = self.clock()
+        entries = {ip: entry for ip, entry in self.entries.items() if now - entry[1] < self.ttl}
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Write a new file and move it into place, so an interrupted run
+        # can't leave a truncated cache behind.
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as outfile:
+            json.dump(entries, outfile)
+        os.replace(tmp_path, self.path)
+
+
+class RateLimiter(object):
+    '''
+    Spaces out requests made from any number of threads to at most
+    `per_minute` a minute, and when the server says no requests are left,
+    holds everyone until the limit resets.
+    '''
+    def __init__(self, per_minute, clock=time.monotonic, sleep=time.sleep):
+        self.interval = 60.0 / per_minute
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        # Take the next free slot, then sleep until it comes without holding
+        # the lock, so the other threads can take the slots after it.
+        with self.lock:
+            now = self.clock()
+            start = max(self.next_time, now)
+            self.next_time = start + self.interval
+        if start > now:
+            self.sleep(start - now)
+
+    def update(self, remaining, reset_secs):
+        '''Take into account the server's count of requests left until a reset.'''
+        if remaining is not None and remaining <= 0:
+            with self.lock:
+                self.next_time = max(self.next_time, self.clock() + reset_secs)
+
+
+class IpApiBackend(object):
+    '''Looks up IPs with the ip-api.com batch endpoint.'''
+    URL = 'http://ip-api.com/batch'
+    FIELDS = 'status,message,query,country,regionName,city,district,proxy'
+    BATCH_SIZE = 100
+    # The free batch endpoint allows 15 requests a minute.
+    PER_MINUTE = 15
+
+    def __init__(self, session=None, rate_limiter=None, max_workers=4, retries=3,
+                 timeout=10):
+        self.session = session or requests.Session()
+        self.rate_limiter = rate_limiter or RateLimiter(self.PER_MINUTE)
+        self.max_workers = max_workers
+        self.retries = retries
+        self.timeout = timeout
+
+    def lookup(self, ips):
+        '''Return a dict mapping each IP to its location (None if the lookup failed).'''
+        batches = [ips[i:i + self.BATCH_SIZE] for i in range(0, len(ips), self.BATCH_SIZE)]
+        if not batches:
+            return {}
+        result = {}
+        with ThreadPool(min(self.max_workers, len(batches))) as pool:
+            for locations in pool.imap_unordered(self.lookup_batch, batches):
+                result.update(locations)
+        return result
+
+    def lookup_batch(self, ips):
+        for attempt in range(self.retries):
+            self.rate_limiter.wait()
+            try:
+                response = self.session.post(self.URL, params={'fields': self.FIELDS},
+                                             json=ips, timeout=self.timeout)
+                self.rate_limiter.update(int(response.headers.get('X-Rl') or 1),
+                                         float(response.headers.get('X-Ttl') or 60))
+                response.raise_for_status()
+                results = response.json()
+            except Exception as e:
+                print('Error looking up {} IPs: {}'.format(len(ips), e), file=sys.stderr)
+                continue
+
+            locations = {ip: None for ip in ips}
+            for data in results:
+                if data.get('status') == 'success':
+                    locations[data['query']] = format_location(data)
+                else:
+                    print('Error looking up {}: {}'.format(data.get('query'),
+                                                           data.get('message')),
+                          file=sys.stderr)
+            return locations
+        return {ip: None for ip in ips}
+
+
+class StubBackend(object):
+    '''A backend for tests: fixed locations, and a record of what was looked up.'''
+    def __init__(self, locations=None):
+        self.locations = locations or {}
+        self.calls = []
+
+    def lookup(self, ips):
+        self.calls.append(list(ips))
+        return {ip: self.locations.get(ip, UNKNOWN) for ip in ips}
+
+
+def locate(ips, backend=None, cache=None):
+    '''
+    Return a dict mapping each of `ips` to a location, looking up the ones
+    that aren't in `cache` with `backend` and remembering the results.
+    '''
+    if cache is None:
+        cache = GeoCache()
+    locations = {}
+    missing = []
+    for ip in dict.fromkeys(ips):
+        location = cache.get(ip)
+        if location is None:
+            missing.append(ip)
+        else:
+            locations[ip] = location
+
+    if missing:
+        if backend is None:
+            backend = IpApiBackend()
+        for ip, location in backend.lookup(missing).items():
+            if location is not None:
+                cache.set(ip, location)
+            locations[ip] = location or UNKNOWN
+        cache.save()
+    return locations
+
+
+def get_location_map(ips, backend=None, cache=None):
+    '''Return a dict mapping locations to the list of `ips` at each one.'''
+    locations = locate(ips, backend=backend, cache=cache)
+    location_map = {}
+    for ip in ips:
+        location_map.setdefault(locations[ip], []).append(ip)
+    return location_map
@@ -1,14 +1,23 @@
-# Run with: python -m dictionary.init_fixture
-
-import sys
+# Run with: python -m dictionary.init_fixture [--jobs N] [--load] [words_file [sources_fixture [output_fixture]]]
+'''
+Convert a tab-separated words file (word, notes, definition, source, alternate
+forms) into a fixture of entries, computing the search fields and guessed
+part of speech and root for each one. Lines are converted and written one
+chunk at a time, spread over N worker processes with --jobs.
+
+With --load, the entries are inserted straight into the database instead of
+written to a fixture, using the sources already in the database.
+'''
 import json
-
+import multiprocessing
 import os
-os.environ.setdefault("DJANGO_SETTINGS_MODULE", "project.settings")
-import django
-django.setup()
+import sys
 
-from .models import Entry
+from .alutiiq import derive_fields
+from .save_all import iter_chunks
+
+
+CHUNK_SIZE = 1000
 
 words_file = 'dictionary/fixtures/words.csv'
 sources_fixture = 'dictionary/fixtures/sources.json'
@@ -16,72 +25,150 @@ sources_fixture = 'dictionary/fixtures/sources.json'
 # and words_file should already exist.
 output_fixture = 'dictionary/fixtures/words.json'
 
-pk_null = False
-
-if len(sys.argv) >= 5:
-    print('Usage: init_fixture.py [words_file [sources_fixture [output_fixture]]]')
-    print('Default values:')
-    print(f'    words_file = {words_file}')
-    print(f'    output_fixture = {output_fixture}')
-    sys.exit(2)
-
-if len(sys.argv) >= 4:
-    output_fixture = sys.argv[3]
-    pk_null = True
 
-if len(sys.argv) >= 3:
-    sources_fixture = sys.argv[2]
+def read_sources(path):
+    with open(path, 'r') as infile:
+        return {source['fields']['abbrev']: source['pk'] for source in json.load(infile)}
 
-if len(sys.argv) >= 2:
-    words_file = sys.argv[1]
 
-
-SOURCES = {}
-with open(sources_fixture, 'r') as infile:
-    sources_json = json.load(infile)
-    for source in sources_json:
-        SOURCES[source['fields']['abbrev']] = source['pk']
-
-
-def parse_source(source):
+def parse_source(source, sources):
     tokens = source.split()
-    if tokens and tokens[0] in SOURCES:
-        return SOURCES[tokens[0]], ' '.join(tokens[1:])
+    if tokens and tokens[0] in sources:
+        return sources[tokens[0]], ' '.join(tokens[1:])
     else:
         return None, ' '.join(tokens)
 
 
-fixture = []
-with open(words_file, 'r') as infile:
-    for line in infile:
-        line = line[:-1]
-        tabs = line.count('\t')
-        if tabs > 4:
+def convert_line(line, sources):
+    '''
+    The fixture fields for one line of the words file, or None if the line
+    is malformed.
+
+    >>> convert_line('taqukaq\\t\\tbear\\tFP (130708 0:20)\\n', {'FP': 3})['source_info']
+    '(130708 0:20)'
+    '''
+    line = line.rstrip('\n')
+    tabs = line.count('\t')
+    if tabs > 4:
+        return None
+    elif tabs < 4:
+        line += '\t' * (4 - tabs)
+    entry, notes, defn, source, alts = line.split('\t')
+    source_pk, source_info = parse_source(source, sources)
+    fields = {'entry': entry}
+    fields.update(derive_fields(entry, defn)._asdict())
+    fields.update({
+        'defn': defn,
+        'source': source_pk,
+        'source_info': source_info,
+    })
+    return fields
+
+
+def convert_chunk(task):
+    '''Convert a chunk of lines; returns the fields and the malformed lines.'''
+    lines, sources = task
+    rows = []
+    malformed = []
+    for line in lines:
+        fields = convert_line(line, sources)
+        if fields is None:
+            malformed.append(line)
+        else:
+            rows.append(fields)
+    return rows, malformed
+
+
+def convert(lines, sources, processes=1):
+    '''Generate the fixture fields for each well-formed line, in order.'''
+    tasks = ((chunk, sources) for chunk in iter_chunks(lines, CHUNK_SIZE))
+    if processes > 1:
+        with multiprocessing.Pool(processes) as pool:
+            yield from report(pool.imap(convert_chunk, tasks))
+    else:
+        yield from report(map(convert_chunk, tasks))
+
+
+def report(results):
+    for rows, malformed in results:
+        for line in malformed:
             print('Malformed line:')
-            print(repr(line))
-            continue
-        elif tabs < 4:
-            line += '\t' * (4 - tabs)
-        entry, notes, defn, source, alts = line.split('\t')
-        source_pk, source_info = parse_source(source)
-        c = Entry(entry=entry, defn=defn)
-        c.fill()
-        fixture.append({
-            'model': 'dictionary.Entry',
-            'pk': (None if pk_null else (len(fixture) + 1)),
-            'fields': {
-                'entry': c.entry,
-                'pos_auto': c.pos_auto,
-                'pos_final': c.pos_final,
-                'root_auto': c.root_auto,
-                'root_final': c.root_final,
-                'defn': c.defn,
-                'source': source_pk,
-                'source_info': source_info,
-                'search_text': c.search_text,
-            },
-        })
-
-
-with open(output_fixture, 'w') as outfile:
-    json.dump(fixture, outfile, indent=4, separators=(',', ': '))
+            print(repr(line.rstrip('\n')))
+        yield from rows
+
+
+def write_fixture(rows, outfile, pk_null=False):
+    '''Write fixture objects one per line, without holding them all in memory.'''
+    outfile.write('[')
+    for pk, fields in enumerate(rows, 1):
+        obj = {'model': 'dictionary.Entry', 'pk': None if pk_null else pk, 'fields': fields}
+        outfile.write('\n' if pk == 1 else ',\n')
+        outfile.write(json.dumps(obj, ensure_ascii=False, separators=(',', ':')))
+    outfile.write('\n]\n')
+
+
+def load_rows(rows, batch_size=CHUNK_SIZE):
+    '''Insert entries with the given fields into the database with bulk inserts.'''
+    from django.db import transaction
+    from . import caching, search
+    from .models import Entry
+
+    count = 0
+    with transaction.atomic():
+        for chunk in iter_chunks(rows, batch_size):
+            Entry.objects.bulk_create([Entry(source_id=fields.pop('source'), **fields)
+                                       for fields in chunk])
+            count += len(chunk)
+    search.invalidate_index()
+    caching.lexicon_changed()
+    return count
+
+
+if __name__ == '__main__':
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "project.settings")
+    import django
+    django.setup()
+
+    args = sys.argv[1:]
+    load = '--load' in args
+    processes = 1
+    if '--load' in args:
+        args.remove('--load')
+    if '--jobs' in args:
+        i = args.index('--jobs')
+        processes = int(args[i + 1])
+        del args[i:i + 2]
+
+    pk_null = False
+
+    if len(args) >= 4 or any(arg.startswith('--') for arg in args):
+        print('Usage: init_fixture.py [--jobs N] [--load] '
+              '[words_file [sources_fixture [output_fixture]]]')
+        print('Default values:')
+        print(f'    words_file = {words_file}')
+        print(f'    output_fixture = {output_fixture}')
+        sys.exit(2)
+
+    if len(args) >= 3:
+        output_fixture = args[2]
+        pk_null = True
+
+    if len(args) >= 2:
+        sources_fixture = args[1]
+
+    if len(args) >= 1:
+        words_file = args[0]
+
+    if load:
+        from .models import Source
+        sources = dict(Source.objects.values_list('abbrev', 'id'))
+    else:
+        sources = read_sources(sources_fixture)
+
+    with open(words_file, 'r') as infile:
+        rows = convert(infile, sources, processes)
+        if load:
+            print('{} entries loaded'.format(load_rows(rows)))
+        else:
+            with open(output_fixture, 'w') as outfile:
+                write_fixture(rows, outfile, pk_null)
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from dictionary.backups import dump_lexicon
+
+
+class Command(BaseCommand):
+    help = 'Back up the dictionary tables to a gzipped JSON Lines file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Backup file to write, e.g. backup.jsonl.gz')
+
+    def handle(self, *args, **options):
+        counts = dump_lexicon(options['path'])
+        for label, count in counts.items():
+            self.stdout.write('{:7d} {}'.format(count, label))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from dictionary.backups import load_lexicon
+
+
+class Command(BaseCommand):
+    help = 'Restore the dictionary tables from a backup written by dumplexicon.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Backup file to read')
+        parser.add_argument('--replace', action='store_true',
+                            help='Delete the current contents of the dictionary tables first')
+
+    def handle(self, *args, **options):
+        try:
+            counts = load_lexicon(options['path'], replace=options['replace'])
+        except ValueError as e:
+            raise CommandError(e)
+        for label, count in counts.items():
+            self.stdout.write('{:7d} {}'.format(count, label))
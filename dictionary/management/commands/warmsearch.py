@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from dictionary.analytics import top_queries
+from dictionary.views import QUERY_CACHE, search_listings
+from dictionary.weekly_summary import archive_paths, summarize_archives
+
+
+class Command(BaseCommand):
+    help = ('Put the results of the most popular searches in the cache ahead of time, '
+            'taking the searches from the request analytics or from log archives.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('logs', nargs='*',
+                            help='Log archives (or directories of them) to take the searches '
+                                 'from instead of the analytics tables')
+        parser.add_argument('--top', type=int, default=200,
+                            help='Number of searches to run (default 200)')
+        parser.add_argument('--days', type=int, default=7,
+                            help='Days of analytics to count searches over (default 7)')
+
+    def handle(self, *args, **options):
+        if options['logs']:
+            summary = summarize_archives(archive_paths(options['logs']))
+            queries = [query for query, count in summary['searches'].most_common(options['top'])]
+        else:
+            queries = [query for query, count in top_queries('search', days=options['days'],
+                                                             limit=options['top'])]
+        if not getattr(settings, 'QUERY_CACHE_SHARED', False):
+            self.stderr.write('The cache is not shared between processes (see CACHE_URL), so '
+                              'this only warms the cache of this process.')
+
+        for query in queries:
+            search_listings(query)
+        stats = QUERY_CACHE.stats()
+        self.stdout.write('{} searches: {} already cached, {} run'.format(
+            len(queries), stats['hits'] + stats['shared_hits'], stats['misses']))
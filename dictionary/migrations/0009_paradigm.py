@@ -0,0 +1,24 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dictionary', '0008_auto_20200712_1612'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Paradigm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('root', models.CharField(max_length=100)),
+                ('pos', models.CharField(max_length=10)),
+                ('rules_hash', models.CharField(help_text='Hash of the ending tables the forms were built from', max_length=40)),
+                ('forms', models.TextField(help_text='JSON object mapping full tag ids to forms')),
+            ],
+            options={
+                'unique_together': {('root', 'pos')},
+            },
+        ),
+    ]
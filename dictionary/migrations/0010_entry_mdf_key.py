@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dictionary', '0009_paradigm'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entry',
+            name='mdf_key',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, help_text='Identifies the record this entry was imported from in the combined dictionary file.', max_length=50),
+        ),
+        migrations.AddField(
+            model_name='entry',
+            name='mdf_hash',
+            field=models.CharField(blank=True, default='', editable=False, help_text='Hash of the imported record, used to detect changes when the file is imported again.', max_length=40),
+        ),
+    ]
@@ -0,0 +1,17 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dictionary', '0010_entry_mdf_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entry',
+            name='modified',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, editable=False),
+        ),
+    ]
@@ -0,0 +1,29 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dictionary', '0011_entry_modified'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RequestRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('kind', models.CharField(max_length=10)),
+                ('key', models.CharField(blank=True, max_length=200)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('total_ms', models.PositiveBigIntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('date', 'kind', 'key')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='requestrollup',
+            index=models.Index(fields=['kind', 'date'], name='dictionary__kind_973634_idx'),
+        ),
+    ]
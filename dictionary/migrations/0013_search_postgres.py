@@ -0,0 +1,44 @@
+from django.db import migrations
+
+
+# Only on Postgres: trigram indexes that regex queries on search_word and
+# search_text can use, and a full-text column for whole-word English searches
+# (see search.PostgresBackend). Other databases keep scanning the table.
+FORWARDS = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX dictionary_entry_search_word_trgm '
+    'ON dictionary_entry USING gin (search_word gin_trgm_ops)',
+    'CREATE INDEX dictionary_entry_search_text_trgm '
+    'ON dictionary_entry USING gin (search_text gin_trgm_ops)',
+    "ALTER TABLE dictionary_entry ADD COLUMN search_vector tsvector "
+    "GENERATED ALWAYS AS (to_tsvector('simple', "
+    "regexp_replace(search_text, '[^[:alnum:]_]+', ' ', 'g'))) STORED",
+    'CREATE INDEX dictionary_entry_search_vector '
+    'ON dictionary_entry USING gin (search_vector)',
+]
+
+BACKWARDS = [
+    'DROP INDEX IF EXISTS dictionary_entry_search_vector',
+    'ALTER TABLE dictionary_entry DROP COLUMN IF EXISTS search_vector',
+    'DROP INDEX IF EXISTS dictionary_entry_search_text_trgm',
+    'DROP INDEX IF EXISTS dictionary_entry_search_word_trgm',
+]
+
+
+def run_on_postgres(statements):
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor == 'postgresql':
+            for sql in statements:
+                schema_editor.execute(sql)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dictionary', '0012_requestrollup'),
+    ]
+
+    operations = [
+        migrations.RunPython(run_on_postgres(FORWARDS), run_on_postgres(BACKWARDS)),
+    ]
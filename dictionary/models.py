@@ -1,7 +1,11 @@
 from django.db import models
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
 from django.template.defaultfilters import truncatechars
+from django.utils import timezone
 
-from .alutiiq import normalize, get_pos, get_root
+from . import caching, paradigms, search
+from .alutiiq import derive_fields
 
 
 class Source(models.Model):
@@ -143,6 +147,14 @@ class Entry(models.Model):
                                  help_text='Check this to hide the entry from public viewing '
                                            '(e.g. if it contains things that are sacred, '
                                            'offensive, etc.)')
+    mdf_key = models.CharField(max_length=50, default='', blank=True, editable=False,
+                               db_index=True,
+                               help_text='Identifies the record this entry was imported from '
+                                         'in the combined dictionary file.')
+    mdf_hash = models.CharField(max_length=40, default='', blank=True, editable=False,
+                                help_text='Hash of the imported record, used to detect changes '
+                                          'when the file is imported again.')
+    modified = models.DateTimeField(default=timezone.now, editable=False, db_index=True)
 
     class Meta:
         verbose_name_plural = "entries"
@@ -154,21 +166,38 @@ class Entry(models.Model):
         return self.root or self.root_auto
 
     def fill(self):
-        self.search_word = normalize(self.entry)
-        self.search_text = self.defn.lower()
-        self.pos_auto = get_pos(self.entry, self.defn)
-        self.pos_final = self.pos or self.pos_auto
-        self.root_auto = get_root(self.entry, self.pos_final, self.defn)
-        self.root_final = self.root or self.root_auto
+        derived = derive_fields(self.entry, self.defn, self.pos, self.root)
+        for field, value in derived._asdict().items():
+            setattr(self, field, value)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        entry = super(Entry, cls).from_db(db, field_names, values)
+        # The paradigm the entry was loaded with, so save() can tell whether
+        # it changed without reading the row again.
+        entry.loaded_paradigm = (entry.__dict__.get('root_final'),
+                                 entry.__dict__.get('pos_final'))
+        return entry
 
     def save(self):
+        old_paradigm = getattr(self, 'loaded_paradigm', (None, None))
         self.fill()
+        self.modified = timezone.now()
         super(Entry, self).save()
+        search.index_entry(self)
+        self.loaded_paradigm = (self.root_final, self.pos_final)
+        if None not in old_paradigm and old_paradigm != self.loaded_paradigm:
+            paradigms.discard_unused(*old_paradigm)
 
     def __str__(self):
         return self.entry
 
 
+@receiver(post_delete, sender=Entry)
+def unindex_deleted_entry(sender, instance, **kwargs):
+    search.unindex_entry(instance.pk)
+
+
 class EntryVarietyInfo(models.Model):
     entry = models.ForeignKey(Entry, models.CASCADE)
     variety = models.ForeignKey(Variety, models.CASCADE)
@@ -214,3 +243,53 @@ class SeeAlso(models.Model):
 
     def __str__(self):
         return u'{}: see also "{}"'.format(self.source, self.target)
+
+
+class Paradigm(models.Model):
+    '''
+    Generated forms for one (root, part of speech), so that entry pages don't
+    have to rebuild them. Maintained by dictionary/paradigms.py.
+    '''
+    root = models.CharField(max_length=100)
+    pos = models.CharField(max_length=10)
+    rules_hash = models.CharField(max_length=40,
+                                  help_text='Hash of the ending tables the forms were built from')
+    forms = models.TextField(help_text='JSON object mapping full tag ids to forms')
+
+    class Meta:
+        unique_together = [('root', 'pos')]
+
+    def __str__(self):
+        return u'{} ({})'.format(self.root, self.pos)
+
+
+class RequestRollup(models.Model):
+    '''
+    Number of requests of one kind (searches for a query, views of a word,
+    etc.) on one day, and their total response time. Maintained by
+    dictionary/analytics.py.
+    '''
+    date = models.DateField()
+    kind = models.CharField(max_length=10)
+    key = models.CharField(max_length=200, blank=True)
+    count = models.PositiveIntegerField(default=0)
+    total_ms = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        unique_together = [('date', 'kind', 'key')]
+        indexes = [models.Index(fields=['kind', 'date'])]
+
+    def __str__(self):
+        return u'{} {} {}: {}'.format(self.date, self.kind, self.key, self.count)
+
+
+# Any change to the dictionary tables moves the lexicon version on, which
+# invalidates cached pages (see caching.py).
+for model in (Source, Variety, Example, Entry):
+    post_save.connect(caching.lexicon_changed, sender=model)
+    post_delete.connect(caching.lexicon_changed, sender=model)
+for through in (EntryVarietyInfo, ExampleVarietyInfo, EntryExampleInfo, SeeAlso):
+    post_save.connect(caching.lexicon_changed, sender=through)
+    post_delete.connect(caching.lexicon_changed, sender=through)
+    # Entry.examples.add() and the like.
+    m2m_changed.connect(caching.lexicon_changed, sender=through)
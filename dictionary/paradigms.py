@@ -0,0 +1,217 @@
+'''
+Persistent store of generated paradigms (the forms shown in ending tables).
+
+Forms are stored per (root, part of speech) in the `Paradigm` model along with
+a hash of `ENDINGS` and `HIERARCHY`; rows built from older ending tables are
+regenerated the next time they are read. Entry pages read paradigms from here
+instead of recomputing them.
+
+Fill or refresh the store for every entry with:
+
+    python -m dictionary.paradigms
+
+or write every form of every entry to a tab-separated file with:
+
+    python -m dictionary.paradigms forms.tsv
+'''
+import hashlib
+import json
+import multiprocessing
+import os
+
+from django.db import IntegrityError, transaction
+
+from .alutiiq import CELL_PLANS, ENDINGS, HIERARCHY, get_endings_map, morpho_join
+
+
+RULES_HASH = hashlib.sha1(
+    json.dumps([ENDINGS, HIERARCHY], sort_keys=True).encode('utf-8')
+).hexdigest()
+
+BATCH_SIZE = 500
+CHUNK_SIZE = 50
+
+
+def get_paradigms(keys):
+    '''
+    Return a dict mapping each (root, pos) in `keys` to its endings map,
+    generating and storing any that are missing or out of date.
+    '''
+    from .models import Paradigm
+
+    keys = set(keys)
+    roots = {root for root, pos in keys}
+    stored = {
+        (p.root, p.pos): p
+        for p in Paradigm.objects.filter(root__in=roots, pos__in=ENDINGS.keys())
+        if (p.root, p.pos) in keys
+    }
+
+    result = {}
+    for root, pos in keys:
+        paradigm = stored.get((root, pos))
+        if paradigm is not None and paradigm.rules_hash == RULES_HASH:
+            result[root, pos] = json.loads(paradigm.forms)
+        else:
+            result[root, pos] = get_endings_map(root, pos)
+            store(paradigm or Paradigm(root=root, pos=pos), result[root, pos])
+    return result
+
+
+def store(paradigm, endings_map):
+    paradigm.rules_hash = RULES_HASH
+    paradigm.forms = json.dumps(endings_map, ensure_ascii=False)
+    try:
+        with transaction.atomic():
+            paradigm.save()
+    except IntegrityError:
+        # Another request stored the same paradigm first.
+        pass
+
+
+def generate_rows(task):
+    pos, roots = task
+    return [(root, pos, tag, morpho_join([root, ending]))
+            for root in roots for tag, ending in CELL_PLANS[pos]]
+
+
+def generate_paradigms(pairs, callback=None, outfile=None, processes=None):
+    '''
+    Generate every form for each distinct (root, pos) in `pairs`, passing
+    (root, pos, tag, form) rows to `callback` and/or writing them to `outfile`
+    as tab-separated lines as they are produced. Pairs whose part of speech
+    has no endings are skipped. Roots are split into chunks by part of speech
+    and spread over `processes` worker processes (default one per CPU; 1 does
+    everything in this process). Returns the number of rows generated.
+    '''
+    by_pos = {}
+    for root, pos in dict.fromkeys(pairs):
+        if pos in ENDINGS:
+            by_pos.setdefault(pos, []).append(root)
+    tasks = [(pos, roots[i:i + CHUNK_SIZE])
+             for pos, roots in sorted(by_pos.items())
+             for i in range(0, len(roots), CHUNK_SIZE)]
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(tasks))
+
+    if processes > 1:
+        with multiprocessing.Pool(processes) as pool:
+            return emit_rows(pool.imap(generate_rows, tasks), callback, outfile)
+    else:
+        return emit_rows(map(generate_rows, tasks), callback, outfile)
+
+
+def emit_rows(results, callback, outfile):
+    count = 0
+    for rows in results:
+        for row in rows:
+            if callback is not None:
+                callback(row)
+            if outfile is not None:
+                outfile.write('\t'.join(row) + '\n')
+        count += len(rows)
+    return count
+
+
+def build_paradigms(pairs, processes=None):
+    '''
+    Return a dict mapping each (root, pos) in `pairs` to its endings map,
+    generated in bulk with `generate_paradigms`.
+    '''
+    result = {}
+
+    def collect(row):
+        root, pos, tag, form = row
+        result.setdefault((root, pos), {})[tag] = form
+
+    generate_paradigms(pairs, callback=collect, processes=processes)
+    return result
+
+
+def paradigm_root(root_final):
+    '''
+    The root a paradigm is stored under for an entry's `root_final` (entries
+    without a root have 'None').
+
+    >>> paradigm_root('None'), paradigm_root('nallu')
+    ('', 'nallu')
+    '''
+    return '' if root_final == 'None' else root_final
+
+
+def discard_unused(root_final, pos):
+    '''
+    Delete the stored paradigm for an entry's old (root_final, pos) if no
+    entry uses it anymore.
+    '''
+    from .models import Entry, Paradigm
+    root = paradigm_root(root_final)
+    roots = {root, 'None'} if root == '' else {root}
+    if not Entry.objects.filter(root_final__in=roots, pos_final=pos).exists():
+        Paradigm.objects.filter(root=root, pos=pos).delete()
+
+
+def entry_keys():
+    from .models import Entry
+    return {
+        (paradigm_root(root), pos)
+        for root, pos in Entry.objects.filter(pos_final__in=ENDINGS.keys())
+                                      .values_list('root_final', 'pos_final')
+                                      .distinct()
+    }
+
+
+def fill_paradigms(processes=None):
+    '''
+    Bring the store up to date with the current entries: build missing and
+    out-of-date paradigms in bulk and delete ones that no entry uses. Returns
+    the number of paradigms in each of those states.
+    '''
+    from .models import Paradigm
+
+    keys = entry_keys()
+    stored = {(p.root, p.pos): p for p in Paradigm.objects.only('id', 'root', 'pos', 'rules_hash')}
+
+    unused = [p.id for key, p in stored.items() if key not in keys]
+    stale = [p for key, p in stored.items() if key in keys and p.rules_hash != RULES_HASH]
+    missing = sorted(key for key in keys if key not in stored)
+    built = build_paradigms([(p.root, p.pos) for p in stale] + missing, processes=processes)
+
+    with transaction.atomic():
+        Paradigm.objects.filter(id__in=unused).delete()
+
+        for paradigm in stale:
+            paradigm.rules_hash = RULES_HASH
+            paradigm.forms = json.dumps(built[paradigm.root, paradigm.pos], ensure_ascii=False)
+        Paradigm.objects.bulk_update(stale, ['rules_hash', 'forms'], batch_size=BATCH_SIZE)
+
+        Paradigm.objects.bulk_create([
+            Paradigm(root=root, pos=pos, rules_hash=RULES_HASH,
+                     forms=json.dumps(built[root, pos], ensure_ascii=False))
+            for root, pos in missing
+        ], batch_size=BATCH_SIZE)
+
+    return {
+        'up to date': len(keys) - len(stale) - len(missing),
+        'out of date': len(stale),
+        'missing': len(missing),
+        'unused': len(unused),
+    }
+
+
+if __name__ == '__main__':
+    import os
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "project.settings")
+    import django
+    django.setup()
+
+    import sys
+    if len(sys.argv) >= 2:
+        with open(sys.argv[1], 'w', encoding='utf-8') as outfile:
+            count = generate_paradigms(sorted(entry_keys()), outfile=outfile)
+        print('{} forms written to {}'.format(count, sys.argv[1]))
+    else:
+        counts = fill_paradigms()
+        print(', '.join('{} {}'.format(count, state) for state, count in counts.items()))
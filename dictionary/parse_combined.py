@@ -2,6 +2,17 @@
 r'''
 Run as python -m dictionary.parse_combined <combined_dict_file.mdf>
 
+The import is committed in batches of records. If it fails partway, run the
+same command again to resume after the last committed batch (progress is
+kept in <combined_dict_file.mdf>.checkpoint).
+
+To update a database that already has the dictionary in it, run
+
+    python -m dictionary.parse_combined --diff [--dry-run] <combined_dict_file.mdf>
+
+This only inserts, updates or deletes entries whose records changed since
+the last import (see diff_db); --dry-run just prints what would change.
+
 check:
     \codes with spaces before tab
     \sse's that should be \see's (look for "under"?)
@@ -66,14 +77,13 @@ Varieties:
 '''
 
 import codecs
+import hashlib
+import json
+import os
 import re
+import time
 from collections import Counter
 
-import os
-os.environ.setdefault("DJANGO_SETTINGS_MODULE", "project.settings")
-import django
-django.setup()
-
 
 NOTE_TAGS = {
     'nqq': 'Joe Kwaraceius:',
@@ -123,9 +133,12 @@ class Entry(object):
         self.varieties = []
         self.examples = []
         self.main_entry = main_entry
+        self.superscript = ''
         self.notes = ''
         self.comments = ''
         self.model = None
+        self.key = ''
+        self.hash = ''
 
 
 class Example(object):
@@ -140,35 +153,72 @@ class Example(object):
         self.model = None
 
 
+def iter_fields(lines):
+    r'''
+    Yield (key, value, line number) for each field of an MDF file, with
+    continuation lines joined onto the field they belong to.
+
+    >>> list(iter_fields(['\\lx\ttamaa\n', 'and more\n', '\n', '\\ps\tpron\n']))
+    [('lx', 'tamaa and more', 1), ('ps', 'pron', 4)]
+    '''
+    parts = None
+    for line_num, line in enumerate(lines, 1):
+        if line.endswith('\n'):
+            line = line[:-1]
+        if parts is None or '\t' in line:
+            if parts is not None:
+                yield split_field(parts, start)
+            parts = [line]
+            start = line_num
+        elif line.strip():
+            parts.append(line.strip())
+    if parts is not None:
+        yield split_field(parts, start)
+
+
+def split_field(parts, line_num):
+    key, value = ' '.join(parts).split('\t', 1)
+    return key.lstrip('\\'), value, line_num
+
+
 class FieldGenerator(object):
+    '''
+    The current field (`key`, `value`, `line_num`) of an MDF file, for the
+    recursive-descent parsers below. `next()` moves to the following field
+    and raises StopIteration at the end of the file.
+    '''
     def __init__(self, lines):
-        self.iter = iter(lines)
-        self.done = False
-        self.nextline = next(self.iter)[:-1]
-        self.line_num = 0
+        self.fields = iter_fields(lines)
         self.next()
 
     def next(self):
-        if self.done:
-            raise StopIteration
+        self.key, self.value, self.line_num = next(self.fields)
 
-        line = self.nextline
 
-        while True:
-            try:
-                self.nextline = next(self.iter)[:-1]
-                self.line_num += 1
-            except StopIteration:
-                self.done = True
-                break
-            if '\t' in self.nextline:
-                break
-            elif self.nextline.strip():
-                line = '{} {}'.format(line, self.nextline.strip())
+def iter_records(infile, garbage=None):
+    r'''
+    Parse an MDF file one \lx record at a time, yielding the entries and
+    examples of each record (the headword with its subentries, variants,
+    derivatives, etc.) without keeping earlier records around.
+    '''
+    if garbage is None:
+        garbage = Counter()
 
-        self.key, self.value = line.split('\t', 1)
-        while self.key.startswith('\\'):
-            self.key = self.key[1:]
+    f = FieldGenerator(infile)
+
+    while f.key != 'lx':
+        garbage[f.key] += 1
+        f.next()
+
+    done = False
+    while not done:
+        entries = []
+        examples = []
+        try:
+            parse_entry(0, f, entries, examples, garbage)
+        except StopIteration:
+            done = True
+        yield entries, examples
 
 
 def parse_combined(infile):
@@ -179,25 +229,21 @@ def parse_combined(infile):
 
     garbage = Counter()
 
-    f = FieldGenerator(infile)
+    for record_entries, record_examples in iter_records(infile, garbage):
+        entries.extend(record_entries)
+        examples.extend(record_examples)
 
-    while f.key != 'lx':
-        garbage[f.key] += 1
-        f.next()
+    print_summary(garbage, len(entries), len(examples))
+
+    return entries, examples
 
-    while True:
-        try:
-            parse_entry(0, f, entries, examples, garbage)
-        except StopIteration:
-            break
 
+def print_summary(garbage, num_entries, num_examples):
     for k, count in garbage.most_common():
         print('{:7d} {}'.format(count, k))
 
-    print('{} entries'.format(len(entries)))
-    print('{} examples'.format(len(examples)))
-
-    return entries, examples
+    print('{} entries'.format(num_entries))
+    print('{} examples'.format(num_examples))
 
 
 def parse_entry(sublevel, f, entries, examples, garbage, main_entry=None):
@@ -207,6 +253,7 @@ def parse_entry(sublevel, f, entries, examples, garbage, main_entry=None):
     word, number = extract_superscript(word)
     letter = 'a'
     entry = Entry(entry=ortho_fix(word), main_entry=main_entry)
+    entry.superscript = number or ''
     if meta_annotations:
         entry.comments = '\n'.join(meta_annotations)
     entries.append(entry)
@@ -258,7 +305,7 @@ def parse_entry(sublevel, f, entries, examples, garbage, main_entry=None):
             if entry.defn:
                 if number:
                     entry.defn = '.'.join((number + letter, entry.defn.split('.')[1]))
-                    letter = unichr(ord(letter) + 1)
+                    letter = chr(ord(letter) + 1)
                 new_entry = Entry(entry.entry, main_entry=entry.main_entry)
                 new_entry.pos = entry.pos
                 new_entry.root = entry.root
@@ -367,6 +414,7 @@ def parse_variant(f, entries, examples, garbage, band, main_entry):
     word, number = extract_superscript(word)
     letter = 'a'
     variant = Entry(entry=ortho_fix(word), main_entry=main_entry)
+    variant.superscript = number or ''
     variant.defn = '({}: `{}`)'.format(EXPLANATIONS[band], main_entry.entry)
     if band in ('syn', 'ant', 'va'):
         variant.pos = main_entry.pos
@@ -390,7 +438,7 @@ def parse_variant(f, entries, examples, garbage, band, main_entry):
             if not defn_is_explanation:
                 if number:
                     variant.defn = '.'.join((number + letter, variant.defn.split('.')[1]))
-                    letter = unichr(ord(letter) + 1)
+                    letter = chr(ord(letter) + 1)
                 new_variant = Entry(variant.entry, main_entry=variant.main_entry)
                 new_variant.pos = variant.pos
                 new_variant.root = variant.root
@@ -490,6 +538,7 @@ def parse_derivative(f, entries, examples, garbage, band, main_entry):
             word, meta_annotations = extract_meta(f.value)
             word, number = extract_superscript(word)
             derivative.entry = ortho_fix(word)
+            derivative.superscript = number or ''
             if number:
                 derivative.defn = 'sense {} = {}'.format(number, derivative.defn)
             derivative.comments += (
@@ -590,115 +639,455 @@ def extend_source_info(old, new):
         return old
 
 
-def populate_db(entries, examples):
-    from dictionary.models import Source
-    try:
-        Source.objects.get(abbrev='A/SD')
-    except Source.DoesNotExist:
-        Source(
-            abbrev='A/SD',
-            description='Joe Kwaraceius, Jeff Leer, et al., '
-                        'Alutiiq/Sugpiaq Dictionary, 2018 (preprint)',
-        ).save()
-
-    for i, entry in enumerate(entries):
-        insert_entry(entry)
-        if i % 1000 == 0:
-            print('entry {} ({})'.format(i, entry.entry))
-    for i, example in enumerate(examples):
-        insert_example(example)
-        if i % 1000 == 0:
-            print('example {}'.format(i))
-
-
-def insert_entry(entry):
-    from dictionary.models import Entry as EntryModel
-    from dictionary.models import EntryExampleInfo, EntryVarietyInfo
-    if entry.model is not None or not entry.entry:
-        return
-    m = entry.model = EntryModel(
-        entry=entry.entry,
-        defn=entry.defn,
-        pos=entry.pos,
-        root=entry.root,
-        source=lookup_source(entry.source),
-        source_info=entry.source_info,
-        etymology=entry.etymology,
-        notes=entry.notes,
-        comments=entry.comments,
-    )
-    m.save()
-    for example in entry.examples:
-        insert_example(example)
-        if example.model:
-            EntryExampleInfo(
-                entry=m,
-                example=example.model,
-            ).save()
-    for main, detail in entry.varieties:
-        variety_model = get_variety_model(main)
-        EntryVarietyInfo(
-            entry=m,
-            variety=variety_model,
-            detail=detail,
-        ).save()
-    if entry.main_entry:
-        insert_entry(entry.main_entry)
-        if entry.main_entry.model:
+BATCH_SIZE = 1000
+RECORDS_PER_BATCH = 500
+SOURCE_ABBREV = 'A/SD'
+
+
+def import_combined(infile, checkpoint_file=None, records_per_batch=RECORDS_PER_BATCH):
+    r'''
+    Stream the records of an MDF file into the database, committing every
+    `records_per_batch` \lx records. If `checkpoint_file` is given, the number
+    of records committed so far is written there after each batch, and an
+    existing checkpoint makes the import skip that many records, so a failed
+    import can be resumed by running it again. The checkpoint is removed once
+    the whole file has been imported.
+    '''
+    done = 0
+    if checkpoint_file and os.path.exists(checkpoint_file):
+        with open(checkpoint_file) as checkpoint:
+            done = int(checkpoint.read())
+        print('resuming after record {}'.format(done))
+
+    start = time.time()
+    rows = 0
+    batch = []
+    seen = Counter()
+    for i, (entries, examples) in enumerate(iter_records(infile), 1):
+        fingerprint(entries, seen)
+        if i <= done:
+            continue
+        batch.append((entries, examples))
+        if len(batch) == records_per_batch:
+            rows += populate_batch(batch)
+            write_checkpoint(checkpoint_file, i)
+            batch = []
+            print('record {} ({:.0f} rows/s)'.format(i, rows / max(time.time() - start, 1e-6)))
+    if batch:
+        rows += populate_batch(batch)
+
+    if checkpoint_file and os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+    print('{} rows in {:.1f} s'.format(rows, time.time() - start))
+    return rows
+
+
+def populate_batch(records):
+    return populate_db([entry for entries, examples in records for entry in entries],
+                       [example for entries, examples in records for example in examples],
+                       verbose=False)
+
+
+def write_checkpoint(checkpoint_file, done):
+    if checkpoint_file:
+        with open(checkpoint_file, 'w') as outfile:
+            outfile.write('{}\n'.format(done))
+
+
+def fingerprint(entries, seen=None):
+    '''
+    Set `key` on each parsed entry: a hash of its headword, superscript
+    (homonym) number and part of speech, plus how many earlier entries had
+    the same hash. This identifies the entry across imports, even when its
+    definition changes. Also set `hash`, a hash of everything else that is
+    imported for it, so that changes can be detected. `seen` carries the
+    counts over from earlier calls when a file is fingerprinted in pieces.
+    '''
+    if seen is None:
+        seen = Counter()
+    for entry in entries:
+        if entry.entry:
+            base = record_key(entry.entry, entry.superscript, entry.pos)
+            entry.key = '{}:{}'.format(base, seen[base])
+            seen[base] += 1
+    for entry in entries:
+        if entry.entry:
+            main_key = entry.main_entry.key if entry.main_entry else ''
+            entry.hash = content_hash([entry.defn] + imported_content(entry, main_key))
+
+
+def legacy_fingerprints(entries):
+    '''
+    The keys that entries imported before they were keyed by superscript
+    have, which hashed the definition instead, mapped to the parsed entry
+    and its hash as computed back then.
+    '''
+    seen = Counter()
+    keys = {}
+    for entry in entries:
+        if entry.entry:
+            base = record_key(entry.entry, entry.pos, entry.defn)
+            keys[entry] = '{}:{}'.format(base, seen[base])
+            seen[base] += 1
+    return {key: (entry, content_hash(imported_content(entry, keys.get(entry.main_entry, ''))))
+            for entry, key in keys.items()}
+
+
+def record_key(*fields):
+    return hashlib.sha1('\x1f'.join(fields).encode('utf-8')).hexdigest()
+
+
+def imported_content(entry, main_key):
+    return [
+        entry.root, entry.etymology, entry.source_info, entry.notes, entry.comments,
+        main_key,
+        entry.varieties,
+        [[example.vernacular, example.english, example.source_info, example.notes,
+          example.comments, example.varieties]
+         for example in entry.examples],
+    ]
+
+
+def content_hash(content):
+    return hashlib.sha1(json.dumps(content).encode('utf-8')).hexdigest()
+
+
+class BulkWriter(object):
+    '''
+    Collects new rows for parsed entries and examples and writes them with
+    bulk inserts. Entry and example ids are assigned as rows are added (in
+    the order the old row-by-row import used), so main entries and the
+    through tables can be linked before anything is written. Use inside a
+    transaction: the entry and example tables are locked against other
+    inserts until it ends (see `lock_for_insert`), so nothing else can take
+    the ids.
+    '''
+    def __init__(self):
+        from django.db.models import Max
+        from dictionary.models import Entry as EntryModel, Example as ExampleModel
+        from dictionary.models import EntryExampleInfo, EntryVarietyInfo, ExampleVarietyInfo
+        from dictionary.models import Source, Variety
+
+        lock_for_insert([EntryModel, ExampleModel])
+
+        Source.objects.get_or_create(
+            abbrev=SOURCE_ABBREV,
+            defaults={'description': 'Joe Kwaraceius, Jeff Leer, et al., '
+                                     'Alutiiq/Sugpiaq Dictionary, 2018 (preprint)'},
+        )
+        self.sources = {s.abbrev: s for s in Source.objects.all()}
+        self.varieties = {v.abbrev: v for v in Variety.objects.all()}
+        self.next_id = {
+            model: (model.objects.aggregate(Max('id'))['id__max'] or 0) + 1
+            for model in (EntryModel, ExampleModel)
+        }
+        self.rows = {model: [] for model in (EntryModel, ExampleModel, EntryExampleInfo,
+                                             EntryVarietyInfo, ExampleVarietyInfo)}
+
+    def get_variety(self, abbrev):
+        from dictionary.models import Variety
+        if abbrev not in self.varieties:
+            self.varieties[abbrev] = Variety.objects.create(abbrev=abbrev,
+                                                            description=VARIETIES[abbrev])
+        return self.varieties[abbrev]
+
+    def add(self, model, **fields):
+        if model in self.next_id:
+            fields['id'] = self.next_id[model]
+            self.next_id[model] += 1
+        row = model(**fields)
+        self.rows[model].append(row)
+        return row
+
+    def add_example(self, example):
+        from dictionary.models import Example as ExampleModel
+        from dictionary.models import ExampleVarietyInfo
+        if example.model is not None or not example.vernacular:
+            return
+        m = example.model = self.add(
+            ExampleModel,
+            vernacular=example.vernacular,
+            english=example.english,
+            source=self.sources[example.source],
+            source_info=example.source_info,
+            notes=example.notes,
+            comments=example.comments,
+        )
+        for main, detail in example.varieties:
+            self.add(ExampleVarietyInfo, example=m, variety=self.get_variety(main), detail=detail)
+
+    def add_entry(self, entry):
+        from dictionary.models import Entry as EntryModel
+        if entry.model is not None or not entry.entry:
+            return
+        m = entry.model = self.add(EntryModel)
+        set_entry_fields(m, entry, self.sources)
+        self.add_links(entry, m)
+        if entry.main_entry:
+            self.add_entry(entry.main_entry)
             m.main_entry = entry.main_entry.model
-            m.save()
-
-
-def insert_example(example):
-    from dictionary.models import Example as ExampleModel
-    from dictionary.models import ExampleVarietyInfo
-    if example.model is not None or not example.vernacular:
-        return
-    m = example.model = ExampleModel(
-        vernacular=example.vernacular,
-        english=example.english,
-        source=lookup_source(example.source),
-        source_info=example.source_info,
-        notes=example.notes,
-        comments=example.comments,
-    )
-    m.save()
-    for main, detail in example.varieties:
-        variety_model = get_variety_model(main)
-        ExampleVarietyInfo(
-            example=m,
-            variety=variety_model,
-            detail=detail,
-        ).save()
-
-
-def lookup_source(abbrev):
-    from dictionary.models import Source
-    return Source.objects.get(abbrev=abbrev)
-
-
-def get_variety_model(abbrev):
-    from dictionary.models import Variety
-    try:
-        return Variety.objects.get(abbrev=abbrev)
-    except Variety.DoesNotExist:
-        model = Variety(abbrev=abbrev, description=VARIETIES[abbrev])
-        model.save()
-        return model
+
+    def add_links(self, entry, m):
+        from dictionary.models import EntryExampleInfo, EntryVarietyInfo
+        for example in entry.examples:
+            self.add_example(example)
+            if example.model:
+                self.add(EntryExampleInfo, entry=m, example=example.model)
+        for main, detail in entry.varieties:
+            self.add(EntryVarietyInfo, entry=m, variety=self.get_variety(main), detail=detail)
+
+    def write(self, batch_size=BATCH_SIZE, verbose=True):
+        '''Insert the collected rows and return how many there were.'''
+        from django.core.management.color import no_style
+        from django.db import connection
+        from dictionary.models import Entry as EntryModel, Example as ExampleModel
+
+        self.rows[EntryModel] = parents_first(self.rows[EntryModel])
+        for model, model_rows in self.rows.items():
+            for i in range(0, len(model_rows), batch_size):
+                model.objects.bulk_create(model_rows[i:i + batch_size])
+            if verbose:
+                print('{} {} rows'.format(len(model_rows), model._meta.verbose_name))
+
+        # The ids above were assigned by hand, so move the id sequences
+        # (on databases that have them) past them.
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [EntryModel, ExampleModel]):
+                cursor.execute(sql)
+
+        return sum(len(model_rows) for model_rows in self.rows.values())
+
+
+def parents_first(rows):
+    '''
+    New entry rows reordered so that each comes after its main entry, if
+    that is also new, and otherwise in the same order. Subentries are
+    added before their main entries, but MySQL checks foreign keys row by
+    row as they are inserted.
+    '''
+    main_ids = {row.id: row.main_entry_id for row in rows}
+
+    def depth(row):
+        depth, main_id = 0, row.main_entry_id
+        while main_id in main_ids:
+            depth, main_id = depth + 1, main_ids[main_id]
+        return depth
+
+    return sorted(rows, key=depth)
+
+
+def lock_for_insert(models):
+    '''
+    Keep other connections from inserting into the tables of `models` until
+    the current transaction ends, while still letting them read.
+    '''
+    from django.db import connection
+
+    quote = connection.ops.quote_name
+    tables = [quote(model._meta.db_table) for model in models]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('LOCK TABLE {} IN SHARE ROW EXCLUSIVE MODE'.format(', '.join(tables)))
+        elif connection.vendor == 'mysql':
+            # Locks the gap after the highest id, where new rows would go.
+            for table in tables:
+                cursor.execute('SELECT id FROM {} ORDER BY id DESC LIMIT 1 FOR UPDATE'
+                               .format(table))
+        elif connection.vendor == 'sqlite':
+            # SQLite has one writer at a time; any write statement makes
+            # this connection it until the transaction ends.
+            cursor.execute('UPDATE {} SET id = id WHERE 1 = 0'.format(tables[0]))
+
+
+def set_entry_fields(m, entry, sources):
+    from django.utils import timezone
+    m.entry = entry.entry
+    m.defn = entry.defn
+    m.pos = entry.pos
+    m.root = entry.root
+    m.source = sources[entry.source]
+    m.source_info = entry.source_info
+    m.etymology = entry.etymology
+    m.notes = entry.notes
+    m.comments = entry.comments
+    m.mdf_key = entry.key
+    m.mdf_hash = entry.hash
+    m.modified = timezone.now()
+    m.fill()
+
+
+def populate_db(entries, examples, batch_size=BATCH_SIZE, verbose=True):
+    '''
+    Insert parsed entries and examples, with their variety and example
+    links, in one transaction, using a few bulk inserts per table. Returns
+    the number of rows written.
+    '''
+    from django.db import transaction
+    from dictionary import caching, search
+
+    if any(entry.entry and not entry.key for entry in entries):
+        fingerprint(entries)
+
+    start = time.time()
+    with transaction.atomic():
+        writer = BulkWriter()
+        for entry in entries:
+            writer.add_entry(entry)
+        for example in examples:
+            writer.add_example(example)
+        total = writer.write(batch_size, verbose=verbose)
+
+    search.invalidate_index()
+    caching.lexicon_changed()
+
+    if verbose:
+        elapsed = time.time() - start
+        print('{} rows in {:.1f} s ({:.0f} rows/s)'.format(total, elapsed,
+                                                          total / max(elapsed, 1e-6)))
+    return total
+
+
+UPDATE_FIELDS = ['entry', 'defn', 'pos', 'root', 'source', 'source_info', 'etymology',
+                 'notes', 'comments', 'main_entry', 'mdf_key', 'mdf_hash', 'modified',
+                 'search_word', 'search_text', 'pos_auto', 'pos_final', 'root_auto',
+                 'root_final']
+
+
+def diff_db(entries, dry_run=False, batch_size=BATCH_SIZE):
+    '''
+    Bring the entries previously imported from the combined dictionary in
+    line with freshly parsed `entries`: insert new records, update records
+    whose imported content changed (replacing their examples and varieties)
+    and delete records that are gone. Matching uses the keys from
+    `fingerprint`, so rows that did not change in the file are left alone,
+    along with any edits made to them in the admin. Examples that are not
+    attached to an entry are not touched. Prints a summary and returns the
+    number of entries in each state; with `dry_run`, nothing is written.
+    '''
+    from django.db import transaction
+    from dictionary.models import Entry as EntryModel, Example as ExampleModel
+    from dictionary.models import EntryVarietyInfo
+    from dictionary import caching, paradigms, search
+
+    fingerprint(entries)
+    parsed = {entry.key: entry for entry in entries if entry.entry}
+    legacy_parsed = legacy_fingerprints(entries)
+
+    stored = {}
+    rekeyed = {}
+    legacy = Counter()
+    deleted = []
+    for id, key, hash, word, pos, defn in (
+            EntryModel.objects.filter(source__abbrev=SOURCE_ABBREV)
+                              .order_by('id')
+                              .values_list('id', 'mdf_key', 'mdf_hash', 'entry', 'pos', 'defn')):
+        if not key:
+            # Imported before keys were stored.
+            base = record_key(word, pos, defn)
+            key = '{}:{}'.format(base, legacy[base])
+            legacy[base] += 1
+        if key not in parsed and key in legacy_parsed:
+            # Imported before entries were keyed by superscript; if nothing
+            # else changed, only the key and hash need rewriting.
+            entry, legacy_hash = legacy_parsed[key]
+            key = entry.key
+            if hash == legacy_hash:
+                hash = entry.hash
+                rekeyed[id] = entry
+        if key in parsed and key not in stored:
+            stored[key] = (id, hash)
+        else:
+            deleted.append(id)
+
+    inserted = [entry for key, entry in parsed.items() if key not in stored]
+    updated = [entry for key, entry in parsed.items()
+               if key in stored and stored[key][1] != entry.hash]
+    counts = {
+        'unchanged': len(stored) - len(updated),
+        'inserted': len(inserted),
+        'updated': len(updated),
+        'deleted': len(deleted),
+    }
+    print(', '.join('{} {}'.format(count, state) for state, count in counts.items()))
+    for state, changed in [('insert', inserted), ('update', updated)]:
+        for entry in changed[:10]:
+            print('  {} {} ({})'.format(state, entry.entry, entry.defn))
+    if dry_run:
+        return counts
+
+    with transaction.atomic():
+        for key, (id, hash) in stored.items():
+            parsed[key].model = EntryModel(id=id)
+        updated_ids = [stored[entry.key][0] for entry in updated]
+
+        ExampleModel.objects.filter(entryexampleinfo__entry__in=updated_ids + deleted,
+                                    source__abbrev=SOURCE_ABBREV).delete()
+        EntryVarietyInfo.objects.filter(entry__in=updated_ids).delete()
+
+        old_paradigms = set(EntryModel.objects.filter(id__in=updated_ids + deleted)
+                                              .values_list('root_final', 'pos_final'))
+        EntryModel.objects.filter(id__in=deleted).delete()
+
+        writer = BulkWriter()
+        for entry in inserted:
+            writer.add_entry(entry)
+        models = EntryModel.objects.in_bulk(updated_ids)
+        for entry in updated:
+            entry.model = models[entry.model.id]
+            set_entry_fields(entry.model, entry, writer.sources)
+            entry.model.main_entry = entry.main_entry.model if entry.main_entry else None
+            writer.add_links(entry, entry.model)
+        # Updated rows may point to new main entries, so insert those first.
+        writer.write(batch_size, verbose=False)
+        EntryModel.objects.bulk_update(models.values(), UPDATE_FIELDS, batch_size=batch_size)
+        EntryModel.objects.bulk_update(
+            [EntryModel(id=id, mdf_key=entry.key, mdf_hash=entry.hash)
+             for id, entry in rekeyed.items() if stored[entry.key][0] == id],
+            ['mdf_key', 'mdf_hash'], batch_size=batch_size)
+
+        for root, pos in old_paradigms:
+            paradigms.discard_unused(root, pos)
+
+    search.invalidate_index()
+    caching.lexicon_changed()
+    return counts
 
 
 if __name__ == '__main__':
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "project.settings")
+    import django
+    django.setup()
+
     import sys
-    if len(sys.argv) != 2:
-        print('Usage: {} <dict_file.mdf>'.format(sys.argv[0]))
+    flags = [arg for arg in sys.argv[1:] if arg.startswith('--')]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if len(args) != 1 or not set(flags) <= {'--diff', '--dry-run'}:
+        print('Usage: {} [--diff [--dry-run]] <dict_file.mdf>'.format(sys.argv[0]))
         sys.exit(-2)
-
+    sys.argv[1:] = args
+
+    if '--diff' in flags:
+        with codecs.open(sys.argv[1], 'r', encoding='utf-8') as infile:
+            entries, examples = parse_combined(infile)
+        diff_db(entries, dry_run='--dry-run' in flags)
+        sys.exit()
+
+    checkpoint_file = sys.argv[1] + '.checkpoint'
+    if not os.path.exists(checkpoint_file):
+        # Parse once without keeping anything, to show what will be imported.
+        garbage = Counter()
+        entries = examples = 0
+        with codecs.open(sys.argv[1], 'r', encoding='utf-8') as infile:
+            for record_entries, record_examples in iter_records(infile, garbage):
+                entries += len(record_entries)
+                examples += len(record_examples)
+        print_summary(garbage, entries, examples)
+
+        answer = input('continue and populate database (y/n)? ')
+        if answer.lower() not in ('y', 'yes'):
+            print('canceled')
+            sys.exit()
+
+    print('populating...')
     with codecs.open(sys.argv[1], 'r', encoding='utf-8') as infile:
-        entries, examples = parse_combined(infile)
-
-    answer = input('continue and populate database (y/n)? ')
-    if answer.lower() in ('y', 'yes'):
-        print('populating...')
-        populate_db(entries, examples)
-    else:
-        print('canceled')
+        import_combined(infile, checkpoint_file)
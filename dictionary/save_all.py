@@ -1,21 +1,150 @@
-# Run with: python -m dictionary.save_all
+# Run with: python -m dictionary.save_all [--since <date/time>] [--since-id <id>] [--jobs <n>]
 # This script is useful for refreshing the "search_word" and "search_text"
-# fields when doing database migrations or restoring backups.
+# fields (and the guessed part of speech and root) when doing database
+# migrations, restoring backups or changing the rules in alutiiq.py.
+# --since only refreshes entries saved at or after the given time (e.g.
+# 2020-07-12 or "2020-07-12 16:12"), --since-id those with at least the
+# given id.
 
+import multiprocessing
 import os
-os.environ.setdefault("DJANGO_SETTINGS_MODULE", "project.settings")
-import django
-django.setup()
+from itertools import islice
 
-from .models import Entry
+from .alutiiq import DerivedFields, derive_fields
 
 
-def save_all():
-    for i, entry in enumerate(Entry.objects.all()):
-        if i % 1000 == 0:
-            print(i)
-        entry.save()
+CHUNK_SIZE = 1000
+DERIVED_FIELDS = list(DerivedFields._fields)
+
+
+def iter_chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def changed_rows(rows):
+    '''
+    Recompute the derived fields for (id, entry, defn, pos, root, *stored
+    derived fields) rows. Returns the number of rows and a list of
+    (id, stored, derived) for the rows where they differ.
+    '''
+    result = []
+    for row in rows:
+        id, word, defn, pos, root = row[:5]
+        stored = DerivedFields(*row[5:])
+        derived = derive_fields(word, defn, pos, root)
+        if derived != stored:
+            result.append((id, stored, derived))
+    return len(rows), result
+
+
+def save_all(since=None, since_id=None, processes=None, chunk_size=CHUNK_SIZE, verbose=True):
+    '''
+    Recompute the derived fields of every entry (or only those saved at or
+    after the datetime `since` and/or with an id of at least `since_id`) and
+    write the ones that changed with bulk updates. Entries are read in
+    chunks of `chunk_size`, which are spread over `processes` worker
+    processes (default one per CPU; 1 does everything in this process).
+    Returns the number of entries updated.
+    '''
+    from django.db import connections, transaction
+    from . import caching, paradigms, search
+    from .models import Entry
+
+    entries = Entry.objects.order_by('id')
+    if since is not None:
+        entries = entries.filter(modified__gte=since)
+    if since_id is not None:
+        entries = entries.filter(id__gte=since_id)
+    rows = entries.values_list('id', 'entry', 'defn', 'pos', 'root', *DERIVED_FIELDS)
+    chunks = iter_chunks(rows.iterator(chunk_size=chunk_size), chunk_size)
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    checked = updated = 0
+    old_paradigms = set()
+
+    def write(results):
+        nonlocal checked, updated
+        for count, changed in results:
+            with transaction.atomic():
+                Entry.objects.bulk_update([Entry(id=id, **derived._asdict())
+                                           for id, stored, derived in changed],
+                                          DERIVED_FIELDS)
+            old_paradigms.update((stored.root_final, stored.pos_final)
+                                 for id, stored, derived in changed
+                                 if (stored.root_final, stored.pos_final) !=
+                                    (derived.root_final, derived.pos_final))
+            updated += len(changed)
+            checked += count
+            if verbose:
+                print('{} checked, {} updated'.format(checked, updated))
+
+    def feed():
+        # The pool pulls chunks from its task-feeder thread, which opens its
+        # own database connection to run the query; close it when done.
+        try:
+            yield from chunks
+        finally:
+            connections.close_all()
+
+    if processes > 1:
+        with multiprocessing.Pool(processes) as pool:
+            write(pool.imap(changed_rows, feed()))
+    else:
+        write(map(changed_rows, chunks))
+
+    for root, pos in old_paradigms:
+        paradigms.discard_unused(root, pos)
+    if updated:
+        search.invalidate_index()
+        caching.lexicon_changed()
+    return updated
+
+
+def parse_since(value):
+    from django.utils import timezone
+    from django.utils.dateparse import parse_date, parse_datetime
+
+    since = parse_datetime(value)
+    if since is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError('not a date or time: {}'.format(value))
+        since = parse_datetime(date.isoformat() + 'T00:00')
+    if timezone.is_naive(since):
+        since = timezone.make_aware(since)
+    return since
 
 
 if __name__ == '__main__':
-    save_all()
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "project.settings")
+    import django
+    django.setup()
+
+    import sys
+    options = {}
+    args = sys.argv[1:]
+    try:
+        while args:
+            flag, value = args[:2]
+            if flag == '--since':
+                options['since'] = parse_since(value)
+            elif flag == '--since-id':
+                options['since_id'] = int(value)
+            elif flag == '--jobs':
+                options['processes'] = int(value)
+            else:
+                raise ValueError('unknown option: {}'.format(flag))
+            args = args[2:]
+    except ValueError as e:
+        print(e)
+        print('Usage: {} [--since <date/time>] [--since-id <id>] [--jobs <n>]'.format(sys.argv[0]))
+        sys.exit(-2)
+
+    print('{} entries updated'.format(save_all(**options)))
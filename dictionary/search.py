@@ -0,0 +1,493 @@
+# -*- coding: utf-8 -*-
+'''
+Search backends for finding the entries that match a query.
+
+A search runs through a fixed sequence of tiers, from the most to the least
+specific. Alutiiq tiers match the normalized headword (`Entry.search_word`):
+
+    exact       whole word, with an optional trailing hyphen
+    prefix      beginning of the word
+    suffix      end of the word, with an optional trailing hyphen
+    substring   anywhere in the word
+
+English tiers match the lowercased definition (`Entry.search_text`):
+
+    word        whole word(s)
+    start       beginning of a word
+    end         end of a word
+
+`RegexBackend` runs each tier as a regex query against the database.
+`PostgresBackend` runs the same queries on Postgres, where they can use the
+trigram and full-text indexes added by migration 0013 instead of scanning the
+table. `IndexBackend` answers the same tiers from an in-memory index that is
+built once per process and kept up to date as entries are saved and deleted.
+'''
+import bisect
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import BooleanField
+from django.db.models.expressions import RawSQL
+
+from .alutiiq import normalize
+from .caching import lexicon_version
+
+
+SEARCH_LIMIT = 1000
+
+ALUTIIQ_TIERS = [
+    ('exact', '^{}-?$'),
+    ('prefix', '^{}'),
+    ('suffix', '{}-?$'),
+    ('substring', '{}'),
+]
+
+ENGLISH_TIERS = [
+    ('word', '{sow}{}{eow}'),
+    ('start', '{sow}{}'),
+    ('end', '{}{eow}'),
+]
+
+R_CLASS = '[rRřŘ]'
+
+
+def alutiiq_pattern(query):
+    r'''
+    Build the regex used to match a query against `Entry.search_word`:
+    g matches g or r, r matches g, r, or R, and R matches only R.
+
+    >>> alutiiq_pattern('giinaq')
+    'rinak'
+    >>> alutiiq_pattern('kuruq')
+    'ku[rRřŘ]uk'
+    >>> alutiiq_pattern('kuRuq')
+    'kuRuk'
+    >>> alutiiq_pattern('angayuq')
+    'angaiuk'
+    '''
+    return re.sub(
+        r'(?<!n)g', 'r',
+        re.escape(normalize(query, g_and_r=False)).replace('r', R_CLASS)
+    )
+
+
+def english_pattern(query):
+    return re.escape(query.lower())
+
+
+def word_boundaries(vendor):
+    if vendor == 'mysql':
+        return '(^|[[:space:][:punct:]])', '($|[[:space:][:punct:]])'
+    elif vendor == 'postgresql':
+        return r'\m', r'\M'
+    else:
+        return r'\b', r'\b'
+
+
+def find_entry_ids(query, limit=SEARCH_LIMIT):
+    '''
+    Return the ids of entries matching `query`, tier by tier. As with the
+    original sequence of regex queries, a tier that hits `limit` results ends
+    its group of tiers without contributing anything, and an entry matched
+    by several tiers is listed once per tier.
+    '''
+    backend = get_backend()
+
+    result = []
+    for tier, _ in ALUTIIQ_TIERS:
+        ids = backend.alutiiq_ids(query, tier, limit)
+        if len(ids) == limit:
+            break
+        result.extend(ids)
+
+    for tier, _ in ENGLISH_TIERS:
+        ids = backend.english_ids(query, tier, limit)
+        if len(ids) == limit:
+            break
+        result.extend(ids)
+
+    return result
+
+
+class RegexBackend(object):
+    '''Runs every tier as a `__regex` query (a full table scan).'''
+
+    def __init__(self):
+        self.sow, self.eow = word_boundaries(connection.vendor)
+
+    def alutiiq_ids(self, query, tier, limit):
+        from .models import Entry
+        regex = dict(ALUTIIQ_TIERS)[tier].format(alutiiq_pattern(query))
+        return list(Entry.objects.filter(search_word__regex=regex)
+                                 .values_list('id', flat=True)[:limit])
+
+    def english_ids(self, query, tier, limit):
+        from .models import Entry
+        regex = dict(ENGLISH_TIERS)[tier].format(english_pattern(query),
+                                                 sow=self.sow, eow=self.eow)
+        return list(Entry.objects.filter(search_text__regex=regex)
+                                 .values_list('id', flat=True)[:limit])
+
+
+# Runs of anything but letters, digits and underscores, which are replaced by
+# spaces before text is split into words for Entry.search_vector (see
+# migration 0013). Queries go through the same expression, so they are split
+# into the same words.
+VECTOR_SEPARATORS = '[^[:alnum:]_]+'
+VECTOR_MATCH = ("search_vector @@ phraseto_tsquery('simple', "
+                "regexp_replace(%s, %s, ' ', 'g'))")
+
+
+class PostgresBackend(RegexBackend):
+    '''
+    Runs the same regex queries on Postgres, where the trigram (pg_trgm)
+    indexes on `search_word` and `search_text` let the planner skip the rows
+    that can't match. A whole-word English query is also narrowed down by
+    the full-text index on `search_vector`: every regex match contains the
+    query's words in order, so the text search finds a superset of the
+    matches and the regex picks out the real ones.
+    '''
+
+    def english_ids(self, query, tier, limit):
+        from .models import Entry
+        if tier != 'word' or not re.search(r'[^\W_]', query):
+            return super(PostgresBackend, self).english_ids(query, tier, limit)
+        regex = dict(ENGLISH_TIERS)[tier].format(english_pattern(query),
+                                                 sow=self.sow, eow=self.eow)
+        vector_match = RawSQL(VECTOR_MATCH, [query.lower(), VECTOR_SEPARATORS],
+                              output_field=BooleanField())
+        return list(Entry.objects.filter(vector_match, search_text__regex=regex)
+                                 .values_list('id', flat=True)[:limit])
+
+
+def fold(word):
+    '''
+    Collapse the letters that an Alutiiq query pattern can match
+    interchangeably, so index lookups return a superset of the real matches.
+
+    >>> fold('kuRřuk')
+    'kurruk'
+    '''
+    return word.translate(FOLD_TABLE)
+
+
+FOLD_TABLE = str.maketrans('RřŘ', 'rrr')
+
+WORD_RE = re.compile(r'\w+')
+
+
+def ngrams(word, n):
+    return {word[i:i + n] for i in range(len(word) - n + 1)}
+
+
+def prefixed(sorted_keys, prefix):
+    '''
+    >>> list(prefixed([('ab', 1), ('abc', 2), ('b', 3)], 'ab'))
+    [('ab', 1), ('abc', 2)]
+    '''
+    start = bisect.bisect_left(sorted_keys, (prefix,))
+    for i in range(start, len(sorted_keys)):
+        if not sorted_keys[i][0].startswith(prefix):
+            break
+        yield sorted_keys[i]
+
+
+class SearchIndex(object):
+    '''
+    In-memory index over `Entry.search_word` and `Entry.search_text`.
+
+    Headwords are indexed by their 1-, 2- and 3-grams and kept in sorted
+    forward and reversed lists for prefix and suffix lookups. Definitions are
+    indexed by word token, with a sorted vocabulary (also forward and
+    reversed) for tokens that only need to match at one end. Lookups produce
+    a small candidate set, which is then checked against the same regex the
+    database would have used.
+
+    >>> index = SearchIndex()
+    >>> index.add(1, 'rinak', 'a letter, character')
+    >>> index.add(2, 'rinaki', 'letters')
+    >>> index.alutiiq_ids('giinaq', 'exact', 10)
+    [1]
+    >>> index.alutiiq_ids('iinaq', 'suffix', 10)
+    [1]
+    >>> index.english_ids('Letter', 'start', 10)
+    [1, 2]
+    >>> index.remove(1)
+    >>> index.english_ids('letter', 'start', 10)
+    [2]
+    '''
+
+    def __init__(self):
+        self.words = {}
+        self.texts = {}
+        self.exact = {}
+        self.grams = {}
+        self.forward = []
+        self.backward = []
+        self.tokens = {}
+        self.vocab = []
+        self.vocab_reversed = []
+        self.lock = threading.RLock()
+
+    def add(self, id, search_word, search_text):
+        with self.lock:
+            if id in self.words:
+                self.remove(id)
+            self.words[id] = search_word
+            self.texts[id] = search_text
+
+            folded = fold(search_word)
+            for key in self.word_keys(folded):
+                self.exact.setdefault(key, set()).add(id)
+                bisect.insort(self.backward, (key[::-1], id))
+            bisect.insort(self.forward, (folded, id))
+            for gram in self.word_grams(folded):
+                self.grams.setdefault(gram, set()).add(id)
+
+            for token in set(WORD_RE.findall(search_text)):
+                if token not in self.tokens:
+                    self.tokens[token] = set()
+                    bisect.insort(self.vocab, token)
+                    bisect.insort(self.vocab_reversed, token[::-1])
+                self.tokens[token].add(id)
+
+    def remove(self, id):
+        with self.lock:
+            if id not in self.words:
+                return
+            search_word = self.words.pop(id)
+            search_text = self.texts.pop(id)
+
+            folded = fold(search_word)
+            for key in self.word_keys(folded):
+                self.discard(self.exact, key, id)
+                self.remove_sorted(self.backward, (key[::-1], id))
+            self.remove_sorted(self.forward, (folded, id))
+            for gram in self.word_grams(folded):
+                self.discard(self.grams, gram, id)
+
+            for token in set(WORD_RE.findall(search_text)):
+                if self.discard(self.tokens, token, id):
+                    self.remove_sorted(self.vocab, token)
+                    self.remove_sorted(self.vocab_reversed, token[::-1])
+
+    @staticmethod
+    def word_keys(folded):
+        # '^q-?$' and 'q-?$' also accept the word without its trailing hyphen.
+        if folded.endswith('-'):
+            return [folded, folded[:-1]]
+        else:
+            return [folded]
+
+    @staticmethod
+    def word_grams(folded):
+        return set().union(*(ngrams(folded, n) for n in (1, 2, 3)))
+
+    @staticmethod
+    def discard(postings, key, id):
+        '''Remove `id` from a posting set; return True if the set is now empty.'''
+        ids = postings.get(key)
+        if ids is None:
+            return False
+        ids.discard(id)
+        if not ids:
+            del postings[key]
+            return True
+        return False
+
+    @staticmethod
+    def remove_sorted(sorted_list, item):
+        i = bisect.bisect_left(sorted_list, item)
+        if i < len(sorted_list) and sorted_list[i] == item:
+            del sorted_list[i]
+
+    def alutiiq_ids(self, query, tier, limit):
+        regex = re.compile(dict(ALUTIIQ_TIERS)[tier].format(alutiiq_pattern(query)))
+        literal = fold(re.sub(r'(?<!n)g', 'r', normalize(query, g_and_r=False)))
+        with self.lock:
+            candidates = self.alutiiq_candidates(literal, tier)
+            return self.verify(candidates, self.words, regex, limit)
+
+    def alutiiq_candidates(self, query, tier):
+        if tier == 'exact':
+            return self.exact.get(query, ())
+        elif tier == 'prefix':
+            return [id for _, id in prefixed(self.forward, query)]
+        elif tier == 'suffix':
+            return [id for _, id in prefixed(self.backward, query[::-1])]
+        elif not query:
+            return self.words.keys()
+        elif len(query) <= 3:
+            return self.grams.get(query, ())
+        else:
+            return self.intersect(self.grams.get(gram, set())
+                                  for gram in ngrams(query, 3))
+
+    def english_ids(self, query, tier, limit):
+        regex = re.compile(dict(ENGLISH_TIERS)[tier].format(english_pattern(query),
+                                                            sow=r'\b', eow=r'\b'))
+        with self.lock:
+            candidates = self.english_candidates(query.lower(), tier)
+            return self.verify(candidates, self.texts, regex, limit)
+
+    def english_candidates(self, query, tier):
+        spans = [m.span() for m in WORD_RE.finditer(query)]
+        if not spans:
+            return self.texts.keys()
+
+        id_sets = []
+        for start, end in spans:
+            # A query token must line up with the start (end) of a word in the
+            # definition if anything comes before (after) it in the query, or
+            # if the tier asks for a word boundary there.
+            at_start = start > 0 or tier in ('word', 'start')
+            at_end = end < len(query) or tier in ('word', 'end')
+            token = query[start:end]
+            if at_start and at_end:
+                matches = [token] if token in self.tokens else []
+            elif at_start:
+                matches = list(self.vocab_range(self.vocab, token))
+            elif at_end:
+                matches = [t[::-1] for t in self.vocab_range(self.vocab_reversed, token[::-1])]
+            else:
+                matches = [t for t in self.vocab if token in t]
+            id_sets.append(set().union(*(self.tokens[t] for t in matches)))
+        return self.intersect(id_sets)
+
+    @staticmethod
+    def vocab_range(sorted_vocab, prefix):
+        start = bisect.bisect_left(sorted_vocab, prefix)
+        for i in range(start, len(sorted_vocab)):
+            if not sorted_vocab[i].startswith(prefix):
+                break
+            yield sorted_vocab[i]
+
+    @staticmethod
+    def intersect(id_sets):
+        id_sets = sorted(id_sets, key=len)
+        if not id_sets:
+            return set()
+        return id_sets[0].intersection(*id_sets[1:])
+
+    @staticmethod
+    def verify(candidates, fields, regex, limit):
+        result = []
+        for id in sorted(set(candidates)):
+            if regex.search(fields[id]):
+                result.append(id)
+                if len(result) == limit:
+                    break
+        return result
+
+
+class IndexBackend(object):
+    '''Answers search tiers from a process-wide `SearchIndex`.'''
+
+    def alutiiq_ids(self, query, tier, limit):
+        return get_index().alutiiq_ids(query, tier, limit)
+
+    def english_ids(self, query, tier, limit):
+        return get_index().english_ids(query, tier, limit)
+
+
+INDEX = None
+INDEX_BUILT = 0.0
+INDEX_VERSION = None
+INDEX_LOCK = threading.Lock()
+
+
+def get_index():
+    '''
+    Return the process-wide search index, building it from the database the
+    first time and again when the lexicon version (see caching.py) has moved
+    on or the index is older than `SEARCH_INDEX_MAX_AGE` seconds (to pick up
+    edits made by other server processes).
+    '''
+    global INDEX, INDEX_BUILT, INDEX_VERSION
+    max_age = getattr(settings, 'SEARCH_INDEX_MAX_AGE', 300)
+    version = lexicon_version()
+    with INDEX_LOCK:
+        if INDEX is None or INDEX_VERSION != version or time.time() - INDEX_BUILT > max_age:
+            INDEX = build_index()
+            INDEX_BUILT = time.time()
+            INDEX_VERSION = version
+        return INDEX
+
+
+def build_index():
+    from .models import Entry
+    index = SearchIndex()
+    rows = Entry.objects.values_list('id', 'search_word', 'search_text')
+    for id, search_word, search_text in rows.iterator():
+        index.add(id, search_word, search_text)
+    return index
+
+
+def invalidate_index():
+    '''Force a rebuild on the next search (after bulk changes to entries).'''
+    global INDEX
+    with INDEX_LOCK:
+        INDEX = None
+
+
+HEADWORDS = None
+HEADWORDS_LOADED = 0.0
+HEADWORDS_VERSION = None
+
+
+def get_headwords():
+    '''
+    The distinct headwords of visible entries, sorted, loaded once per
+    process and again when the lexicon version has moved on or the list is
+    older than `SEARCH_INDEX_MAX_AGE` seconds, like the index.
+    '''
+    global HEADWORDS, HEADWORDS_LOADED, HEADWORDS_VERSION
+    from .models import Entry
+
+    max_age = getattr(settings, 'SEARCH_INDEX_MAX_AGE', 300)
+    version = lexicon_version()
+    with INDEX_LOCK:
+        if (HEADWORDS is None or HEADWORDS_VERSION != version or
+                time.time() - HEADWORDS_LOADED > max_age):
+            HEADWORDS = list(Entry.objects.filter(hidden=False)
+                                          .order_by('entry')
+                                          .values_list('entry', flat=True)
+                                          .distinct())
+            HEADWORDS_LOADED = time.time()
+            HEADWORDS_VERSION = version
+        return HEADWORDS
+
+
+def version_changed(old, new):
+    '''
+    Called when this process moves the lexicon version on. Its own changes
+    to entries reach the index through index_entry and unindex_entry (or
+    invalidate_index), so an index that was current stays current.
+    '''
+    global INDEX_VERSION
+    with INDEX_LOCK:
+        if INDEX_VERSION == old:
+            INDEX_VERSION = new
+
+
+def index_entry(entry):
+    '''Bring the index up to date after `entry` has been saved.'''
+    if INDEX is not None:
+        INDEX.add(entry.pk, entry.search_word, entry.search_text)
+
+
+def unindex_entry(entry_id):
+    if INDEX is not None:
+        INDEX.remove(entry_id)
+
+
+def get_backend():
+    if getattr(settings, 'SEARCH_INDEX', True):
+        return IndexBackend()
+    elif connection.vendor == 'postgresql':
+        return PostgresBackend()
+    else:
+        return RegexBackend()
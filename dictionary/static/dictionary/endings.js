@@ -12,6 +12,49 @@ var PopoutState = function($popout) {
     this.row_span = {};
     this.col_span = {};
     this.collapse = {};
+    // Pages rendered with only the default cells give the URL of the full
+    // tables, which are fetched the first time a cell is clicked.
+    this.endings_url = $popout.attr("data-endings-url");
+    this.loaded = !this.endings_url;
+    this.loading = false;
+
+    this.load = function(callback) {
+        var state = this;
+        if (state.loaded) {
+            callback();
+            return;
+        }
+        if (state.loading)
+            return;
+
+        state.loading = true;
+        $popout.find(".endings-error").remove();
+        $.getJSON(state.endings_url, function(data) {
+            $popout.find("table.inflection").map(function() {
+                var cells = data.tables[$(this).attr("id")] || {};
+                $(this).find(".ientry").map(function() {
+                    var forms = cells[$(this).attr("id")];
+                    if (forms === undefined)
+                        return;
+                    var $cell = $(this).empty();
+                    for (var id in forms) {
+                        if (forms.hasOwnProperty(id)) {
+                            $cell.append($('<span class="iopt"></span>').attr("id", id).text(forms[id]));
+                        }
+                    }
+                });
+            });
+            state.loaded = true;
+            callback();
+        }).fail(function() {
+            // Leave the default cells as they are; the next click tries again.
+            $popout.find(".popout-content").prepend(
+                $('<p class="endings-error"></p>').text(
+                    "Sorry, the other endings couldn't be loaded. Click a cell to try again."));
+        }).always(function() {
+            state.loading = false;
+        });
+    }
 
     this.remove_ids = function(id) {
         var pieces = id.split(":");
@@ -131,7 +174,10 @@ $(document).ready(function() {
     $(".ientry").click(function(event) {
         var popout_id = $(this).closest(".popout").attr("id");
         var id = $(this).attr("id");
-        endings.state[popout_id].activate_cell(id);
+        var state = endings.state[popout_id];
+        state.load(function() {
+            state.activate_cell(id);
+        });
     });
 
     if($(".popout-content").length > 1) {
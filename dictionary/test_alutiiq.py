@@ -313,6 +313,65 @@ class TestPastMap(unittest.TestCase):
         self.assertEqual(PAST_MAP['-llria'], '+[+t]uq')
 
 
+class TestMorphoEngine(unittest.TestCase):
+    def test_shared_cache(self):
+        from .alutiiq import MorphoEngine, get_endings_map
+        engine = MorphoEngine()
+        expected = get_endings_map('nallu', 'vt')
+        self.assertEqual(get_endings_map('nallu', 'vt', engine=engine), expected)
+        before = engine.stats()['join']
+        self.assertEqual(get_endings_map('nallu', 'vt', engine=engine), expected)
+        after = engine.stats()['join']
+        self.assertEqual(after['misses'], before['misses'])
+        self.assertGreater(after['hits'], before['hits'])
+
+    def test_bounded(self):
+        from .alutiiq import MorphoEngine
+        engine = MorphoEngine(maxsize=2)
+        for root in ['nallu', 'silug', 'yaamar']:
+            engine.join([root, '~aqa'])
+        self.assertEqual(engine.stats()['join']['size'], 2)
+        engine.clear()
+        self.assertEqual(engine.stats()['join']['size'], 0)
+
+
+class TestTables(unittest.TestCase):
+    def test_matches_naive_tables(self):
+        from .alutiiq import get_endings_map
+        from .benchmarks import ROOTS, naive_build_rows, table_rows
+        for pos, root in ROOTS.items():
+            endings_map = get_endings_map(root, pos)
+            self.assertEqual(table_rows(pos, endings_map),
+                             table_rows(pos, endings_map, naive_build_rows), pos)
+
+
+class TestNormalize(unittest.TestCase):
+    def test_matches_naive_normalize(self):
+        from .alutiiq import normalize
+        from .benchmarks import fixture_words, naive_normalize
+        words = fixture_words() + ["RuuR'eaaeiQ", 'nggg', 'Gg', "'R", 'EeE', '']
+        for g_and_r in (True, False):
+            expected = [naive_normalize(w, g_and_r) for w in words]
+            self.assertEqual([normalize(w, g_and_r) for w in words], expected)
+
+
+class TestOrthoTransformer(unittest.TestCase):
+    def test_longest_key_wins(self):
+        from .combined_ortho import OrthoTransformer
+        fix = OrthoTransformer([('n', 'N'), ('ng', 'ŋ'), ('nng', 'Ŋ')])
+        self.assertEqual(fix('nnga nga na'), 'Ŋa ŋa Na')
+
+    def test_stream_matches_naive(self):
+        import io
+        from .combined_ortho import OrthoTransformer
+        from .benchmarks import ORTHO_TABLE, fixture_words, naive_transform
+        table = dict(sorted(ORTHO_TABLE.items(), key=lambda item: -len(item[0])))
+        text = ''.join('\\lx\t{}\n'.format(word) for word in fixture_words())
+        outfile = io.StringIO()
+        OrthoTransformer(table).transform_stream(io.StringIO(text), outfile, chunk_size=100)
+        self.assertEqual(outfile.getvalue(), naive_transform(table, text))
+
+
 if __name__ == '__main__':
     import nose
     nose.main()
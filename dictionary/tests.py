@@ -1,3 +1,1004 @@
-from django.test import TestCase
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
-# Create your tests here.
+import gzip
+import io
+import json
+import os
+import tempfile
+import time
+from contextlib import redirect_stderr, redirect_stdout
+from datetime import timedelta
+from unittest import mock, skipUnless
+
+from . import (analytics, backups, caching, geolocation, init_fixture, paradigms,
+               parse_combined, save_all, search, weekly_summary)
+from .alutiiq import get_endings_map
+from .models import Entry, Example, Paradigm, RequestRollup, Source, Variety
+from .models import EntryExampleInfo, EntryVarietyInfo, ExampleVarietyInfo, SeeAlso
+from .views import QUERY_CACHE, RelevanceScorer, root_to_id, search_listings, word_of_the_day
+
+
+# Only AnalyticsTest counts requests (see there).
+NO_ANALYTICS = override_settings(ANALYTICS=False)
+
+
+def setUpModule():
+    NO_ANALYTICS.enable()
+
+
+def tearDownModule():
+    NO_ANALYTICS.disable()
+
+
+WORDS = [
+    ('giinaq', 'a letter, character'),
+    ('giinaqs', 'letters'),
+    ('kuRuq', 'it is dry'),
+    ('nalluluku', 'to not know ~it~'),
+    ('liilluni', 'to learn; to study'),
+    ('piugta', 'dog'),
+    ('taqukaraq', 'brown bear'),
+    ('ang-', 'to be big'),
+]
+
+QUERIES = ['giinaq', 'ginaq', 'iinaq', 'kuruq', 'kuRuq', 'ang', 'ng', 'a', 'lu',
+           'letter', 'lett', 'ter', 'to be', 'not know', 'it~', 'bear', 'dog', '-']
+
+
+class SearchIndexTest(TestCase):
+    def setUp(self):
+        search.invalidate_index()
+        for word, defn in WORDS:
+            Entry(entry=word, defn=defn).save()
+
+    def tearDown(self):
+        search.invalidate_index()
+
+    def test_index_matches_regex_search(self):
+        regex_backend = search.RegexBackend()
+        index_backend = search.IndexBackend()
+        for query in QUERIES:
+            for tier, _ in search.ALUTIIQ_TIERS:
+                self.assertEqual(index_backend.alutiiq_ids(query, tier, 1000),
+                                 sorted(regex_backend.alutiiq_ids(query, tier, 1000)),
+                                 (query, tier))
+            for tier, _ in search.ENGLISH_TIERS:
+                self.assertEqual(index_backend.english_ids(query, tier, 1000),
+                                 sorted(regex_backend.english_ids(query, tier, 1000)),
+                                 (query, tier))
+
+    def test_limit_skips_tier(self):
+        # Two words contain 'lu', so that tier is dropped at a limit of two.
+        self.assertEqual(search.find_entry_ids('lu', limit=2), [])
+        self.assertEqual(len(search.find_entry_ids('lu', limit=3)), 2)
+
+    def test_save_updates_index(self):
+        search.get_index()
+        entry = Entry(entry='tamaa', defn='that one')
+        entry.save()
+        self.assertEqual(search.find_entry_ids('tamaa'), [entry.id] * 4)
+
+        entry.defn = 'this one'
+        entry.save()
+        self.assertEqual(search.find_entry_ids('that'), [])
+        self.assertEqual(search.find_entry_ids('this'), [entry.id] * 3)
+
+        entry.delete()
+        self.assertEqual(search.find_entry_ids('tamaa'), [])
+
+    @override_settings(SEARCH_INDEX=False)
+    def test_regex_backend(self):
+        self.assertIsInstance(search.get_backend(), search.RegexBackend)
+        self.assertEqual(len(search.find_entry_ids('dog')), 3)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'needs Postgres')
+class PostgresSearchTest(TestCase):
+    def setUp(self):
+        for word, defn in WORDS + [('kuRuq', 'it is (very) dry'), ('tamaa', 'the dog/cat'),
+                                   ('piugtaq', 'dog_food; dog-like')]:
+            Entry(entry=word, defn=defn).save()
+
+    @override_settings(SEARCH_INDEX=False)
+    def test_matches_regex_search(self):
+        self.assertIsInstance(search.get_backend(), search.PostgresBackend)
+        regex_backend = search.RegexBackend()
+        postgres_backend = search.PostgresBackend()
+        for query in QUERIES + ['dog food', 'dog-like', 'cat', 'very', '(very)']:
+            for tier, _ in search.ALUTIIQ_TIERS:
+                self.assertEqual(sorted(postgres_backend.alutiiq_ids(query, tier, 1000)),
+                                 sorted(regex_backend.alutiiq_ids(query, tier, 1000)),
+                                 (query, tier))
+            for tier, _ in search.ENGLISH_TIERS:
+                self.assertEqual(sorted(postgres_backend.english_ids(query, tier, 1000)),
+                                 sorted(regex_backend.english_ids(query, tier, 1000)),
+                                 (query, tier))
+
+
+class RelevanceTest(SimpleTestCase):
+    def test_scores(self):
+        scorer = RelevanceScorer('know')
+        cases = [
+            ('nalluluku', 'to not know ~it~', 40),
+            ('nallun', 'to know (something)', 50),
+            ('nallun', 'to understand; to know', 55),
+            ('nallun', 'knowledge', 20),
+            ('nallun', 'understanding (knowing)', 10),
+            ('nallun', 'understanding (not know)', 30),
+            ('know', 'unrelated', 60),
+        ]
+        for word, defn, score in cases:
+            self.assertEqual(scorer(Entry(entry=word, defn=defn)), (-score, word), defn)
+
+    def test_fuzzy_alutiiq(self):
+        scorer = RelevanceScorer('giinaq')
+        self.assertEqual(scorer.score(Entry(entry='giinaq', defn='letter')), 60)
+        self.assertEqual(scorer.score(Entry(entry='ginaq', defn='letter')), 45)
+        self.assertEqual(scorer.score(Entry(entry='ginaqa', defn='letter')), 33)
+        self.assertEqual(scorer.score(Entry(entry='tamaa', defn='that')), 0)
+
+
+class QueryCountTest(TestCase):
+    def setUp(self):
+        search.invalidate_index()
+        self.source = Source.objects.create(abbrev='T', description='Test source')
+        self.variety = Variety.objects.create(abbrev='K', description='Koniag')
+        self.main = Entry(entry='pingaq', defn='hook')
+        self.main.save()
+
+    def tearDown(self):
+        search.invalidate_index()
+
+    def add_senses(self, count):
+        for i in range(count):
+            chunk = Entry(entry='pingaqs', defn='fishhook %d' % i,
+                          source=self.source, main_entry=self.main)
+            chunk.save()
+            sub = Entry(entry='pingaqsuk%d' % i, defn='small hook', main_entry=chunk)
+            sub.save()
+            SeeAlso.objects.create(source=chunk, target=sub)
+            EntryVarietyInfo.objects.create(entry=chunk, variety=self.variety)
+            example = Example.objects.create(vernacular='pingaqs %d' % i, english='hook %d' % i,
+                                             source=self.source)
+            ExampleVarietyInfo.objects.create(example=example, variety=self.variety)
+            EntryExampleInfo.objects.create(entry=chunk, example=example)
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_constant_queries(self):
+        search.get_index()
+        self.add_senses(1)
+        entry_queries = self.count_queries('/ems/w/pingaqs/')
+        search_queries = self.count_queries('/ems/search/?q=fishhook')
+
+        self.add_senses(10)
+        self.assertEqual(self.count_queries('/ems/w/pingaqs/'), entry_queries)
+        self.assertEqual(self.count_queries('/ems/search/?q=fishhook'), search_queries)
+
+
+class PageCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        search.invalidate_index()
+        Entry(entry='nallu', defn='to not know').save()
+
+    def tearDown(self):
+        search.invalidate_index()
+
+    def test_cached_until_changed(self):
+        first = self.client.get('/ems/search/?q=know')
+        with self.assertNumQueries(0):
+            second = self.client.get('/ems/search/?q=know')
+        self.assertEqual(second.content, first.content)
+
+        Entry(entry='nalluluku', defn='to not know ~it~').save()
+        third = self.client.get('/ems/search/?q=know')
+        self.assertIn(b'nalluluku', third.content)
+        self.assertNotIn(b'nalluluku', first.content)
+
+    @override_settings(CACHE_SHARED=True)
+    def test_conditional_requests(self):
+        response = self.client.get('/ems/w/nallu/')
+        self.assertEqual(response['ETag'], '"{}"'.format(caching.lexicon_version()))
+        self.assertIn('no-cache', response['Cache-Control'])
+
+        not_modified = self.client.get('/ems/w/nallu/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        not_modified = self.client.get('/ems/w/nallu/',
+                                       HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(not_modified.status_code, 304)
+
+        Example.objects.create(vernacular='nallua', english='I do not know')
+        self.assertEqual(self.client.get('/ems/w/nallu/', HTTP_IF_NONE_MATCH=response['ETag'])
+                             .status_code, 200)
+
+    def test_no_conditional_requests_per_process(self):
+        response = self.client.get('/ems/w/nallu/')
+        self.assertNotIn('ETag', response)
+        self.assertNotIn('Last-Modified', response)
+        self.assertIn('no-cache', response['Cache-Control'])
+        self.assertEqual(self.client.get('/ems/w/nallu/', HTTP_IF_NONE_MATCH='"1"')
+                             .status_code, 200)
+
+    def test_version_outlives_pages(self):
+        version = caching.lexicon_version()
+        cache.clear()
+        self.assertEqual(caching.lexicon_version(), version)
+
+    def test_user_agent(self):
+        first = self.client.get('/ems/w/nallu/', HTTP_USER_AGENT='Browser/1.0 (A)')
+        second = self.client.get('/ems/w/nallu/', HTTP_USER_AGENT='Other/2.0')
+        self.assertIn(b'Browser/1.0%20%28A%29', first.content)
+        self.assertIn(b'Other/2.0', second.content)
+        self.assertNotIn(caching.USER_AGENT_PLACEHOLDER.encode('ascii'), second.content)
+        self.assertEqual(first.content.replace(b'Browser/1.0%20%28A%29', b'Other/2.0'),
+                         second.content)
+
+    def test_listing_fragments(self):
+        Entry(entry='nalluluku', defn='to not know ~it~').save()
+        Entry(entry='nalluluku', defn='to forget ~it~').save()
+        know = search_listings('know')
+        self.assertEqual(len(know), 2)
+        self.assertNotIn('forget', ''.join(know))
+        # Both words are cached with the same matching chunks, so only the
+        # ranking query is run.
+        with self.assertNumQueries(1):
+            self.assertEqual(search_listings('not know'), know)
+        # All of nalluluku matches here, which is a different listing.
+        nallu = search_listings('nallu')
+        self.assertEqual(nallu[0], know[0])
+        self.assertIn('forget', nallu[1])
+
+    def test_version_moves_again_on_commit(self):
+        version = caching.lexicon_version()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            Source.objects.create(abbrev='T', description='Test source')
+            changed = caching.lexicon_version()
+            self.assertGreater(changed, version)
+        self.assertEqual(len(callbacks), 1)
+        self.assertGreater(caching.lexicon_version(), changed)
+
+    def test_index_follows_version(self):
+        index = search.get_index()
+        Entry(entry='qayaq', defn='kayak').save()
+        # This process's own edits are applied to the index as they're made.
+        self.assertIs(search.get_index(), index)
+        # Edits made elsewhere only show up as a new version.
+        caches[caching.VERSION_CACHE].set(caching.VERSION_KEY, caching.lexicon_version() + 1,
+                                          timeout=None)
+        self.assertIsNot(search.get_index(), index)
+
+
+class QueryCacheTest(SimpleTestCase):
+    def test_popular_queries_stay(self):
+        results = caching.QueryCache(maxsize=4, window=4, version=lambda: 1)
+        for i in range(3):
+            results.get_or_compute('nallu', str.upper)
+        for i in range(20):
+            results.get_or_compute('once %d' % i, str.upper)
+        self.assertIn('nallu', results.entries)
+        self.assertEqual(results.stats()['evictions'], 17)
+
+    def test_counts_age(self):
+        results = caching.QueryCache(maxsize=2, window=2, version=lambda: 1)
+        for i in range(3):
+            results.get_or_compute('nallu', str.upper)
+        # Every 16 lookups halve the counts, until 'nallu' is as unpopular as the rest.
+        for i in range(40):
+            results.get_or_compute('once %d' % (i // 2), str.upper)
+        self.assertNotIn('nallu', results.entries)
+
+    def test_expiry(self):
+        now = [0.0]
+        results = caching.QueryCache(maxsize=2, timeout=300, version=lambda: 1,
+                                     clock=lambda: now[0])
+        results.get_or_compute('nallu', str.upper)
+        now[0] = 299.0
+        results.get_or_compute('nallu', str.upper)
+        now[0] = 300.0
+        results.get_or_compute('nallu', str.upper)
+        self.assertEqual((results.hits, results.misses), (1, 2))
+
+    def test_version_and_shared_cache(self):
+        version = [1]
+        shared = {}
+        fake_cache = mock.Mock(get=shared.get,
+                               set=lambda key, value, timeout: shared.update({key: value}))
+        computed = []
+
+        def compute(query):
+            computed.append(query)
+            return query.upper()
+
+        first = caching.QueryCache(shared=fake_cache, version=lambda: version[0])
+        second = caching.QueryCache(shared=fake_cache, version=lambda: version[0])
+        self.assertEqual(first.get_or_compute('nallu', compute), 'NALLU')
+        self.assertEqual(second.get_or_compute('nallu', compute), 'NALLU')
+        self.assertEqual(computed, ['nallu'])
+        self.assertEqual(second.stats()['shared_hits'], 1)
+
+        version[0] = 2
+        self.assertEqual(first.get_or_compute('nallu', compute), 'NALLU')
+        self.assertEqual(computed, ['nallu', 'nallu'])
+        self.assertEqual(first.stats()['size'], 1)
+
+
+class SearchCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        search.invalidate_index()
+        Entry(entry='nallu', defn='to not know').save()
+
+    def tearDown(self):
+        search.invalidate_index()
+
+    def test_cached_results(self):
+        listings = search_listings('know')
+        with self.assertNumQueries(0):
+            self.assertEqual(search_listings('know'), listings)
+        Entry(entry='nalluluku', defn='to not know ~it~').save()
+        self.assertEqual(len(search_listings('know')), 2)
+
+    def test_normalized_query(self):
+        listings = search_listings('know')
+        with self.assertNumQueries(0):
+            self.assertEqual(search_listings('  know '), listings)
+        self.assertIn('know', QUERY_CACHE.entries)
+        self.assertNotIn('  know ', QUERY_CACHE.entries)
+        self.assertEqual(search_listings(' '), [])
+
+    def test_stale_ranking(self):
+        self.assertEqual(len(search_listings('know')), 1)
+        # Renamed without telling this process, and the listing has expired.
+        Entry.objects.filter(entry='nallu').update(entry='nalluq')
+        cache.clear()
+        self.assertEqual(search_listings('know'), [])
+
+    def test_warmsearch(self):
+        for query, count in [('know', 3), ('nallu', 2), ('qayaq', 1)]:
+            for i in range(count):
+                analytics.BUFFER.record('/ems/search/?q=' + query, 200, '10.0.0.1', 5)
+        analytics.BUFFER.flush()
+        out = io.StringIO()
+        call_command('warmsearch', '--top', '2', stdout=out, stderr=io.StringIO())
+        self.assertIn('2 searches', out.getvalue())
+        self.assertIn('know', QUERY_CACHE.entries)
+        self.assertIn('nallu', QUERY_CACHE.entries)
+        self.assertNotIn('qayaq', QUERY_CACHE.entries)
+
+
+class RandomWordTest(TestCase):
+    def setUp(self):
+        search.invalidate_index()
+        for word in ['nallu', 'qayaq', 'taqukaq']:
+            Entry(entry=word, defn='a word').save()
+        Entry(entry='qayaq', defn='kayak').save()
+        Entry(entry='giinaq', defn='a hidden word', hidden=True).save()
+
+    def test_random_entry(self):
+        self.assertEqual(search.get_headwords(), ['nallu', 'qayaq', 'taqukaq'])
+        seen = set()
+        with self.assertNumQueries(0):
+            for i in range(30):
+                response = self.client.get('/ems/random/')
+                self.assertEqual(response.status_code, 302)
+                seen.add(response['Location'])
+        self.assertEqual(seen, {'/ems/w/nallu/', '/ems/w/qayaq/', '/ems/w/taqukaq/'})
+
+        Entry.objects.get(entry='nallu').delete()
+        self.assertEqual(search.get_headwords(), ['qayaq', 'taqukaq'])
+
+    def test_word_of_the_day(self):
+        day = timezone.localdate()
+        word = word_of_the_day(day)
+        self.assertIn(word, ['nallu', 'qayaq', 'taqukaq'])
+        self.assertEqual(word_of_the_day(day), word)
+        self.assertEqual(len({word_of_the_day(day + timedelta(days=i)) for i in range(20)}), 3)
+
+        response = self.client.get('/ems/today/')
+        self.assertEqual(response['Location'], '/ems/w/{}/'.format(word))
+        max_age = int(response['Cache-Control'].split('max-age=')[1])
+        self.assertTrue(0 <= max_age <= 25 * 60 * 60)
+
+class ParadigmStoreTest(TestCase):
+    def test_get_paradigms(self):
+        expected = get_endings_map('nallu', 'vt')
+        self.assertEqual(paradigms.get_paradigms([('nallu', 'vt')]), {('nallu', 'vt'): expected})
+        stored = Paradigm.objects.get(root='nallu', pos='vt')
+        self.assertEqual(json.loads(stored.forms), expected)
+
+        # Rows built from different ending tables are regenerated.
+        stored.rules_hash = 'old'
+        stored.forms = '{}'
+        stored.save()
+        self.assertEqual(paradigms.get_paradigms([('nallu', 'vt')])[('nallu', 'vt')], expected)
+        self.assertEqual(Paradigm.objects.get(root='nallu', pos='vt').rules_hash,
+                         paradigms.RULES_HASH)
+
+    def test_fill_and_discard(self):
+        entry = Entry(entry='silugluni', defn='to be stubborn')
+        entry.save()
+        paradigms.fill_paradigms()
+        self.assertEqual(list(Paradigm.objects.values_list('root', 'pos')), [('silug', 'vi')])
+
+        entry.root = 'silu'
+        entry.save()
+        self.assertFalse(Paradigm.objects.exists())
+
+    def test_discard_after_loading(self):
+        Entry(entry='silugluni', defn='to be stubborn').save()
+        paradigms.fill_paradigms()
+        entry = Entry.objects.get(entry='silugluni')
+        entry.defn = 'to be very stubborn'
+        with self.assertNumQueries(1):
+            entry.save()
+        entry.root = 'silu'
+        entry.save()
+        self.assertFalse(Paradigm.objects.exists())
+
+    def test_discard_without_root(self):
+        paradigms.store(Paradigm(root='', pos='n'), {})
+        paradigms.discard_unused('None', 'n')
+        self.assertFalse(Paradigm.objects.exists())
+
+    def test_generate_paradigms(self):
+        pairs = [('nallu', 'vt'), ('silug', 'vi'), ('nallu', 'vt'), ('kuRu', 'adv')]
+        rows = []
+        count = paradigms.generate_paradigms(pairs, callback=rows.append, processes=2)
+        self.assertEqual(count, len(rows))
+        expected = [(root, pos, tag, form)
+                    for root, pos in [('silug', 'vi'), ('nallu', 'vt')]
+                    for tag, form in get_endings_map(root, pos).items()]
+        self.assertEqual(rows, expected)
+        self.assertEqual(paradigms.build_paradigms(pairs, processes=1),
+                         {key: get_endings_map(*key) for key in [('nallu', 'vt'), ('silug', 'vi')]})
+
+
+class EndingsApiTest(TestCase):
+    def setUp(self):
+        Entry(entry='nalluluku', defn='to not know ~it~').save()
+        self.url = '/ems/w/nalluluku/endings/?root=' + root_to_id('vt', 'nallu')
+
+    def test_all_tables(self):
+        tables = self.client.get(self.url).json()['tables']
+        self.assertEqual(list(tables), ['tense', 'subject', 'object'])
+        self.assertEqual(tables['tense']['PRES:POS']['O3P:OSG:S1P:SSG'], 'nalluwaqa')
+
+    def test_table_and_cell(self):
+        tables = self.client.get(self.url + '&table=tense&cell=PAST:POS').json()['tables']
+        self.assertEqual(list(tables), ['tense'])
+        self.assertEqual(list(tables['tense']), ['PAST:POS'])
+        self.assertEqual(tables['tense']['PAST:POS']['O3P:OSG:S1P:SSG'], "nalluk'gka")
+
+        self.assertEqual(self.client.get(self.url + '&table=tense&cell=NOPE').status_code, 404)
+        self.assertEqual(self.client.get(self.url + '&table=nope').status_code, 404)
+        self.assertEqual(self.client.get('/ems/w/nalluluku/endings/?root=n-x').status_code, 404)
+
+    def test_subdir_and_cache(self):
+        response = self.client.get(self.url[len('/ems'):])
+        self.assertRedirects(response, self.url, fetch_redirect_response=False)
+        first = self.client.get(self.url)
+        with self.assertNumQueries(0):
+            second = self.client.get(self.url)
+        self.assertEqual(second['Content-Type'], 'application/json')
+        self.assertEqual(second.json(), first.json())
+
+    def test_lazy_entry_page(self):
+        full = self.client.get('/ems/w/nalluluku/').content.decode('utf-8')
+        # The same URL, so bypass the page cache.
+        with override_settings(LAZY_ENDING_TABLES=True, PAGE_CACHE=False):
+            lazy = self.client.get('/ems/w/nalluluku/').content.decode('utf-8')
+        self.assertNotIn('data-endings-url', full)
+        self.assertIn('data-endings-url', lazy)
+        self.assertIn('nalluwaqa', lazy)
+        # One form per cell, the one shown before anything is clicked.
+        self.assertEqual(lazy.count('class="iopt"'), lazy.count('class="ientry"'))
+        self.assertGreater(full.count('class="iopt"'), full.count('class="ientry"'))
+        self.assertLess(len(lazy), len(full) / 5)
+
+
+MDF_SAMPLE = """\\_sh\tv3.0  400  MDF 4.0
+
+\\lx\tagayuun
+\\ps\tn
+\\de\tgod
+\\dl\tK KOD
+\\xv\tAgayuun tang'rqa.
+\\xe\tI see god.
+\\dl\tC
+\\se\tagayuwik
+\\ps\tn
+\\de\tchurch
+\\dl\tPWS [N]
+\\va\tagayuwig
+\\lx\tikayuq
+\\ps\tvt
+\\de\tto help
+\\xv\tIkayurru.
+\\xe\tHelp him.
+"""
+
+
+class PopulateDbTest(TestCase):
+    def populate(self, mdf):
+        with redirect_stdout(io.StringIO()):
+            entries, examples = parse_combined.parse_combined(io.StringIO(mdf))
+            parse_combined.populate_db(entries, examples, batch_size=2)
+
+    def test_bulk_import(self):
+        search.invalidate_index()
+        Entry(entry='tamaa', defn='that one').save()
+        self.populate(MDF_SAMPLE)
+
+        self.assertEqual(Entry.objects.count(), 5)
+        church = Entry.objects.get(entry='agayuwik')
+        self.assertEqual(church.main_entry.entry, 'agayuun')
+        self.assertEqual(church.pos_final, 'n')
+        self.assertEqual(Entry.objects.get(entry='agayuwig').main_entry, church)
+        self.assertEqual(sorted(EntryVarietyInfo.objects.values_list('variety__abbrev', flat=True)),
+                         ['C', 'K', 'KOD', 'PWS'])
+        self.assertEqual(Entry.objects.get(entry='ikayuq').examples.get().english, 'Help him.')
+        self.assertEqual(len(search.find_entry_ids('ikayuq')), 4)
+
+        # New rows get ids after the imported ones.
+        last_id = Entry.objects.order_by('-id')[0].id
+        later = Entry(entry='tamaat', defn='those')
+        later.save()
+        self.assertEqual(later.id, last_id + 1)
+
+    def test_resume_from_checkpoint(self):
+        checkpoint = os.path.join(tempfile.mkdtemp(), 'sample.mdf.checkpoint')
+        populate_batch = parse_combined.populate_batch
+
+        def fail_on_second_record(records):
+            if records[0][0][0].entry == 'ikayuq':
+                raise RuntimeError('connection lost')
+            return populate_batch(records)
+
+        with redirect_stdout(io.StringIO()):
+            with mock.patch.object(parse_combined, 'populate_batch', fail_on_second_record):
+                with self.assertRaises(RuntimeError):
+                    parse_combined.import_combined(io.StringIO(MDF_SAMPLE), checkpoint,
+                                                   records_per_batch=1)
+            self.assertEqual(Entry.objects.count(), 3)
+            with open(checkpoint) as infile:
+                self.assertEqual(infile.read(), '1\n')
+
+            parse_combined.import_combined(io.StringIO(MDF_SAMPLE), checkpoint, records_per_batch=1)
+        self.assertEqual(sorted(Entry.objects.values_list('entry', flat=True)),
+                         ['agayuun', 'agayuwig', 'agayuwik', 'ikayuq'])
+        self.assertFalse(os.path.exists(checkpoint))
+
+    def test_numbered_senses(self):
+        self.populate('\\lx\tnallu$1\n\\ps\tvt\n\\de\tto not know\n\\al\tto be unaware\n')
+        self.assertEqual(sorted(Entry.objects.values_list('defn', flat=True)),
+                         ['1a. to not know', '1b. to be unaware'])
+
+    def test_main_entries_inserted_first(self):
+        inserted = []
+        create = Entry.objects.bulk_create
+
+        def bulk_create(rows, *args, **kwargs):
+            inserted.extend(rows)
+            return create(rows, *args, **kwargs)
+
+        with mock.patch.object(Entry.objects, 'bulk_create', bulk_create):
+            self.populate(MDF_SAMPLE)
+        self.assertEqual(sorted(row.entry for row in inserted),
+                         ['agayuun', 'agayuwig', 'agayuwik', 'ikayuq'])
+        for i, row in enumerate(inserted):
+            if row.main_entry_id is not None:
+                self.assertIn(row.main_entry_id, [earlier.id for earlier in inserted[:i]])
+
+        # A subentry is added before its main entry when that is reached
+        # through it; its id stays lower, but it's inserted after.
+        rows = [Entry(id=1, main_entry_id=3), Entry(id=2, main_entry_id=9),
+                Entry(id=3, main_entry_id=4), Entry(id=4)]
+        self.assertEqual([row.id for row in parse_combined.parents_first(rows)], [2, 4, 3, 1])
+
+    def test_diff_import(self):
+        self.populate(MDF_SAMPLE)
+        god = Entry.objects.get(entry='agayuun')
+        god.comments = 'edited in the admin'
+        god.save()
+        church_id = Entry.objects.get(entry='agayuwik').id
+        help_id = Entry.objects.get(entry='ikayuq').id
+        Entry.objects.filter(id=help_id).update(hidden=True)
+
+        changed = (MDF_SAMPLE.replace('to help', 'to help, assist')
+                             .replace('\\dl\tPWS [N]\n', '\\dl\tPWS\n') +
+                   '\\lx\ttamaa\n\\ps\tdem\n\\de\tthat one\n')
+        changed = changed.replace('\\va\tagayuwig\n', '')
+
+        def diff(mdf, dry_run=False):
+            with redirect_stdout(io.StringIO()):
+                entries, examples = parse_combined.parse_combined(io.StringIO(mdf))
+                return parse_combined.diff_db(entries, dry_run=dry_run)
+
+        counts = diff(changed, dry_run=True)
+        self.assertEqual(counts, {'unchanged': 1, 'inserted': 1, 'updated': 2, 'deleted': 1})
+        self.assertEqual(Entry.objects.count(), 4)
+
+        diff(changed)
+        self.assertEqual(sorted(Entry.objects.values_list('entry', flat=True)),
+                         ['agayuun', 'agayuwik', 'ikayuq', 'tamaa'])
+        self.assertEqual(Entry.objects.get(entry='agayuun').comments, 'edited in the admin')
+        church = Entry.objects.get(entry='agayuwik')
+        self.assertEqual(church.id, church_id)
+        self.assertEqual(church.main_entry.entry, 'agayuun')
+        self.assertEqual(list(church.varieties.values_list('abbrev', flat=True)), ['PWS'])
+        help = Entry.objects.get(entry='ikayuq')
+        self.assertEqual(help.defn, 'to help, assist')
+        self.assertEqual(help.id, help_id)
+        self.assertTrue(help.hidden)
+        self.assertEqual(help.examples.get().english, 'Help him.')
+        self.assertEqual(Example.objects.count(), 2)
+        self.assertIn(Entry.objects.get(entry='tamaa').id, search.find_entry_ids('tamaa'))
+
+        self.assertEqual(diff(changed),
+                         {'unchanged': 4, 'inserted': 0, 'updated': 0, 'deleted': 0})
+
+    def test_diff_legacy_keys(self):
+        self.populate(MDF_SAMPLE)
+        with redirect_stdout(io.StringIO()):
+            entries, examples = parse_combined.parse_combined(io.StringIO(MDF_SAMPLE))
+        parse_combined.fingerprint(entries)
+        ids = {}
+        for key, (entry, hash) in parse_combined.legacy_fingerprints(entries).items():
+            ids[entry.key] = Entry.objects.get(mdf_key=entry.key).id
+            Entry.objects.filter(mdf_key=entry.key).update(mdf_key=key, mdf_hash=hash)
+
+        with redirect_stdout(io.StringIO()):
+            counts = parse_combined.diff_db(entries)
+        self.assertEqual(counts, {'unchanged': 4, 'inserted': 0, 'updated': 0, 'deleted': 0})
+        self.assertEqual(dict(Entry.objects.values_list('mdf_key', 'id')), ids)
+
+
+class SaveAllTest(TestCase):
+    def refresh(self, **kwargs):
+        with redirect_stdout(io.StringIO()):
+            return save_all.save_all(processes=1, chunk_size=2, **kwargs)
+
+    def test_refresh_changed_rows(self):
+        words = []
+        for word, defn in [('taqukaq', 'bear'), ('ikayurluku', 'to help'), ('tamaa', 'that one')]:
+            entry = Entry(entry=word, defn=defn)
+            entry.save()
+            words.append(entry)
+        self.assertEqual(self.refresh(), 0)
+
+        Entry.objects.update(search_word='', root_auto='x', root_final='x')
+        Entry.objects.filter(id=words[0].id).update(modified=timezone.now() - timedelta(days=2))
+        self.assertEqual(self.refresh(since_id=words[1].id), 2)
+        self.assertEqual(Entry.objects.get(id=words[0].id).search_word, '')
+        self.assertEqual(self.refresh(since=timezone.now() - timedelta(days=1)), 0)
+
+        self.assertEqual(self.refresh(), 1)
+        bear = Entry.objects.get(id=words[0].id)
+        self.assertEqual((bear.search_word, bear.root_final), ('takukak', 'taqukar'))
+        self.assertEqual(self.refresh(), 0)
+
+
+class BackupTest(TestCase):
+    def setUp(self):
+        with redirect_stdout(io.StringIO()):
+            entries, examples = parse_combined.parse_combined(io.StringIO(MDF_SAMPLE))
+            parse_combined.populate_db(entries, examples)
+        # A main entry with a higher id than its sub-entry.
+        main = Entry(entry='agayuut', defn='gods')
+        main.save()
+        Entry.objects.filter(entry='agayuun').update(main_entry=main)
+        SeeAlso(source=main, target=Entry.objects.get(entry='ikayuq')).save()
+        self.path = os.path.join(tempfile.mkdtemp(), 'backup.jsonl.gz')
+
+    def snapshot(self):
+        return {model: list(model.objects.order_by('id').values())
+                for model in backups.get_models()}
+
+    def test_round_trip(self):
+        before = self.snapshot()
+        call_command('dumplexicon', self.path, stdout=io.StringIO())
+        with gzip.open(self.path, 'rt', encoding='utf-8') as infile:
+            lines = [json.loads(line) for line in infile]
+        self.assertEqual(lines[0], {'format': 'lexicon', 'version': 1})
+        self.assertIn({'end': 'dictionary.entry', 'count': 5, 'sha1': mock.ANY}, lines)
+
+        with self.assertRaises(CommandError):
+            call_command('loadlexicon', self.path, stdout=io.StringIO())
+        Entry.objects.all().delete()
+        call_command('loadlexicon', self.path, '--replace', stdout=io.StringIO())
+        self.assertEqual(self.snapshot(), before)
+
+        later = Entry(entry='tamaa', defn='that one')
+        later.save()
+        self.assertEqual(later.id, max(row['id'] for row in before[Entry]) + 1)
+
+    def test_checksum_mismatch(self):
+        backups.dump_lexicon(self.path)
+        with gzip.open(self.path, 'rt', encoding='utf-8') as infile:
+            text = infile.read()
+        with gzip.open(self.path, 'wt', encoding='utf-8') as outfile:
+            outfile.write(text.replace('Help him.', 'Help her.'))
+
+        before = self.snapshot()
+        with self.assertRaisesRegex(ValueError, 'dictionary.example: checksum'):
+            backups.load_lexicon(self.path, replace=True)
+        self.assertEqual(self.snapshot(), before)
+
+
+class InitFixtureTest(TestCase):
+    LINES = [
+        'ukuaq\t\tdaughter-in-law\tFP (130708 0:20)\t\n',
+        'angayuq\t\tfriend\n',
+        'a\tb\tc\td\te\tf\n',
+    ]
+
+    def test_fixture(self):
+        outfile = io.StringIO()
+        with redirect_stdout(io.StringIO()) as output:
+            init_fixture.write_fixture(init_fixture.convert(self.LINES, {'FP': 3}), outfile)
+        self.assertIn('Malformed line', output.getvalue())
+        fixture = json.loads(outfile.getvalue())
+        self.assertEqual([obj['pk'] for obj in fixture], [1, 2])
+        self.assertEqual(fixture[0]['fields']['source'], 3)
+        self.assertEqual(fixture[0]['fields']['source_info'], '(130708 0:20)')
+        self.assertEqual(fixture[1]['fields']['search_word'], 'angaiuk')
+
+    def test_load(self):
+        source = Source(abbrev='FP', description='Florence Pestrikoff')
+        source.save()
+        with redirect_stdout(io.StringIO()):
+            count = init_fixture.load_rows(init_fixture.convert(self.LINES, {'FP': source.id}))
+        self.assertEqual(count, 2)
+        friend = Entry.objects.get(entry='angayuq')
+        self.assertEqual((friend.pos_final, friend.root_final), ('n', 'angayur'))
+        self.assertEqual(Entry.objects.get(entry='ukuaq').source, source)
+        self.assertIn(friend.id, search.find_entry_ids('angayuq'))
+
+
+class FakeResponse(object):
+    def __init__(self, data, remaining=10):
+        self.data = data
+        self.headers = {'X-Rl': str(remaining), 'X-Ttl': '30'}
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.requests = []
+
+    def post(self, url, params=None, json=None, timeout=None):
+        self.requests.append(json)
+        if '192.0.2.1' in json:
+            raise IOError('connection reset')
+        return FakeResponse([{'status': 'success', 'query': ip, 'city': 'Kodiak',
+                              'regionName': 'Alaska', 'country': 'United States',
+                              'district': '', 'proxy': False}
+                             for ip in json])
+
+
+class GeolocationTest(SimpleTestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'geolocation.json')
+        self.now = 1000.0
+
+    def cache(self):
+        return geolocation.GeoCache(self.path, ttl=100, clock=lambda: self.now)
+
+    def test_cache(self):
+        backend = geolocation.StubBackend({'10.0.0.1': 'Kodiak'})
+        self.assertEqual(geolocation.locate(['10.0.0.1', '10.0.0.2'], backend, self.cache()),
+                         {'10.0.0.1': 'Kodiak', '10.0.0.2': 'unknown'})
+
+        self.now += 50
+        location_map = geolocation.get_location_map(['10.0.0.2', '10.0.0.1', '10.0.0.3'],
+                                                    backend, self.cache())
+        self.assertEqual(location_map, {'unknown': ['10.0.0.2', '10.0.0.3'],
+                                        'Kodiak': ['10.0.0.1']})
+        self.assertEqual(backend.calls, [['10.0.0.1', '10.0.0.2'], ['10.0.0.3']])
+
+        self.now += 75
+        geolocation.locate(['10.0.0.1', '10.0.0.3'], backend, self.cache())
+        self.assertEqual(backend.calls[-1], ['10.0.0.1'])
+
+    def test_ip_api_batches(self):
+        session = FakeSession()
+        limiter = geolocation.RateLimiter(60, clock=lambda: 0.0, sleep=lambda secs: None)
+        backend = geolocation.IpApiBackend(session, limiter, retries=2)
+        ips = ['10.0.{}.{}'.format(i // 256, i % 256) for i in range(250)] + ['192.0.2.1']
+        with redirect_stderr(io.StringIO()):
+            locations = geolocation.locate(ips, backend, self.cache())
+        # The last batch fails twice and is given up on.
+        self.assertEqual(sorted(len(batch) for batch in session.requests), [51, 51, 100, 100])
+        self.assertEqual(locations['10.0.0.1'], 'Kodiak, Alaska, United States')
+        self.assertEqual(locations['192.0.2.1'], 'unknown')
+        self.assertEqual(self.cache().get('10.0.0.1'), 'Kodiak, Alaska, United States')
+        self.assertIsNone(self.cache().get('192.0.2.1'))
+
+    def test_rate_limiter(self):
+        now = [0.0]
+
+        def sleep(secs):
+            # Other threads can take their slots meanwhile.
+            self.assertFalse(limiter.lock.locked())
+            now[0] += secs
+
+        limiter = geolocation.RateLimiter(30, clock=lambda: now[0], sleep=sleep)
+        limiter.wait()
+        limiter.wait()
+        self.assertEqual(now[0], 2.0)
+        limiter.update(0, 10.0)
+        limiter.wait()
+        self.assertEqual(now[0], 12.0)
+
+
+def router_line(message, source='heroku/router'):
+    return '\t'.join(['1', '2020-07-12T16:12:00', '2020-07-12T16:12:00Z', '1', 'wiinaq',
+                      '10.1.1.1', 'Local3', 'Info', source, message])
+
+
+ROUTER_LINES = [
+    router_line('at=info method=GET path="/ems/search/?q=nallu+a" host=wiinaq.herokuapp.com '
+                'request_id=1 fwd="10.0.0.1" dyno=web.1 connect=0ms service=12ms status=200 '
+                'bytes=1000 protocol=https'),
+    router_line('at=info method=GET path="/ems/w/nallu/" host=wiinaq.herokuapp.com '
+                'request_id=2 fwd="10.0.0.2" dyno=web.1 connect=0ms service=9ms status=200 '
+                'bytes=1000 protocol=https'),
+    router_line('at=error code=H12 desc="Request timeout" method=GET path="/ems/w/qayaq/" '
+                'host=wiinaq.herokuapp.com request_id=3 fwd="10.0.0.1" dyno=web.1 '
+                'connect=0ms service=30000ms status=503 bytes=0 protocol=https'),
+    router_line('Starting process', source='app/web.1'),
+]
+
+
+class WeeklySummaryTest(SimpleTestCase):
+    def write_archive(self, directory, name, lines):
+        path = os.path.join(directory, name)
+        with gzip.open(path, 'wt', encoding='utf-8') as outfile:
+            outfile.write(''.join(line + '\n' for line in lines))
+        return path
+
+    def test_summarize_logs(self):
+        summary = weekly_summary.summarize_logs(ROUTER_LINES)
+        self.assertEqual(summary['total_requests'], 3)
+        self.assertEqual(summary['searches'], {'nallu a': 1})
+        self.assertEqual(summary['words'], {'nallu': 1})
+        self.assertEqual(summary['paths_5xx'], {'/ems/w/qayaq/': 1})
+        self.assertEqual(summary['ips'], {'10.0.0.1': 1, '10.0.0.2': 1})
+
+    def test_local_archives(self):
+        directory = tempfile.mkdtemp()
+        self.write_archive(directory, '2020-07-12-01.tsv.gz', ROUTER_LINES[2:] * 2)
+        self.write_archive(directory, '2020-07-12-00.tsv.gz', ROUTER_LINES[:2])
+        paths = weekly_summary.archive_paths([directory])
+        self.assertEqual([os.path.basename(path) for path in paths],
+                         ['2020-07-12-00.tsv.gz', '2020-07-12-01.tsv.gz'])
+        self.assertEqual(weekly_summary.summarize_archives(paths, processes=1),
+                         weekly_summary.summarize_logs(ROUTER_LINES[:2] + ROUTER_LINES[2:] * 2))
+
+    def test_downloads(self):
+        path = self.write_archive(tempfile.mkdtemp(), 'archive.tsv.gz', ROUTER_LINES)
+
+        def get(url, headers=None, stream=False):
+            response = mock.MagicMock()
+            response.raw = open(path, 'rb')
+            return response
+
+        with mock.patch.object(weekly_summary.requests, 'get', get), \
+                redirect_stdout(io.StringIO()):
+            summary = weekly_summary.summarize_archives([('http://a', {}), ('http://b', {})])
+        self.assertEqual(summary['total_requests'], 6)
+        self.assertEqual(summary['ips'], {'10.0.0.1': 2, '10.0.0.2': 2})
+
+
+# Without a flush interval, the counts are only saved when the tests flush them.
+@override_settings(ANALYTICS=True, ANALYTICS_FLUSH_INTERVAL=None)
+class AnalyticsTest(TestCase):
+    def setUp(self):
+        Entry(entry='nallu', defn='to not know').save()
+
+    def test_middleware(self):
+        self.client.get('/ems/search/?q=nallu', REMOTE_ADDR='10.0.0.1')
+        self.client.get('/ems/search/?q=nallu', HTTP_X_FORWARDED_FOR='10.0.0.2, 10.1.1.1')
+        self.client.get('/ems/w/nallu/', REMOTE_ADDR='10.0.0.1')
+        analytics.BUFFER.flush()
+        today = timezone.localdate()
+        summary = analytics.summary_from_rollups(today, today + timedelta(days=1))
+        self.assertEqual(summary['total_requests'], 3)
+        self.assertEqual(summary['searches'], {'nallu': 2})
+        self.assertEqual(summary['words'], {'nallu': 1})
+        self.assertEqual(summary['ips'], {'10.0.0.0': 3})
+
+        self.client.get('/ems/search/?q=nallu')
+        analytics.BUFFER.flush()
+        self.assertEqual(RequestRollup.objects.get(date=today, kind='search', key='nallu').count,
+                         3)
+
+    @override_settings(ANALYTICS=False)
+    def test_disabled(self):
+        self.client.get('/ems/search/?q=nallu')
+        self.assertEqual(analytics.BUFFER.counts, {})
+
+    def test_matches_log_summary(self):
+        day = timezone.localdate()
+        for line in ROUTER_LINES:
+            info = weekly_summary.parse_router_line(line)
+            if info is not None:
+                analytics.BUFFER.record(info['path'][1:-1], info['status'],
+                                        info['fwd'][1:-1], 10, date=day)
+        analytics.BUFFER.flush()
+        summary = analytics.summary_from_rollups(day, day + timedelta(days=1))
+        self.assertEqual(summary.pop('service_ms'), {'all': 30, 'searches': 10, 'words': 10,
+                                                     'paths_5xx': 10})
+        self.assertTrue(summary.pop('ip_networks'))
+        logs = weekly_summary.summarize_logs(ROUTER_LINES)
+        self.assertEqual(logs.pop('ips'), {'10.0.0.1': 1, '10.0.0.2': 1})
+        self.assertEqual(summary.pop('ips'), {'10.0.0.0': 2})
+        self.assertEqual(summary, logs)
+
+    def test_background_flush(self):
+        buffer = analytics.RollupBuffer(interval=0.01)
+        buffer.record('/ems/search/?q=nallu', 200, '10.0.0.1', 5)
+        with mock.patch.object(analytics, 'write_rollups') as write_rollups, \
+                mock.patch('atexit.register'):
+            buffer.start()
+            for i in range(100):
+                if write_rollups.called:
+                    break
+                time.sleep(0.01)
+            buffer.stop()
+        self.assertEqual(write_rollups.call_count, 1)
+        self.assertEqual(buffer.counts, {})
+
+    def test_batched_upsert(self):
+        today = timezone.localdate()
+        counts = {(today, 'search', 'q%d' % i): [1, 5] for i in range(250)}
+        with CaptureQueriesContext(connection) as queries:
+            analytics.write_rollups(counts)
+        self.assertEqual(sum(query['sql'].startswith('INSERT') for query in queries), 3)
+        analytics.write_rollups({(today, 'search', 'q0'): [2, 10]})
+        row = RequestRollup.objects.get(date=today, kind='search', key='q0')
+        self.assertEqual((row.count, row.total_ms), (3, 15))
+        self.assertEqual(RequestRollup.objects.count(), 250)
+
+    def test_top_queries_and_trends(self):
+        today = timezone.localdate()
+        last_week = today - timedelta(days=7)
+        for date, query, count in [(today, 'nallu', 3), (today, 'qayaq', 1),
+                                   (today - timedelta(days=1), 'qayaq', 1),
+                                   (last_week, 'qayaq', 4),
+                                   (last_week - timedelta(days=1), 'nallu', 1)]:
+            for i in range(count):
+                analytics.BUFFER.record('/ems/search/?q=' + query, 200, '10.0.0.1', 5, date=date)
+        analytics.BUFFER.flush()
+
+        self.assertEqual(analytics.top_queries(), [('nallu', 3), ('qayaq', 2)])
+        self.assertEqual(analytics.top_queries(days=14, limit=1), [('qayaq', 6)])
+
+        summary, previous = analytics.week_summaries(end=today + timedelta(days=1))
+        self.assertEqual(summary['searches'], {'nallu': 3, 'qayaq': 2})
+        self.assertEqual(previous['searches'], {'qayaq': 4, 'nallu': 1})
+        lines = weekly_summary.trend_lines(summary, previous)
+        self.assertIn('  Searches: 5 (was 5, +0%)', lines)
+        self.assertIn('    (3, was 1) nallu', lines)
+
+        with mock.patch.object(weekly_summary, 'get_location_map',
+                               return_value={'Kodiak': ['10.0.0.0']}):
+            text = weekly_summary.format_summary(summary, previous)
+        self.assertIn('Unique visitor networks: 1', text)
+        self.assertIn('(1 networks, 5 requests) Kodiak', text)
@@ -5,8 +5,10 @@ from . import views
 urlpatterns = [
     path('', views.index, name='index'),
     path('w/<str:word>/', views.entry, name='entry'),
+    path('w/<str:word>/endings/', views.entry_endings, name='entry_endings'),
     path('search/', views.search, name='search'),
     path('random/', views.random_entry, name='random'),
+    path('today/', views.today, name='today'),
     path('build/', views.build, name='build'),
     path('credits/', views.credits, name='credits'),
 ]
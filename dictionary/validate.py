@@ -10,26 +10,31 @@ import random
 
 def find_bad_entries():
     from .models import Entry
-    from .views import group_entries
-    from .alutiiq import get_endings_map, is_valid
+    from .views import group_entries, with_related
+    from .alutiiq import is_valid
+    from .paradigms import generate_paradigms
 
-    entries = group_entries(Entry.objects.all(), separate_roots=True)
+    entries = group_entries(with_related(Entry.objects.all()), separate_roots=True)
     bad_headwords = []
-    bad_forms = []
-    for i, entry in enumerate(entries):
-        if i % 100 == 0:
-            print(f'{i} / {len(entries)}')
+    words = {}
+    for entry in entries:
         for root in entry.roots:
             word = root.word.replace('(', '').replace(')', '')
             if not is_valid(word):
                 bad_headwords.append(word)
             elif root.pos and root.pos != 'None':
-                for tags, form in get_endings_map(root.root, root.pos).items():
-                    form = form.replace('(', '').replace(')', '')
-                    if form != '-' and not is_valid(form):
-                        bad_forms.append((form, root.word, tags))
-        if len(bad_forms) > 200 or len(bad_headwords) > 200:
-            break
+                words.setdefault((root.root, root.pos), []).append(root.word)
+
+    bad_forms = []
+
+    def check_form(row):
+        root, pos, tags, form = row
+        form = form.replace('(', '').replace(')', '')
+        if form != '-' and not is_valid(form):
+            bad_forms.extend((form, word, tags) for word in words[root, pos])
+
+    count = generate_paradigms(words, callback=check_form)
+    print(f'{len(entries)} entries, {count} forms checked')
 
     sample_size = min(100, len(bad_headwords))
     for word in sorted(random.sample(bad_headwords, sample_size)):
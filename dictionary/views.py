@@ -2,40 +2,42 @@
 import random
 import re
 import binascii
+import datetime
 import itertools
 from urllib.parse import quote, unquote
 from collections import namedtuple
 
-from django.db import connection
-from django.db.models import Max
-from django.http import Http404
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Prefetch
+from django.http import Http404, JsonResponse
 from django.shortcuts import get_list_or_404, redirect, render
+from django.template.loader import render_to_string
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.cache import patch_response_headers
 
-from .models import Entry as EntryModel, Source as SourceModel
-from .alutiiq import inflection_data, normalize
+from .models import Entry as EntryModel, Source as SourceModel, Example as ExampleModel
+from .models import EntryVarietyInfo, ExampleVarietyInfo
+from .alutiiq import ENDINGS, default_tables, inflection_data, normalize, table_maps
+from .caching import QueryCache, cached_fragments, cached_page
+from .paradigms import get_paradigms
+from .search import find_entry_ids, get_headwords
+from .templatetags.formatting import replace_russian_r
 
 
 ALUTIIQ_SUBDIR = '/ems/'
 
-SEARCH_LIMIT = 1000
-
-if connection.vendor == 'mysql':
-    SOW = '(^|[[:space:][:punct:]])'
-    EOW = '($|[[:space:][:punct:]])'
-elif connection.vendor == 'postgresql':
-    SOW = r'\m'
-    EOW = r'\M'
-else:
-    SOW = EOW = r'\b'
-
 
 def subdir(view):
     def redirect_to_subdir(request, *args, **kwargs):
         if request.path.startswith(ALUTIIQ_SUBDIR):
             return view(request, *args, **kwargs)
         else:
-            return redirect(view.__name__, *args, **kwargs)
+            response = redirect(view.__name__, *args, **kwargs)
+            if request.META.get('QUERY_STRING'):
+                response['Location'] += '?' + request.META['QUERY_STRING']
+            return response
 
     return redirect_to_subdir
 
@@ -51,43 +53,102 @@ def credits(request):
                    'url': request.build_absolute_uri(request.get_full_path())})
 
 
+@cached_page
 @subdir
 def entry(request, word):
     word = unquote(word)
-    chunks = get_list_or_404(EntryModel, entry=word, hidden=False)
+    chunks = get_list_or_404(with_related(EntryModel.objects), entry=word, hidden=False)
     entries = group_entries(chunks, separate_roots=True)
     assert len(entries) == 1
+    paradigms = get_paradigms([(root.root, root.pos) for root in entries[0].roots
+                               if root.pos in ENDINGS])
+    lazy = getattr(settings, 'LAZY_ENDING_TABLES', False)
     context = {'word': word,
                'roots': [{'root': root.root,
                           'pos': root.pos,
                           'id': root.id,
-                          'inflections': inflection_data(root),
+                          'inflections': inflection_data(root,
+                                                         paradigms.get((root.root, root.pos))),
                           'sources': root.sources}
                          for root in entries[0].roots],
+               'lazy_endings': lazy,
                'url': request.build_absolute_uri(request.get_full_path()),
                'request': request}
+    if lazy:
+        for root in context['roots']:
+            if root['inflections']:
+                root['inflections'] = default_tables(root['inflections'])
     return render(request, 'dictionary/entry.html', context)
 
 
-MAX_RANDOM_TRIES = 100
+@cached_page
+@subdir
+def entry_endings(request, word):
+    '''
+    The ending tables of one root of an entry as JSON, for entry pages that
+    only render the default cells (LAZY_ENDING_TABLES). `root` is the root id
+    used on the entry page; `table` and `cell` optionally narrow the result
+    to one table or one cell of it.
+    '''
+    word = unquote(word)
+    root_id = request.GET.get('root', '')
+    table_id = request.GET.get('table')
+    cell_id = request.GET.get('cell')
+
+    for chunk in EntryModel.objects.filter(entry=word, hidden=False).only('root_final', 'pos_final'):
+        pos, root = pos_root(chunk, separate_roots=True)
+        if pos in ENDINGS and root_to_id(pos, root) == root_id:
+            break
+    else:
+        raise Http404
+
+    endings_map = get_paradigms([(root, pos)])[root, pos]
+    tables = table_maps(pos, endings_map, table_id)
+    if table_id is not None and not tables:
+        raise Http404
+    if cell_id is not None:
+        if table_id is None or cell_id not in tables[table_id]:
+            raise Http404
+        tables = {table_id: {cell_id: tables[table_id][cell_id]}}
+
+    return JsonResponse({'tables': {
+        table: {cell: {id: replace_russian_r(form) for id, form in forms.items()}
+                for cell, forms in cells.items()}
+        for table, cells in tables.items()
+    }})
 
 
 @subdir
 def random_entry(request):
-    max_id = EntryModel.objects.aggregate(Max('id'))['id__max']
-    random_entry = None
-    for _ in range(MAX_RANDOM_TRIES):
-        random_id = random.randint(0, max_id)
-        try:
-            random_entry = EntryModel.objects.get(id=random_id)
-            break
-        except EntryModel.DoesNotExist:
-            pass
+    headwords = get_headwords()
+    if not headwords:
+        raise Http404
+    return redirect('entry', word=random.choice(headwords))
+
 
-    if random_entry is None:
+def word_of_the_day(date):
+    '''
+    The headword chosen for `date`, the same in every process as long as
+    the dictionary doesn't change.
+    '''
+    headwords = get_headwords()
+    if not headwords:
+        return None
+    return random.Random(date.isoformat()).choice(headwords)
+
+
+@subdir
+def today(request):
+    now = timezone.localtime()
+    word = word_of_the_day(now.date())
+    if word is None:
         raise Http404
-    else:
-        return redirect('entry', word=random_entry.entry)
+    response = redirect('entry', word=word)
+    # Keep the redirect until local midnight.
+    tomorrow = (now + datetime.timedelta(days=1)).replace(hour=0, minute=0, second=0,
+                                                         microsecond=0)
+    patch_response_headers(response, cache_timeout=int((tomorrow - now).total_seconds()))
+    return response
 
 
 def build(request):
@@ -106,122 +167,176 @@ Sense = namedtuple('Sense', ['chunks', 'defn', 'sources', 'examples',
                              'main_entries', 'subentries', 'see_also'])
 
 
-def chunk_relevance(chunk, query):
-    query_l = query.lower()
-    query_fuzzy = normalize(query)
-
-    score = 0
-
-    # Return results in the reverse of the following order:
+# Optional words around a query that still count as matching a whole
+# definition: (prefix, suffix) pairs.
+ACCESSORIES = [
+    ('', ''),
+    ('', ' her'),
+    ('', ' ~her~'),
+    ('', ' ~her/~'),
+    ('', ' him'),
+    ('', ' ~him~'),
+    ('', ' ~him/~'),
+    ('', ' ~him/her~'),
+    ('', ' it'),
+    ('', ' ~it~'),
+    ('', ' ~it/~'),
+    ('', ' some'),
+    ('', ' something'),
+    ('', ' things'),
+    ('', ' them'),
+    ('be ', ''),
+    ('to be ', ''),
+    ('is ', ''),
+    ('are ', ''),
+    ('a ', ''),
+    ('the ', ''),
+]
+
+ChunkText = namedtuple('ChunkText', ['entry_lower', 'entry_words', 'fuzzy', 'fuzzy_words',
+                                     'without_parens', 'inside_parens',
+                                     'full_entries', 'full_entries_no_parens'])
+
+
+def chunk_text(chunk):
+    '''
+    The pieces of a chunk's word and definition that relevance scoring looks
+    at, computed once and cached on the chunk.
+    '''
+    try:
+        return chunk.relevance_text
+    except AttributeError:
+        pass
 
-    # Beginning or end definition match inside parens
-    without_parens = remove_parens(chunk.defn)
-    inside_parens = ' '.join(re.findall(r'(?<=\()[^)]+(?=\))', chunk.defn))
-    if re.search(r'\b%s' % re.escape(query_l), inside_parens) or \
-            re.search(r'%s\b' % re.escape(query_l), inside_parens):
-        score = 10
+    fuzzy = normalize(chunk.entry)
+    full_entries = re.split("[,;] ?", chunk.defn.lower())
+    chunk.relevance_text = ChunkText(
+        entry_lower=chunk.entry.lower(),
+        entry_words=set(chunk.entry.split()),
+        fuzzy=fuzzy,
+        fuzzy_words=set(fuzzy.split()),
+        without_parens=remove_parens(chunk.defn),
+        inside_parens=' '.join(re.findall(r'(?<=\()[^)]+(?=\))', chunk.defn)),
+        full_entries=set(full_entries),
+        full_entries_no_parens={remove_parens(e).strip() for e in full_entries},
+    )
+    return chunk.relevance_text
 
-    # Beginning or end outside of parens
-    if re.search(r'\b%s' % re.escape(query_l), without_parens) or \
-            re.search(r'%s\b' % re.escape(query_l), without_parens):
-        score = 20
 
-    # Whole-word definition match inside parens
-    if re.search(r'\b%s\b' % re.escape(query_l), inside_parens):
-        score = 30
+class RelevanceScorer(object):
+    '''
+    Ranks chunks by how well they match one search query. Everything that
+    depends only on the query is prepared once, so scoring each chunk is a
+    handful of set lookups and precompiled regex searches.
+    '''
 
-    # Beginning or end of Alutiiq word with spelling correction
-    if re.search(r'\b%s' % re.escape(query_fuzzy), normalize(chunk.entry)) or \
-            re.search(r'%s\b' % re.escape(query_fuzzy), normalize(chunk.entry)):
-        score = 33
+    def __init__(self, query):
+        query_l = query.lower()
+        self.query = query
+        self.query_fuzzy = normalize(query)
+
+        escaped_l = re.escape(query_l)
+        escaped_fuzzy = re.escape(self.query_fuzzy)
+        escaped = re.escape(query)
+        self.english_edge = re.compile(r'\b%s|%s\b' % (escaped_l, escaped_l))
+        self.english_word = re.compile(r'\b%s\b' % escaped_l)
+        self.fuzzy_edge = re.compile(r'\b%s|%s\b' % (escaped_fuzzy, escaped_fuzzy))
+        self.alutiiq_edge = re.compile(r'\b%s|%s\b' % (escaped, escaped))
+
+        self.full_definitions = set()
+        for pre, suff in ACCESSORIES:
+            self.full_definitions.add(pre + query_l + suff)
+            if pre == '':
+                self.full_definitions.add('to ' + query_l + suff)
+
+    def score(self, chunk):
+        text = chunk_text(chunk)
+
+        # Checked from best to worst match:
+        if self.query in text.entry_words:
+            # Full Alutiiq word match
+            return 60
+        elif not self.full_definitions.isdisjoint(text.full_entries):
+            # Whole definition, with optional object
+            return 55
+        elif not self.full_definitions.isdisjoint(text.full_entries_no_parens):
+            # Whole definition (ignoring parenthesized expressions), with optional object
+            return 50
+        elif self.query_fuzzy in text.fuzzy_words:
+            # Full Alutiiq word match with spelling correction
+            return 45
+        elif self.english_word.search(text.without_parens):
+            # Whole-word outside of parens
+            return 40
+        elif self.alutiiq_edge.search(chunk.entry):
+            # Beginning or end of Alutiiq word
+            return 35
+        elif self.fuzzy_edge.search(text.fuzzy):
+            # Beginning or end of Alutiiq word with spelling correction
+            return 33
+        elif self.english_word.search(text.inside_parens):
+            # Whole-word definition match inside parens
+            return 30
+        elif self.english_edge.search(text.without_parens):
+            # Beginning or end outside of parens
+            return 20
+        elif self.english_edge.search(text.inside_parens):
+            # Beginning or end definition match inside parens
+            return 10
+        else:
+            return 0
 
-    # Beginning or end of Alutiiq word
-    if re.search(r'\b%s' % re.escape(query), chunk.entry) or \
-            re.search(r'%s\b' % re.escape(query), chunk.entry):
-        score = 35
+    def __call__(self, chunk):
+        return (-self.score(chunk), chunk_text(chunk).entry_lower)
 
-    # Whole-word outside of parens
-    if re.search(r'\b%s\b' % re.escape(query_l), without_parens):
-        score = 40
 
-    # Full Alutiiq word match with spelling correction
-    if query_fuzzy in normalize(chunk.entry).split():
-        score = 45
+def relevance(query):
+    '''A sort key for (word, matching chunks) pairs.'''
+    scorer = RelevanceScorer(query)
 
-    # Whole definition (ignoring parenthesized expressions), with optional object
-    full_entries = re.split("[,;] ?", chunk.defn.lower())
-    full_entries_no_parens = [remove_parens(e).strip() for e in full_entries]
-
-    accessories = [
-        ('', ''),
-        ('', ' her'),
-        ('', ' ~her~'),
-        ('', ' ~her/~'),
-        ('', ' him'),
-        ('', ' ~him~'),
-        ('', ' ~him/~'),
-        ('', ' ~him/her~'),
-        ('', ' it'),
-        ('', ' ~it~'),
-        ('', ' ~it/~'),
-        ('', ' some'),
-        ('', ' something'),
-        ('', ' things'),
-        ('', ' them'),
-        ('be ', ''),
-        ('to be ', ''),
-        ('is ', ''),
-        ('are ', ''),
-        ('a ', ''),
-        ('the ', ''),
-    ]
-    if any(
-        (pre + query_l + suff in full_entries_no_parens) or (
-            pre == '' and 'to ' + query_l + suff in full_entries_no_parens
-        )
-        for pre, suff in accessories
-    ):
-        score = 50
-
-    # Whole definition, with optional object
-    if any(
-        (pre + query_l + suff in full_entries) or (
-            pre == '' and 'to ' + query_l + suff in full_entries
-        )
-        for pre, suff in accessories
-    ):
-        score = 55
-
-    # Full Alutiiq word match
-    if query in chunk.entry.split():
-        score = 60
-
-    return (-score, chunk.entry.lower())
+    def sort_key(item):
+        word, chunks = item
+        return (max(scorer(chunk) for chunk in chunks), word.lower(), word)
 
+    return sort_key
 
-def relevance(query):
-    def sort_key(entry):
-        return (max(chunk_relevance(chunk, query)
-                    for root in entry.roots
-                    for source in root.sources
-                    for sense in source.senses
-                    for chunk in sense.chunks),
-                entry.word.lower(),
-                entry.word)
 
-    return sort_key
+def with_related(queryset):
+    '''
+    Fetch everything that building and rendering a sense looks at (sources,
+    main entries, visible examples, subentries and "see also" links, and
+    variety info) for a queryset of chunks, using a fixed number of queries
+    however many chunks there are.
+    '''
+    visible_entries = EntryModel.objects.filter(hidden=False)
+    return queryset.select_related('source', 'main_entry').prefetch_related(
+        Prefetch('examples',
+                 queryset=ExampleModel.objects.filter(hidden=False)
+                                              .select_related('source')
+                                              .prefetch_related(Prefetch(
+                                                  'examplevarietyinfo_set',
+                                                  queryset=ExampleVarietyInfo.objects
+                                                                             .select_related('variety'),
+                                              )),
+                 to_attr='visible_examples'),
+        Prefetch('subentries', queryset=visible_entries, to_attr='visible_subentries'),
+        Prefetch('see_also', queryset=visible_entries, to_attr='visible_see_also'),
+        Prefetch('entryvarietyinfo_set',
+                 queryset=EntryVarietyInfo.objects.select_related('variety')),
+    )
 
 
 def build_sense(defn, chunks):
+    # chunks should come from a queryset passed through with_related().
     chunks = list(chunks)
     return Sense(defn=defn, chunks=chunks, sources=[c.source_info for c in chunks],
-                 examples=[e for c in chunks for e in c.examples.filter(hidden=False)],
+                 examples=[e for c in chunks for e in c.visible_examples],
                  comments=[c.comments for c in chunks if c.comments is not None],
                  etymologies=[c.etymology for c in chunks if c.etymology is not None],
                  main_entries=dedupe([c.main_entry for c in chunks
                                       if c.main_entry is not None and not c.main_entry.hidden]),
-                 subentries=dedupe([s for c in chunks for s in c.subentries.filter(hidden=False)]),
-                 see_also=dedupe([s for c in chunks for s in c.see_also.filter(hidden=False)]))
+                 subentries=dedupe([s for c in chunks for s in c.visible_subentries]),
+                 see_also=dedupe([s for c in chunks for s in c.visible_see_also]))
 
 
 def dedupe(entries):
@@ -280,47 +395,59 @@ def pos_root(chunk, separate_roots=False):
         return (pos, None)
 
 
-def run_search_query(query):
-    # g matches g or r
-    # r matches g, r, or R
-    # R matches only R
-    alutiiq_query = re.sub(
-        r'(?<!n)g', 'r',
-        re.escape(normalize(query, g_and_r=False)).replace('r', '[rRřŘ]')
-    )
-    english_query = re.escape(query.lower())
-
-    alutiiq_regexes = [
-        '^{}-?$'.format(alutiiq_query),
-        '^{}'.format(alutiiq_query),
-        '{}-?$'.format(alutiiq_query),
-        alutiiq_query,
-    ]
+# Ranked results of the most popular searches.
+QUERY_CACHE = QueryCache(getattr(settings, 'QUERY_CACHE_SIZE', 1000),
+                         shared=cache if getattr(settings, 'QUERY_CACHE_SHARED', False) else None,
+                         timeout=getattr(settings, 'PAGE_CACHE_TIMEOUT', 300))
 
-    english_regexes = [
-        '{}{}{}'.format(SOW, english_query, EOW),
-        '{}{}'.format(SOW, english_query),
-        '{}{}'.format(english_query, EOW),
-    ]
 
-    final_list = []
-    for regex in alutiiq_regexes:
-        search = EntryModel.objects.filter(search_word__regex=regex)[:SEARCH_LIMIT]
-        this_count = len(search)
-        if this_count == SEARCH_LIMIT:
-            break
+def search_listings(query):
+    '''
+    The rendered listing of each word with chunks matching `query`, most
+    relevant first. The ranking of popular queries is kept in QUERY_CACHE,
+    and the listings come from the fragment cache, keyed by word and
+    matching chunks, so only the words that miss are fetched in full.
+    Runs of whitespace in `query` count as one space, so they share a
+    ranking. (Case is kept: Alutiiq R and r are different letters.)
+    '''
+    query = ' '.join(query.split())
+    if not query:
+        return []
+    if getattr(settings, 'PAGE_CACHE', True):
+        keys = QUERY_CACHE.get_or_compute(query, rank_matches)
+    else:
+        keys = rank_matches(query)
+    # Words that are gone by the time they're rendered have empty listings.
+    return [listing for listing in cached_fragments('listing', keys, render_listings) if listing]
 
-        final_list.extend(search)
 
-    for regex in english_regexes:
-        search = EntryModel.objects.filter(search_text__regex=regex)[:SEARCH_LIMIT]
-        this_count = len(search)
-        if this_count == SEARCH_LIMIT:
-            break
+def rank_matches(query):
+    '''
+    The words with chunks matching `query`, most relevant first, as
+    (word, ids of the matching chunks). Ranking only needs the word and
+    definition of each chunk.
+    '''
+    words = {}
+    chunks = EntryModel.objects.filter(id__in=set(find_entry_ids(query))).only('entry', 'defn')
+    for chunk in chunks:
+        words.setdefault(chunk.entry, []).append(chunk)
+    ranked = sorted(words.items(), key=relevance(query))
+    return [(word, tuple(sorted(chunk.id for chunk in chunks))) for word, chunks in ranked]
 
-        final_list.extend(search)
 
-    return sorted(final_list, key=lambda e: (e.entry, e.pos_final))
+def render_listings(keys):
+    '''
+    The listing of each (word, chunk ids) in `keys`, or an empty string for
+    words none of whose chunks are left under that word, as happens when a
+    ranking is older than an edit.
+    '''
+    ids = [id for word, chunk_ids in keys for id in chunk_ids]
+    chunks = sorted(with_related(EntryModel.objects.filter(id__in=ids)),
+                    key=lambda e: (e.entry, e.pos_final))
+    entries = {entry.word: entry for entry in group_entries(chunks)}
+    return [render_to_string('dictionary/listing.html', {'entry': entries[word]})
+            if word in entries else ''
+            for word, chunk_ids in keys]
 
 
 def group_entries(chunk_list, separate_roots=False):
@@ -337,6 +464,7 @@ def group_entries(chunk_list, separate_roots=False):
     ]
 
 
+@cached_page
 @subdir
 def search(request):
     context = {'url': request.build_absolute_uri(request.get_full_path()),
@@ -352,13 +480,10 @@ def search(request):
 
     if 'q' in request.GET and request.GET['q']:
         query = request.GET['q']
-        chunk_list = run_search_query(query)
-        chunk_list = [c for c in chunk_list]
-        entry_list = sorted(group_entries(chunk_list), key=relevance(query))
-        context['entry_list'] = entry_list
+        context['listings'] = search_listings(query)
         context['query'] = query
     else:
-        context['entry_list'] = []
+        context['listings'] = []
         context['query'] = ''
 
         if 'heroku' in context['url'].split('/')[2]:
@@ -1,19 +1,32 @@
+# Run with: python dictionary/weekly_summary.py
+# (or python -m dictionary.weekly_summary), or, to print a summary of
+# Papertrail archives already downloaded (files or directories of *.tsv.gz
+# files) instead of emailing this week's:
+#     python dictionary/weekly_summary.py <archive or directory>...
+
 from __future__ import print_function
 
 import datetime
 import gzip
+import io
+import multiprocessing
 import os
 import re
 import smtplib
 import sys
-import time
-import urllib
 from collections import Counter
 from email.mime.text import MIMEText
-from io import BytesIO
+from multiprocessing.pool import ThreadPool
 
 import requests
 
+if __name__ == '__main__' and not __package__:
+    # Run as a file: make the dictionary package importable.
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dictionary import geolocation  # noqa: E402
+from dictionary.analytics import SUMMARY_KINDS, classify  # noqa: E402
+
 
 def send_weekly_summary():
     if not os.environ.get('EVERY_DAY') and datetime.datetime.today().weekday() != 5:
@@ -23,17 +36,30 @@ def send_weekly_summary():
               'EVERY_DAY to something non-empty to force a run.')
         return
 
-    papertrail_token = os.environ['PAPERTRAIL_API_TOKEN']
     summary_recipient_emails = os.environ['SUMMARY_RECIPIENT_EMAILS'].split(',')
     gmail_id = os.environ['SENDER_GMAIL_ID']
     gmail_password = os.environ['SENDER_GMAIL_PASSWORD']
 
-    log_lines = get_log_lines(papertrail_token)
-    summary = summarize_logs(log_lines)
-    send_email(summary, summary_recipient_emails, gmail_id, gmail_password)
+    if os.environ.get('SUMMARY_FROM_ROLLUPS'):
+        # Read the counts kept by dictionary/analytics.py instead of the logs.
+        os.environ.setdefault("DJANGO_SETTINGS_MODULE", "project.settings")
+        import django
+        django.setup()
+        from dictionary.analytics import week_summaries
+        summary, previous = week_summaries()
+    else:
+        papertrail_token = os.environ['PAPERTRAIL_API_TOKEN']
+        summary = summarize_archives(get_archive_urls(papertrail_token))
+        previous = None
+    send_email(summary, summary_recipient_emails, gmail_id, gmail_password, previous)
 
 
-def get_log_lines(papertrail_token):
+# Number of archives downloaded at once.
+DOWNLOAD_THREADS = 4
+
+
+def get_archive_urls(papertrail_token):
+    '''(url, headers) for each archive from the last week, oldest first.'''
     headers = {'X-Papertrail-Token': papertrail_token}
 
     response = requests.get('https://papertrailapp.com/api/v1/archives.json', headers=headers)
@@ -46,28 +72,111 @@ def get_log_lines(papertrail_token):
     ]
     archive_index.sort(key=lambda b: b['end'])
 
-    for block in archive_index:
-        url = block['_links']['download']['href']
-        print(url)
-        response = requests.get(url, headers=headers)
-        try:
-            response.raise_for_status()
-        except Exception as e:
-            print('Error downloading logs from {}: {}'.format(url, e), file=sys.stderr)
-            continue
+    return [(block['_links']['download']['href'], headers) for block in archive_index]
+
+
+def get_log_lines(papertrail_token):
+    for url, headers in get_archive_urls(papertrail_token):
+        for line in download_lines(url, headers):
+            yield line
+
 
-        gzip_data = BytesIO(response.content)
-        log_text = gzip.GzipFile(fileobj=gzip_data, mode='r').read().decode()
-        for line in log_text.splitlines():
+def download_lines(url, headers):
+    '''The lines of a gzipped archive, decompressed as it downloads.'''
+    print(url)
+    try:
+        response = requests.get(url, headers=headers, stream=True)
+        response.raise_for_status()
+    except Exception as e:
+        print('Error downloading logs from {}: {}'.format(url, e), file=sys.stderr)
+        return
+    with response:
+        response.raw.decode_content = True
+        for line in read_lines(response.raw):
             yield line
 
 
+def read_lines(fileobj):
+    '''The lines of a gzipped log file, without holding the whole file in memory.'''
+    with gzip.GzipFile(fileobj=fileobj, mode='r') as gzip_file:
+        for line in io.TextIOWrapper(gzip_file, encoding='utf-8'):
+            for part in line.splitlines():
+                yield part
+
+
+def archive_paths(paths):
+    '''Expand directories in `paths` to the archives in them, in name (= date) order.'''
+    result = []
+    for path in paths:
+        if os.path.isdir(path):
+            result.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                 if name.endswith('.gz')))
+        else:
+            result.append(path)
+    return result
+
+
+def summarize_archive(source):
+    '''Summarize one archive: a local path, or a (url, headers) pair.'''
+    if isinstance(source, tuple):
+        return summarize_logs(download_lines(*source))
+    with open(source, 'rb') as infile:
+        return summarize_logs(read_lines(infile))
+
+
+def summarize_archives(sources, processes=None):
+    '''
+    Summarize several archives at once and merge the results, in the order
+    of `sources`. Downloads ((url, headers) pairs) run in threads, local
+    files in `processes` worker processes (default one per CPU).
+    '''
+    summary = new_summary()
+    if not sources:
+        return summary
+    if isinstance(sources[0], tuple):
+        pool = ThreadPool(min(DOWNLOAD_THREADS, len(sources)))
+    else:
+        pool = multiprocessing.Pool(min(processes or os.cpu_count() or 1, len(sources)))
+    with pool:
+        for archive_summary in pool.imap(summarize_archive, sources):
+            merge_summaries(summary, archive_summary)
+    return summary
+
+
 def date_from_str(date_str):
     return datetime.datetime.strptime(date_str, '%Y-%m-%dT%H:%M:%SZ')
 
 
-def summarize_logs(log_lines):
-    summary = {
+ROUTER_FIELD = re.compile(r'([^ =]*)=((?:"[^"]*"|[^" ]*)+)')
+# The usual layout of a router line, which gives the fields summarize_logs
+# needs without splitting up the whole line.
+ROUTER_LINE = re.compile(r'at=info method=[^ ]* (path="[^"]*") host=[^ ]* request_id=[^ ]* '
+                         r'(fwd="[^"]*") dyno=[^ ]* connect=[^ ]* service=[^ ]* '
+                         r'(status=[0-9]+) ')
+
+
+def parse_router_line(line):
+    '''
+    The key=value fields of a Heroku router log line, or None for other lines.
+
+    >>> info = parse_router_line('\\t'.join(['x'] * 8 + ['heroku/router',
+    ...     'at=info method=GET path="/ems/w/nallu/" fwd="10.0.0.1" status=200']))
+    >>> info['path'], info['status']
+    ('"/ems/w/nallu/"', '200')
+    '''
+    if 'heroku/router' not in line:
+        return None
+    cols = line.split('\t')
+    if len(cols) < 10 or cols[8] != 'heroku/router':
+        return None
+    match = ROUTER_LINE.match(cols[9])
+    if match:
+        return dict(field.split('=', 1) for field in match.groups())
+    return dict(ROUTER_FIELD.findall(cols[9]))
+
+
+def new_summary():
+    return {
         'searches': Counter(),
         'words': Counter(),
         'other_2xx': Counter(),
@@ -77,49 +186,64 @@ def summarize_logs(log_lines):
         'total_requests': 0,
     }
 
-    for line in log_lines:
-        cols = line.split('\t')
-        if len(cols) < 9 or cols[8] != 'heroku/router':
-            continue
 
-        try:
-            info = {
-                k: v
-                for k, v in re.findall(r'([^ =]*)=((?:"[^"]*"|[^" ]*)+)', cols[9])
-            }
-        except ValueError:
-            print("Can't parse log line: {}".format(line), file=sys.stderr)
+def merge_summaries(summary, other):
+    for key, value in other.items():
+        if key == 'total_requests':
+            summary[key] += value
+        else:
+            summary[key].update(value)
+    return summary
+
+
+def summarize_logs(log_lines):
+    summary = new_summary()
+
+    for line in log_lines:
+        info = parse_router_line(line)
+        if info is None:
             continue
 
         if 'path' not in info or 'status' not in info:
             print("Can't parse log line: {}".format(line), file=sys.stderr)
             continue
 
-        path = info['path'][1:-1]
-
-        if info['status'].startswith('4'):
-            summary['paths_4xx'][path] += 1
-        elif info['status'].startswith('5'):
-            summary['paths_5xx'][path] += 1
-        elif path.startswith('/ems/search/?q='):
-            query = urllib.parse.unquote_plus(path[len('/ems/search/?q='):])
-            summary['searches'][query] += 1
-            summary['ips'][info['fwd'][1:-1]] += 1
-        elif path.startswith('/ems/w/'):
-            word = urllib.parse.unquote(path[len('/ems/w/'):])
-            if word.endswith('/'):
-                word = word[:-1]
-            summary['words'][word] += 1
-            summary['ips'][info['fwd'][1:-1]] += 1
-        elif info['status'].startswith('2') and not path.startswith('/static/'):
-            summary['other_2xx'][path] += 1
+        kind_key = classify(info['path'][1:-1], info['status'])
+        if kind_key is not None:
+            kind, key = kind_key
+            summary[SUMMARY_KINDS[kind]][key] += 1
+            if kind in ('search', 'word'):
+                summary['ips'][info['fwd'][1:-1]] += 1
 
         summary['total_requests'] += 1
 
     return summary
 
 
-def send_email(summary, summary_recipient_emails, sender_id, sender_password):
+def send_email(summary, summary_recipient_emails, sender_id, sender_password, previous=None):
+    body = format_summary(summary, previous)
+
+    msg = MIMEText(body, 'plain', 'utf-8')
+    sender_email = '{}@gmail.com'.format(sender_id)
+    msg['Subject'] = 'Weekly Wiinaq summary'
+    msg['From'] = 'Wiinaq <{}>'.format(sender_email)
+    msg['To'] = ', '.join(summary_recipient_emails)
+
+    s = smtplib.SMTP_SSL('smtp.gmail.com', 465)
+    try:
+        s.login(sender_id, sender_password)
+        s.sendmail(sender_email, summary_recipient_emails, msg.as_string())
+    finally:
+        s.quit()
+
+    print(body)
+
+
+def format_summary(summary, previous=None):
+    '''
+    The text of the summary email. `previous`, a summary of the week before,
+    adds a comparison with that week.
+    '''
     lines = []
 
     total_page_views = sum(sum(summary[key].values()) for key in ('searches', 'words', 'other_2xx'))
@@ -129,7 +253,18 @@ def send_email(summary, summary_recipient_emails, sender_id, sender_password):
     lines.append(u'Total requests: {}'.format(summary['total_requests']))
     lines.append(u'Total pages viewed: {}'.format(total_page_views))
     lines.append(u'Unique pages viewed: {}'.format(unique_page_views))
-    lines.append(u'Unique IP visitors: {}'.format(len(summary['ips'])))
+    if summary.get('ip_networks'):
+        lines.append(u'Unique visitor networks: {}'.format(len(summary['ips'])))
+    else:
+        lines.append(u'Unique IP visitors: {}'.format(len(summary['ips'])))
+    if summary.get('service_ms') and summary['total_requests']:
+        lines.append(u'Average response time: {:.0f} ms'.format(
+            summary['service_ms']['all'] / summary['total_requests']))
+
+    if previous is not None:
+        lines.append(u'')
+        lines.append(u'Compared with the week before:')
+        lines.extend(trend_lines(summary, previous))
 
     if summary['searches']:
         lines.append(u'')
@@ -166,62 +301,49 @@ def send_email(summary, summary_recipient_emails, sender_id, sender_password):
         lines.append(u'Request geolocations:')
         for loc, ips in location_map.items():
             total_requests = sum(summary['ips'][ip] for ip in ips)
-            lines.append(u'  ({} IPs, {} requests) {}'.format(len(ips), total_requests, loc))
-
-    body = u'\n'.join(lines)
-
-    msg = MIMEText(body, 'plain', 'utf-8')
-    sender_email = '{}@gmail.com'.format(sender_id)
-    msg['Subject'] = 'Weekly Wiinaq summary'
-    msg['From'] = 'Wiinaq <{}>'.format(sender_email)
-    msg['To'] = ', '.join(summary_recipient_emails)
-
-    s = smtplib.SMTP_SSL('smtp.gmail.com', 465)
-    try:
-        s.login(sender_id, sender_password)
-        s.sendmail(sender_email, summary_recipient_emails, msg.as_string())
-    finally:
-        s.quit()
-
-    print(body)
+            lines.append(u'  ({} {}, {} requests) {}'.format(
+                len(ips), 'networks' if summary.get('ip_networks') else 'IPs',
+                total_requests, loc))
+
+    return u'\n'.join(lines)
+
+
+def trend_lines(summary, previous, limit=10):
+    '''
+    >>> from collections import Counter
+    >>> trend_lines({'total_requests': 150, 'searches': Counter({'nallu': 6, 'qayaq': 1})},
+    ...             {'total_requests': 100, 'searches': Counter({'nallu': 2, 'qayaq': 3})})
+    ['  Total requests: 150 (was 100, +50%)', '  Searches: 7 (was 5, +40%)', \
+'  Rising searches:', '    (6, was 2) nallu']
+    '''
+    def change(label, now, before):
+        if before:
+            return u'  {}: {} (was {}, {:+.0f}%)'.format(label, now, before,
+                                                       100.0 * (now - before) / before)
+        return u'  {}: {} (was {})'.format(label, now, before)
+
+    lines = [change(u'Total requests', summary['total_requests'], previous['total_requests'])]
+    for key, label in [('searches', u'Searches'), ('words', u'Word views')]:
+        if key not in summary:
+            continue
+        lines.append(change(label, sum(summary[key].values()), sum(previous[key].values())))
+        rising = sorted(((count - previous[key][query], query, count)
+                         for query, count in summary[key].items()
+                         if count > previous[key][query]),
+                        reverse=True)[:limit]
+        if rising:
+            lines.append(u'  Rising {}:'.format(label.lower()))
+            for increase, query, count in rising:
+                lines.append(u'    ({}, was {}) {}'.format(count, previous[key][query], query))
+    return lines
 
 
 def get_location_map(ips):
-    location_map = {}
-
-    for ip in ips:
-        try:
-            response = requests.get(
-                'http://ip-api.com/json/{}'
-                '?fields=status,message,country,regionName,city,district,proxy'.format(ip)
-            )
-            response.raise_for_status()
-            data = response.json()
-            if data.get('message'):
-                raise RuntimeError(data['message'])
-        except Exception as e:
-            print('Error looking up {}: {}'.format(ip, e), file=sys.stderr)
-            time.sleep(1.5)
-            location = u'unknown'
-        else:
-            parts = [
-                part
-                for key in ('district', 'city', 'regionName', 'country')
-                for part in (data[key],)
-                if part
-            ]
-            location = u', '.join(parts)
-            if data['proxy']:
-                location += u' [proxy]'
-
-        location_map.setdefault(location, []).append(ip)
-
-        if int(response.headers.get('x-rl') or '0') <= 0:
-            secs_to_wait = float(response.headers.get('x-ttl') or '1.5')
-            time.sleep(secs_to_wait + 3.0)
-
-    return location_map
+    return geolocation.get_location_map(ips)
 
 
 if __name__ == '__main__':
-    send_weekly_summary()
+    if len(sys.argv) > 1:
+        print(format_summary(summarize_archives(archive_paths(sys.argv[1:]))))
+    else:
+        send_weekly_summary()
@@ -57,6 +57,7 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE = (
+    'dictionary.analytics.AnalyticsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -170,6 +171,100 @@ else:
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
+# Search
+# Answer searches from an in-memory index (dictionary/search.py) instead of
+# running regex queries against the database. Each server process rebuilds its
+# index after SEARCH_INDEX_MAX_AGE seconds to pick up edits made elsewhere.
+# With SEARCH_INDEX=0, searches go to the database, which on Postgres answers
+# them from trigram and full-text indexes.
+
+SEARCH_INDEX = os.environ.get('SEARCH_INDEX', '1') != '0'
+SEARCH_INDEX_MAX_AGE = 300
+
+
+# Page cache
+# Entry and search pages are cached until the dictionary changes
+# (dictionary/caching.py). CACHE_URL chooses where the pages and the lexicon
+# version are kept:
+#     locmem://                  memory of each server process (the default)
+#     file:///path/to/directory  files shared by the processes on one machine
+#     redis://host:6379/0        Redis (needs the django-redis package)
+# The version has a cache of its own ('lexicon'), so culling pages can't
+# evict it. A per-process cache only hears of edits made through that
+# process, so there the cached copies of pages expire after
+# SEARCH_INDEX_MAX_AGE seconds, like the search index, and pages are sent
+# without an ETag or Last-Modified date: browsers couldn't be told when a
+# page changed through another process.
+
+PAGE_CACHE = os.environ.get('PAGE_CACHE', '1') != '0'
+CACHE_URL = os.environ.get('CACHE_URL', 'locmem://')
+cache_url = urlparse.urlparse(CACHE_URL)
+CACHE_SHARED = cache_url.scheme in ('file', 'redis')
+if cache_url.scheme == 'file':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': cache_url.path,
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        },
+        'lexicon': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.path.join(cache_url.path, 'lexicon'),
+        },
+    }
+    PAGE_CACHE_TIMEOUT = 24 * 60 * 60
+elif cache_url.scheme == 'redis':
+    # The version is stored without an expiry, which Redis's volatile-*
+    # eviction policies leave alone.
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': CACHE_URL,
+        },
+        'lexicon': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': CACHE_URL,
+        },
+    }
+    PAGE_CACHE_TIMEOUT = 24 * 60 * 60
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'wiinaq',
+            'OPTIONS': {'MAX_ENTRIES': 2000},
+        },
+        'lexicon': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'wiinaq-lexicon',
+        },
+    }
+    PAGE_CACHE_TIMEOUT = SEARCH_INDEX_MAX_AGE
+
+# The ranked results of up to QUERY_CACHE_SIZE popular searches are kept in
+# each process, and with a cache shared between processes, also in the cache
+# (where ./manage.py warmsearch can put them ahead of time).
+QUERY_CACHE_SIZE = 1000
+QUERY_CACHE_SHARED = CACHE_SHARED
+
+
+# Entry pages
+# Render only the default cell of each ending table and let endings.js fetch
+# the rest from views.entry_endings the first time a cell is clicked.
+
+LAZY_ENDING_TABLES = False
+
+
+# Analytics
+# Count searches, word views and other requests per day, with response times,
+# in the RequestRollup table (dictionary/analytics.py). Counts are kept in
+# memory and saved by a background thread every ANALYTICS_FLUSH_INTERVAL
+# seconds, and when the process exits.
+
+ANALYTICS = os.environ.get('ANALYTICS', '1') != '0'
+ANALYTICS_FLUSH_INTERVAL = 60
+
+
 '''
 # Logging
 LOGGING = {